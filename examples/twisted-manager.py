@@ -15,7 +15,8 @@ class ArbitraryObject(object):
     """
     Any arbitrary object can register for events by simply subscribing to 
     the eventsocket protocol instance, and defining a subscription function 
-    for each event desired.
+    for each event desired. Subscribers are only referenced weakly, so 
+    something else needs to keep the object alive.
     """
     def __init__(self, freeswitch):
         self.freeswitch = freeswitch
@@ -44,7 +45,7 @@ class ExampleServer(Server, InboundEventSocket):
         # turn on debug mode
         protocol_instance.debug = True
         InboundEventSocket.inboundConnected(self, protocol_instance)
-        ArbitraryObject(self.freeswitch)
+        self.arbitrary = ArbitraryObject(self.freeswitch)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Memory used by a Subsystem tracking many channels: CHANNEL_CREATE and
+CHANNEL_ANSWER events are fed for each of 10k synthetic channels, and the
+heap retained per channel is reported, along with the cost per event.
+
+Allocations are measured with tracemalloc when it is installed (the
+pytracemalloc backport); otherwise the size of the objects held for each
+channel is added up with sys.getsizeof, and the growth of the process is
+taken from its peak resident size.
+"""
+from optparse import OptionParser
+import gc
+import resource
+import sys
+import time
+from twisted.test import proto_helpers
+from parseltone.api.base import Subsystem
+from parseltone.eventsocket.protocol import EventSocket
+import samples
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def connect():
+    protocol = EventSocket()
+    protocol.makeConnection(proto_helpers.StringTransport())
+    return Subsystem(protocol), protocol
+
+def answer(sequence):
+    return samples.plain_event([
+        ('Event-Name', 'CHANNEL_ANSWER'),
+        ('Unique-ID', '{uuid}'),
+        ('Channel-State', 'CS_EXECUTE'),
+        ('Channel-Call-State', 'ACTIVE'),
+        ('Answer-State', 'answered'),
+        ('variable_sip_to_tag', 'tag{sequence}'),
+    ], sequence=str(sequence), uuid=samples.channel_uuid(sequence))
+
+def frames(count):
+    return [samples.channel_create(i) for i in xrange(count)] + \
+        [answer(i) for i in xrange(count)]
+
+def object_size(obj, seen):
+    """
+    Returns the size of obj, and of the objects it holds, that are not
+    shared with other channels (interned strings and the like are).
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += object_size(key, seen) + object_size(value, seen)
+    elif isinstance(obj, basestring):
+        return size
+    for name in getattr(obj.__class__, '__slots__', ()):
+        if name != '__weakref__' and hasattr(obj, name):
+            size += object_size(getattr(obj, name), seen)
+    if hasattr(obj, '__dict__'):
+        size += object_size(obj.__dict__, seen)
+    return size
+
+def channel_size(subsystem, protocol):
+    # everything reachable from the protocol is shared by all channels
+    seen = set([id(protocol), id(subsystem)])
+    sizes = [object_size(channel, seen)
+        for channel in subsystem.channels.itervalues()]
+    return float(sum(sizes)) / len(sizes)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-n', '--channels', type='int', default=10000,
+        help='Number of channels to track. (default: %default)')
+    (options, args) = parser.parse_args()
+
+    data = frames(options.channels)
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    subsystem, protocol = connect()
+    start = time.time()
+    for frame in data:
+        protocol.dataReceived(frame)
+    elapsed = time.time() - start
+    gc.collect()
+    print '%d channels, %d events: %.2f us/event' % (
+        len(subsystem.channels), len(data), 1e6 * elapsed / len(data))
+    if tracemalloc:
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        size = sum(stat.size_diff
+            for stat in after.compare_to(before, 'filename'))
+        print 'tracemalloc: %d bytes retained per channel' % (
+            size / len(subsystem.channels))
+    print 'objects: %d bytes held per channel' % channel_size(
+        subsystem, protocol)
+    growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    print 'process: %d KiB peak growth (%d bytes per channel)' % (
+        growth, 1024 * growth / len(subsystem.channels))
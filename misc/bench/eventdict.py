@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Compares EventDict and LazyEventDict for a typical subscriber, which looks
+up a handful of headers in each CHANNEL_CREATE event.
+
+Allocations are measured with tracemalloc when it is installed (the
+pytracemalloc backport); the size of the objects held for each event is
+added up with sys.getsizeof either way, as for the channels benchmark.
+"""
+from optparse import OptionParser
+import time
+from parseltone.eventsocket.utils import EventDict, LazyEventDict
+from channels import object_size
+import samples
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+LOOKUPS = ('Event-Name', 'Unique-ID', 'Channel-State', 'Caller-Caller-ID-Number')
+
+
+def bodies(count):
+    return [samples.channel_create(i).split('\n\n', 1)[1]
+        for i in xrange(count)]
+
+def parse(cls, data):
+    event_dict = cls(data)
+    for key in LOOKUPS:
+        event_dict.get(key)
+    return event_dict
+
+def allocations(cls, data):
+    """
+    Returns the number of memory blocks allocated, and the bytes still
+    held, for parsing each of the given event bodies.
+    """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [parse(cls, body) for body in data]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    del kept
+    return float(blocks) / len(data), float(size) / len(data)
+
+def retained(cls, data):
+    """
+    Returns the bytes of the objects held by the result of parsing each of
+    the given event bodies, other than the bodies themselves; objects shared
+    between the events are counted once.
+    """
+    seen = set([id(body) for body in data])
+    kept = [parse(cls, body) for body in data]
+    return float(sum([object_size(event_dict, seen)
+        for event_dict in kept])) / len(data)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-n', '--events', type='int', default=20000,
+        help='Number of events to parse. (default: %default)')
+    (options, args) = parser.parse_args()
+
+    data = bodies(options.events)
+    for cls in (EventDict, LazyEventDict):
+        start = time.time()
+        for body in data:
+            event_dict = parse(cls, body)
+        elapsed = time.time() - start
+        if cls is LazyEventDict:
+            decoded = len(event_dict._values)
+        else:
+            decoded = len(event_dict)
+        print '%-14s %7.2f us/event, %d of %d headers decoded' % (
+            cls.__name__, 1e6 * elapsed / len(data), decoded,
+            len(EventDict(data[-1])))
+        if tracemalloc:
+            blocks, size = allocations(cls, data[:1000])
+            print '%-14s %7.1f blocks/event, %d bytes/event retained' % (
+                '', blocks, size)
+        print '%-14s %7d bytes/event held by objects' % ('',
+            retained(cls, data[:1000]))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Replays an event socket byte stream through RawEventSocket at a fixed event
+rate, reporting the achieved rate and how much of each second was spent
+framing.
+
+Uses a synthetic stream (see samples.py) unless a captured stream is given
+with --capture; a capture is simply the raw bytes read from the socket.
+"""
+from optparse import OptionParser
+import time
+from parseltone.eventsocket.framing import FrameBuffer
+from parseltone.eventsocket.protocol import RawEventSocket
+import samples
+
+
+class CountingEventSocket(RawEventSocket):
+    events = 0
+    content_bytes = 0
+
+    def eventReceived(self, event_dict, content=None):
+        self.events += 1
+        if content:
+            self.content_bytes += len(content)
+
+
+def count_frames(data):
+    frames = FrameBuffer()
+    frames.feed(data)
+    count = 0
+    while frames.next() is not None:
+        count += 1
+    return count
+
+def replay(chunks, total_events, rate, tick=0.01):
+    """
+    Feeds chunks into a fresh protocol instance. When rate is non-zero, the
+    chunks are released in ticks so that the average is rate events/s.
+    """
+    protocol = CountingEventSocket()
+    protocol.connectionMade()
+    busy = 0.0
+    start = time.time()
+    if not rate:
+        for chunk in chunks:
+            protocol.dataReceived(chunk)
+        busy = time.time() - start
+        return protocol, busy, busy
+    chunks_per_event = float(len(chunks)) / total_events
+    released = 0
+    while released < len(chunks):
+        due = int((time.time() - start) * rate * chunks_per_event) + 1
+        began = time.time()
+        for chunk in chunks[released:due]:
+            protocol.dataReceived(chunk)
+        released = max(released, due)
+        busy += time.time() - began
+        time.sleep(tick)
+    return protocol, busy, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-n', '--events', type='int', default=50000,
+        help='Number of synthetic events to generate. (default: %default)')
+    parser.add_option('-r', '--rate', type='int', default=10000,
+        help='Events per second to replay at, 0 for as fast as possible. '
+        '(default: %default)')
+    parser.add_option('-c', '--capture', dest='capture', default=None,
+        help='Replay a captured raw event socket stream instead.')
+    parser.add_option('-s', '--chunk-size', type='int', default=1448,
+        help='Bytes delivered per dataReceived call. (default: %default)')
+    (options, args) = parser.parse_args()
+
+    if options.capture:
+        data = open(options.capture, 'rb').read()
+    else:
+        data = ''.join(samples.stream(options.events))
+    total_events = count_frames(data)
+    chunks = samples.chunked(data, options.chunk_size)
+
+    protocol, busy, elapsed = replay(chunks, total_events, options.rate)
+    print '%d events, %d bytes in %d chunks' % (
+        protocol.events, len(data), len(chunks))
+    print 'elapsed: %.3fs, achieved %.0f events/s' % (
+        elapsed, protocol.events / elapsed)
+    print 'framing: %.3fs busy (%.1f%%), %.2f us/event' % (
+        busy, 100 * busy / elapsed, 1e6 * busy / protocol.events)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Load test for OutboundEventSocket: a fake FreeSWITCH opens many outbound
+connections at once, as if that many calls had hit the socket application,
+and each session answers, plays a file and hangs up its call.
+
+Both ends run in this process, so the reported rate includes the cost of the
+fake FreeSWITCH too. Every session uses two file descriptors here, so raise
+the limit first for large runs (ulimit -n 4096).
+"""
+from optparse import OptionParser
+import time
+import urllib
+import uuid as uuidlib
+try:
+    from twisted.internet import epollreactor
+    epollreactor.install()
+except Exception:
+    pass
+from twisted.internet import defer, protocol, reactor
+from parseltone.api.outboundserver import OutboundEventSocket
+import samples
+
+
+def command_reply(text, headers=()):
+    return 'Content-Type: command/reply\n%sReply-Text: %s\n\n' % (
+        ''.join(['%s: %s\n' % (key, urllib.quote(value))
+            for key, value in headers]), text)
+
+
+class FakeFreeSWITCH(protocol.Protocol):
+    """
+    Plays the FreeSWITCH side of one outbound connection, replying to each
+    command and sending the events an executed application would cause.
+    """
+    def connectionMade(self):
+        self.uuid = str(uuidlib.uuid4())
+        self.buffer = ''
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while '\n\n' in self.buffer:
+            command, self.buffer = self.buffer.split('\n\n', 1)
+            self.commandReceived(command.split('\n'))
+
+    def commandReceived(self, lines):
+        if lines[0] == 'connect':
+            self.transport.write(command_reply('+OK', [
+                ('Unique-ID', self.uuid),
+                ('Channel-Name', 'sofia/internal/1001@10.0.0.5'),
+                ('Caller-Caller-ID-Number', '1001'),
+                ('Caller-Destination-Number', '3000'),
+            ]))
+        elif lines[0] == 'sendmsg':
+            headers = dict(line.split(': ', 1) for line in lines[1:])
+            self.transport.write(command_reply('+OK'))
+            self.event('CHANNEL_EXECUTE_COMPLETE',
+                ('Application', headers['execute-app-name']),
+                ('Application-UUID', headers.get('Event-UUID', '')))
+        elif lines[0].startswith('api '):
+            self.transport.write(samples.api_response('+OK\n'))
+            if lines[0].startswith('api sched_hangup'):
+                self.event('CHANNEL_HANGUP',
+                    ('Hangup-Cause', 'NORMAL_CLEARING'))
+                notice = 'Disconnected, goodbye.\n'
+                self.transport.write('Content-Type: text/disconnect-notice\n'
+                    'Content-Length: %d\n\n%s' % (len(notice), notice))
+                self.transport.loseConnection()
+        else:
+            self.transport.write(command_reply('+OK'))
+
+    def event(self, name, *headers):
+        self.transport.write(samples.plain_event((('Event-Name', name),
+            ('Unique-ID', self.uuid)) + headers))
+
+
+class CallControl(OutboundEventSocket):
+    def __init__(self, sessions):
+        self.remaining = sessions
+        self.peak = 0
+        self.done = defer.Deferred()
+
+    @defer.inlineCallbacks
+    def outboundSession(self, session):
+        self.peak = max(self.peak, len(self.sessions))
+        yield session.execute('answer')
+        yield session.execute('playback', 'ivr/ivr-welcome.wav')
+        yield session.hangup()
+
+    def outboundSessionEnded(self, session, reason):
+        self.remaining -= 1
+        if not self.remaining:
+            self.done.callback(None)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-n', '--sessions', type='int', default=1000,
+        help='Number of concurrent sessions. (default: %default)')
+    parser.add_option('-p', '--port', type='int', default=18084,
+        help='Port to listen on. (default: %default)')
+    (options, args) = parser.parse_args()
+
+    server = CallControl(options.sessions)
+    # the connections all arrive at once, which a short accept queue would
+    ## turn into SYN retries
+    server.outboundListen('127.0.0.1:%d' % options.port,
+        backlog=options.sessions)
+    client = protocol.ClientFactory()
+    client.protocol = FakeFreeSWITCH
+    def failed(connector, reason):
+        print 'connection failed: %s' % reason.getErrorMessage()
+        server.outboundSessionEnded(None, reason)
+    client.clientConnectionFailed = failed
+    start = time.time()
+    for i in xrange(options.sessions):
+        reactor.connectTCP('127.0.0.1', options.port, client)
+    def finished(result):
+        elapsed = time.time() - start
+        stats = server.outbound_factory.stats
+        print '%s: %d sessions completed, peak %d concurrent' % (
+            reactor.__class__.__name__, stats['completed'], server.peak)
+        print 'elapsed: %.3fs, %.0f sessions/s' % (
+            elapsed, stats['completed'] / elapsed)
+        reactor.stop()
+    server.done.addCallback(finished)
+    reactor.run()
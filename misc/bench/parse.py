@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Measures the cost of receiving CHANNEL_CREATE and HEARTBEAT events through
+EventSocket, from complete frames to a subscriber that reads a few headers.
+Run it before and after changes to the event path to catch regressions.
+"""
+from optparse import OptionParser
+import time
+from twisted.test import proto_helpers
+from parseltone.eventsocket.protocol import EventSocket
+import samples
+
+
+class Subscriber(object):
+    def onChannelCreate(self, event, content):
+        event.dict['Unique-ID']
+        event.dict['Caller-Caller-ID-Number']
+
+    def onHeartbeat(self, event, content):
+        event.dict['Session-Count']
+
+
+def connect():
+    protocol = EventSocket()
+    protocol.makeConnection(proto_helpers.StringTransport())
+    protocol.subscribe(Subscriber())
+    return protocol
+
+def measure(protocol, frames, repeat=3):
+    """
+    Returns the best time per frame, in microseconds, over repeat runs.
+    """
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        for frame in frames:
+            protocol.dataReceived(frame)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return 1e6 * best / len(frames)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-n', '--events', type='int', default=10000,
+        help='Number of events of each type per run. (default: %default)')
+    (options, args) = parser.parse_args()
+
+    protocol = connect()
+    for name, build in (('CHANNEL_CREATE', samples.channel_create),
+            ('HEARTBEAT', samples.heartbeat)):
+        frames = [build(i) for i in xrange(options.events)]
+        print '%-15s %7.2f us/event' % (name, measure(protocol, frames))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Replays a recording of the data received by an event socket (see
+parseltone.eventsocket.recording) into EventSocket, at the speed it was
+recorded, N times that, or as fast as possible, and reports the events per
+second, the latency of parsing and dispatching each event, and the time
+spent in each subscription function. Replaying the same recording before
+and after changes to the event path catches regressions with real traffic.
+
+Without a recording at hand, --synthesize writes one from the samples.
+"""
+from optparse import OptionParser
+import time
+from twisted.internet import defer, reactor, task
+from twisted.test import proto_helpers
+from parseltone.api.base import Subsystem
+from parseltone.eventsocket.protocol import EventSocket
+from parseltone.eventsocket.recording import Recorder, read_recording
+from parseltone.utils.processes import load_object
+import samples
+
+
+class TimedEventSocket(EventSocket):
+    """
+    Times each event from the moment its frame is complete to the return of
+    the last subscription function, less the time spent in them.
+    """
+    def __init__(self):
+        EventSocket.__init__(self)
+        self.latencies = []
+        self.handler_time = 0.0
+        # (calls, seconds) by subscription function
+        self.handlers = {}
+
+    def eventReceived(self, event_dict, content=None):
+        self.handler_time = 0.0
+        start = time.time()
+        EventSocket.eventReceived(self, event_dict, content=content)
+        self.latencies.append(time.time() - start - self.handler_time)
+
+    def instrument(self, obj):
+        """
+        Subscribes obj, timing each of its subscription functions.
+        """
+        self.unsubscribe(obj)
+        for funcname, eventname, subclass in self._subscriptionFunctions(obj):
+            name = '%s.%s' % (obj.__class__.__name__, funcname)
+            setattr(obj, funcname, self._timed(name, getattr(obj, funcname)))
+        self.subscribe(obj, weak=False)
+
+    def _timed(self, name, func):
+        def timed(event, content):
+            start = time.time()
+            try:
+                return func(event, content)
+            finally:
+                elapsed = time.time() - start
+                self.handler_time += elapsed
+                calls, total = self.handlers.get(name, (0, 0.0))
+                self.handlers[name] = (calls + 1, total + elapsed)
+        return timed
+
+
+def synthesize(path, events, rate):
+    """
+    Writes a recording of the sample stream, received at rate events per
+    second in TCP segment sized chunks.
+    """
+    recorder = Recorder(open(path, 'wb'))
+    clock = recorder.clock = task.Clock()
+    for frame in samples.stream(events):
+        for chunk in samples.chunked(frame):
+            recorder.record(chunk)
+        clock.advance(1.0 / rate)
+    recorder.close()
+
+def replay(protocol, path, speed):
+    """
+    Feeds the recording to the protocol, at speed times the recorded pace or
+    as fast as possible if speed is 0. Returns a deferred which is called
+    back with the seconds taken, and the most the feeding fell behind.
+    """
+    records = read_recording(path)
+    if not speed:
+        start = time.time()
+        for timestamp, data in records:
+            protocol.dataReceived(data)
+        return defer.succeed((time.time() - start, 0.0))
+    d = defer.Deferred()
+    first = next(records, None)
+    if first is None:
+        return defer.succeed((0.0, 0.0))
+    origin = first[0]
+    start = time.time()
+    behind = [0.0]
+    def feed(record):
+        while record is not None:
+            timestamp, data = record
+            delay = start + (timestamp - origin) / speed - time.time()
+            if delay > 0:
+                reactor.callLater(delay, feed, record)
+                return
+            behind[0] = max(behind[0], -delay)
+            protocol.dataReceived(data)
+            record = next(records, None)
+        d.callback((time.time() - start, behind[0]))
+    feed(first)
+    return d
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def report(protocol, elapsed, behind):
+    latencies = sorted(protocol.latencies)
+    if not latencies:
+        print 'No events in the recording.'
+        return
+    print '%d events in %.3f s: %.0f events/s' % (len(latencies), elapsed,
+        len(latencies) / elapsed if elapsed else 0)
+    if behind:
+        print 'Fell behind the recording by up to %.1f ms' % (1e3 * behind)
+    print 'Latency (us): p50 %.1f  p90 %.1f  p99 %.1f  max %.1f' % tuple(
+        1e6 * value for value in (percentile(latencies, 0.5),
+        percentile(latencies, 0.9), percentile(latencies, 0.99),
+        latencies[-1]))
+    for name, (calls, total) in sorted(protocol.handlers.items(),
+            key=lambda item: -item[1][1]):
+        print '%-40s %8d calls %9.1f ms %7.2f us/call' % (name, calls,
+            1e3 * total, 1e6 * total / calls)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] recording')
+    parser.add_option('--speed', type='float', default=1.0,
+        help='Multiple of the recorded pace to replay at, or 0 for as fast '
+            'as possible. (default: %default)')
+    parser.add_option('--subscriber', action='append', default=[],
+        help='Subscriber named as module:attribute, instantiated without '
+            'arguments; may be repeated. (default: a Subsystem)')
+    parser.add_option('--synthesize', type='int', metavar='EVENTS',
+        help='First write a recording of this many sample events.')
+    parser.add_option('--rate', type='float', default=1000,
+        help='Events per second of the synthesized recording. '
+            '(default: %default)')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('the recording to replay must be given')
+    if options.synthesize:
+        synthesize(args[0], options.synthesize, options.rate)
+
+    protocol = TimedEventSocket()
+    protocol.makeConnection(proto_helpers.StringTransport())
+    if options.subscriber:
+        for name in options.subscriber:
+            protocol.instrument(load_object(name)())
+    else:
+        protocol.instrument(Subsystem(protocol))
+    def finished(result):
+        report(protocol, *result)
+    d = replay(protocol, args[0], options.speed)
+    d.addCallback(finished)
+    if not d.called:
+        d.addBoth(lambda ignored: reactor.stop())
+        reactor.run()
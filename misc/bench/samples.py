@@ -0,0 +1,179 @@
+"""
+Synthetic event socket traffic for the benchmarks in this directory.
+
+The frames mimic what mod_event_socket sends for 'event plain' subscribers:
+an outer text/event-plain header block whose body is the URL-encoded event
+headers, with header counts and sizes close to a real FreeSWITCH 1.2 box.
+"""
+import urllib
+import uuid as uuidlib
+
+CHANNEL_CREATE_HEADERS = [
+    ('Event-Name', 'CHANNEL_CREATE'),
+    ('Core-UUID', '0d9a2c2e-4ab8-11e1-bd4e-0f5c36f2cc27'),
+    ('FreeSWITCH-Hostname', 'fs01.example.com'),
+    ('FreeSWITCH-Switchname', 'fs01.example.com'),
+    ('FreeSWITCH-IPv4', '10.0.0.5'),
+    ('FreeSWITCH-IPv6', '::1'),
+    ('Event-Date-Local', '2012-01-31 12:32:11'),
+    ('Event-Date-GMT', 'Tue, 31 Jan 2012 19:32:11 GMT'),
+    ('Event-Date-Timestamp', '1328038331613445'),
+    ('Event-Calling-File', 'switch_core_state_machine.c'),
+    ('Event-Calling-Function', 'switch_core_session_run'),
+    ('Event-Calling-Line-Number', '417'),
+    ('Event-Sequence', '{sequence}'),
+    ('Channel-State', 'CS_INIT'),
+    ('Channel-Call-State', 'DOWN'),
+    ('Channel-State-Number', '2'),
+    ('Channel-Name', 'sofia/internal/1001@10.0.0.5'),
+    ('Unique-ID', '{uuid}'),
+    ('Call-Direction', 'inbound'),
+    ('Presence-Call-Direction', 'inbound'),
+    ('Channel-HIT-Dialplan', 'true'),
+    ('Channel-Presence-ID', '1001@10.0.0.5'),
+    ('Channel-Call-UUID', '{uuid}'),
+    ('Answer-State', 'ringing'),
+    ('Caller-Direction', 'inbound'),
+    ('Caller-Username', '1001'),
+    ('Caller-Dialplan', 'XML'),
+    ('Caller-Caller-ID-Name', 'Extension 1001'),
+    ('Caller-Caller-ID-Number', '1001'),
+    ('Caller-Network-Addr', '10.0.0.21'),
+    ('Caller-ANI', '1001'),
+    ('Caller-Destination-Number', '3000'),
+    ('Caller-Unique-ID', '{uuid}'),
+    ('Caller-Source', 'mod_sofia'),
+    ('Caller-Context', 'default'),
+    ('Caller-Channel-Name', 'sofia/internal/1001@10.0.0.5'),
+    ('Caller-Profile-Index', '1'),
+    ('Caller-Profile-Created-Time', '1328038331613445'),
+    ('Caller-Channel-Created-Time', '1328038331613445'),
+    ('Caller-Channel-Answered-Time', '0'),
+    ('Caller-Channel-Progress-Time', '0'),
+    ('Caller-Channel-Progress-Media-Time', '0'),
+    ('Caller-Channel-Hangup-Time', '0'),
+    ('Caller-Channel-Transfer-Time', '0'),
+    ('Caller-Screen-Bit', 'true'),
+    ('Caller-Privacy-Hide-Name', 'false'),
+    ('Caller-Privacy-Hide-Number', 'false'),
+    ('variable_direction', 'inbound'),
+    ('variable_uuid', '{uuid}'),
+    ('variable_session_id', '{sequence}'),
+    ('variable_sip_from_user', '1001'),
+    ('variable_sip_from_uri', '1001@10.0.0.5'),
+    ('variable_sip_from_host', '10.0.0.5'),
+    ('variable_channel_name', 'sofia/internal/1001@10.0.0.5'),
+    ('variable_sip_local_network_addr', '10.0.0.5'),
+    ('variable_sip_network_ip', '10.0.0.21'),
+    ('variable_sip_network_port', '5060'),
+    ('variable_sip_received_ip', '10.0.0.21'),
+    ('variable_sip_received_port', '5060'),
+    ('variable_sip_via_protocol', 'udp'),
+    ('variable_sip_from_user_stripped', '1001'),
+    ('variable_sofia_profile_name', 'internal'),
+    ('variable_sip_req_user', '3000'),
+    ('variable_sip_req_uri', '3000@10.0.0.5'),
+    ('variable_sip_req_host', '10.0.0.5'),
+    ('variable_sip_to_user', '3000'),
+    ('variable_sip_to_uri', '3000@10.0.0.5'),
+    ('variable_sip_to_host', '10.0.0.5'),
+    ('variable_sip_contact_user', '1001'),
+    ('variable_sip_contact_port', '5060'),
+    ('variable_sip_contact_uri', '1001@10.0.0.21:5060'),
+    ('variable_sip_contact_host', '10.0.0.21'),
+    ('variable_sip_via_host', '10.0.0.21'),
+    ('variable_sip_via_port', '5060'),
+    ('variable_sip_via_rport', '5060'),
+    ('variable_switch_r_sdp', 'v=0\no=- 1 1 IN IP4 10.0.0.21\n'
+        's=-\nc=IN IP4 10.0.0.21\nt=0 0\nm=audio 16384 RTP/AVP 0 8 101\n'),
+    ('variable_sip_call_id', '{sequence}@10.0.0.21'),
+    ('variable_sip_user_agent', 'Polycom/3.3.1.0933 PolycomSoundPointIP'),
+    ('variable_endpoint_disposition', 'RECEIVED'),
+]
+
+HEARTBEAT_HEADERS = [
+    ('Event-Name', 'HEARTBEAT'),
+    ('Core-UUID', '0d9a2c2e-4ab8-11e1-bd4e-0f5c36f2cc27'),
+    ('FreeSWITCH-Hostname', 'fs01.example.com'),
+    ('FreeSWITCH-Switchname', 'fs01.example.com'),
+    ('FreeSWITCH-IPv4', '10.0.0.5'),
+    ('FreeSWITCH-IPv6', '::1'),
+    ('Event-Date-Local', '2012-01-31 12:32:11'),
+    ('Event-Date-GMT', 'Tue, 31 Jan 2012 19:32:11 GMT'),
+    ('Event-Date-Timestamp', '1328038331613445'),
+    ('Event-Calling-File', 'switch_core.c'),
+    ('Event-Calling-Function', 'send_heartbeat'),
+    ('Event-Calling-Line-Number', '68'),
+    ('Event-Sequence', '{sequence}'),
+    ('Event-Info', 'System Ready'),
+    ('Up-Time', '0 years, 0 days, 3 hours, 21 minutes, 7 seconds'),
+    ('Session-Count', '2817'),
+    ('Max-Sessions', '5000'),
+    ('Session-Per-Sec', '30'),
+    ('Session-Since-Startup', '331877'),
+    ('Idle-CPU', '61.000000'),
+]
+
+
+def plain_event(headers, **values):
+    """
+    Returns a complete text/event-plain frame for the given header list,
+    substituting {uuid} and {sequence} placeholders from values.
+    """
+    body = ''.join(['%s: %s\n' % (key, urllib.quote(value.format(**values)))
+        for key, value in headers]) + '\n'
+    return 'Content-Length: %d\nContent-Type: text/event-plain\n\n%s' % (
+        len(body), body)
+
+def channel_uuid(sequence):
+    return str(uuidlib.UUID(int=sequence))
+
+def channel_create(sequence):
+    return plain_event(CHANNEL_CREATE_HEADERS, sequence=str(sequence),
+        uuid=channel_uuid(sequence))
+
+def heartbeat(sequence):
+    return plain_event(HEARTBEAT_HEADERS, sequence=str(sequence))
+
+def api_response(body):
+    return 'Content-Type: api/response\nContent-Length: %d\n\n%s' % (
+        len(body), body)
+
+def show_channels(count):
+    """
+    Returns an api/response frame resembling 'show channels' output for
+    count active calls.
+    """
+    rows = ['uuid,direction,created,created_epoch,name,state,cid_name,'
+        'cid_num,ip_addr,dest,application,application_data,dialplan,context,'
+        'read_codec,read_rate,write_codec,write_rate,secure,hostname']
+    for i in xrange(count):
+        rows.append('%s,inbound,2012-01-31 12:32:11,1328038331,'
+            'sofia/internal/1001@10.0.0.5,CS_EXECUTE,Extension 1001,1001,'
+            '10.0.0.21,3000,bridge,user/3000,XML,default,PCMU,8000,PCMU,'
+            '8000,,fs01.example.com' % uuidlib.UUID(int=i))
+    rows.append('')
+    rows.append('%d total.' % count)
+    return api_response('\n'.join(rows) + '\n')
+
+def stream(events, show_channels_every=1000, show_channels_count=5000):
+    """
+    Returns a list of frames: mostly CHANNEL_CREATE events, with a heartbeat
+    every 100 events and a large 'show channels' api/response mixed in.
+    """
+    frames = []
+    big = show_channels(show_channels_count)
+    for i in xrange(events):
+        if show_channels_every and i % show_channels_every == 0:
+            frames.append(big)
+        elif i % 100 == 0:
+            frames.append(heartbeat(i))
+        else:
+            frames.append(channel_create(i))
+    return frames
+
+def chunked(data, size=1448):
+    """
+    Splits data into TCP segment sized chunks.
+    """
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
@@ -1,3 +1,3 @@
 from parseltone.api.inboundclient import InboundEventSocket
 from parseltone.api.outboundserver import OutboundEventSocket
-
+from parseltone.api.cluster import ClusterEventSocket
@@ -1,51 +1,262 @@
+from collections import OrderedDict
+from twisted.internet import defer, reactor
 from parseltone.api.channel import Channel
 from parseltone.api.commands import Commands
 
 
 class Channels(dict):
+    """
+    The channels known to a Subsystem, by uuid. Besides the channels
+    themselves, this keeps an index of the channels that do and do not
+    currently exist in FreeSWITCH, as told by their events. A channel that
+    is only known by its uuid (such as the peer of a bridge) is in neither,
+    until an event of its own arrives.
+
+    Channels that no longer exist are kept for inactive_ttl seconds, and at
+    most inactive_limit of them, after which they are forgotten, and the
+    expired function (if any) is called with each.
+    """
+    inactive_ttl = 300
+    inactive_limit = 10000
+    # source of the time channels are deactivated at
+    clock = reactor
+
+    def __init__(self, expired=None):
+        dict.__init__(self)
+        self.expired = expired
+        self._active = {}
+        # oldest first, with the time each was deactivated
+        self._inactive = OrderedDict()
+        self._deactivated = {}
+
+    def __setitem__(self, uuid, channel):
+        self._discard(uuid)
+        dict.__setitem__(self, uuid, channel)
+        if channel.destroyed:
+            self.deactivate(uuid)
+
+    def __delitem__(self, uuid):
+        dict.__delitem__(self, uuid)
+        self._discard(uuid)
+
+    def pop(self, uuid, *default):
+        self._discard(uuid)
+        return dict.pop(self, uuid, *default)
+
+    def clear(self):
+        dict.clear(self)
+        self._active.clear()
+        self._inactive.clear()
+        self._deactivated.clear()
+
+    def _discard(self, uuid):
+        self._active.pop(uuid, None)
+        self._inactive.pop(uuid, None)
+        self._deactivated.pop(uuid, None)
+
+    def activate(self, uuid):
+        """
+        Moves the channel to the active index, once it is known to exist,
+        unless it no longer does.
+        """
+        if uuid in self._active or uuid in self._inactive:
+            return
+        channel = self.get(uuid)
+        if channel is not None and not channel.destroyed:
+            self._active[uuid] = channel
+
+    def deactivate(self, uuid):
+        """
+        Moves the channel to the inactive index, once it no longer exists.
+        """
+        channel = self.get(uuid)
+        if channel is None or uuid in self._inactive:
+            return
+        self._active.pop(uuid, None)
+        self._inactive[uuid] = channel
+        self._deactivated[uuid] = self.clock.seconds()
+        self.expire()
+
+    def expire(self):
+        """
+        Forgets the channels which have been inactive for too long, or are
+        beyond the limit.
+        """
+        expiry = self.clock.seconds() - self.inactive_ttl
+        while self._inactive:
+            uuid = next(iter(self._inactive))
+            if len(self._inactive) <= self.inactive_limit and \
+                    self._deactivated[uuid] > expiry:
+                break
+            channel = self.pop(uuid)
+            if self.expired:
+                self.expired(channel)
+
     def active(self):
         """
-        Returns a new dictionary populated only with channels that DO 
-        currently exist in FreeSWITCH.
+        Returns the dictionary of channels that DO currently exist in
+        FreeSWITCH. This is the index itself, and must not be modified.
         """
-        results = {}
-        for uuid, channel in self.items():
-            if not channel.exists():
-                continue
-            results.update({uuid: channel})
-        return results
+        return self._active
 
     def inactive(self):
         """
-        Returns a new dictionary populated only with channels that DO NOT 
-        currently exist in FreeSWITCH. (These channels existed at one time,
-        but are now not connected.)
+        Returns the dictionary of channels that DO NOT currently exist in
+        FreeSWITCH. (These channels existed at one time, but are now not
+        connected.) This is the index itself, and must not be modified.
         """
-        results = {}
-        for uuid, channel in self.items():
-            if channel.exists():
-                continue
-            results.update({uuid: channel})
-        return results
+        self.expire()
+        return self._inactive
 
 
 class Subsystem(Commands):
-    channels = Channels()
+    """
+    Tracks every channel through its CHANNEL_* events, so the state of any
+    channel is known without asking FreeSWITCH.
+    """
+    # commands a batch keeps outstanding at once, unless told otherwise
+    batch_concurrency = 50
+    # the class of the channel objects; a subclass of Channel may change
+    ## its settings (such as setvar_delay) for the channels of this subsystem
+    channel_class = Channel
+
+    def __init__(self, eventsocket):
+        self.channels = Channels(expired=self._unsubscribeChannel)
+        Commands.__init__(self, eventsocket)
 
-    def subscribe(self, target):
+    def subscribe(self, target, filters=None, weak=True, queue=None):
         """
         Allow target objects to subscribe directly through the subsystem.
         """
-        self.eventsocket.subscribe(target)
+        self.eventsocket.subscribe(target, filters=filters, weak=weak,
+            queue=queue)
+
+    def unsubscribe(self, target):
+        """
+        Stop target objects from receiving events through the subsystem.
+        """
+        self.eventsocket.unsubscribe(target)
 
     def flush(self, channel):
         """
-        Stop internally tracking the given channel. Does not hang up the 
+        Stop internally tracking the given channel. Does not hang up the
         channel.
         """
         self.channels.pop(channel.uuid)
+        self._unsubscribeChannel(channel)
+
+    def _unsubscribeChannel(self, channel):
+        self.eventsocket.unsubscribe(channel.eventlistener)
+
+    def channel(self, uuid):
+        """
+        Returns the channel object for the uuid, tracking it from now on. It
+        is only listed as active once one of its own events has arrived.
+        """
+        try:
+            return self.channels[uuid]
+        except KeyError:
+            channel = self.channels[uuid] = self.channel_class(
+                self.eventsocket, uuid)
+            return channel
+
+    def batch(self, uuids, operation, *args, **kwargs):
+        """
+        Runs an operation on many channels, keeping at most concurrency
+        (default: batch_concurrency) of them outstanding at once. The
+        operation is the name of a Channel method, which is given the args
+        and kwargs, or a function taking the channel and returning a
+        deferred. Channels not already tracked are given a Channel of their
+        own for the operation. For example, to hang up every call on a
+        gateway:
+
+            uuids = [uuid for uuid, channel in
+                subsystem.channels.active().iteritems()
+                if channel.variables.get('sip_gateway_name') == 'X']
+            subsystem.batch(uuids, 'hangup', cause='NORMAL_CLEARING')
+
+        Returns a deferred which is called back once all are done with a
+        dictionary of (success, result) by uuid; a result starting with
+        -ERR counts as a failure. If a progress function is given, it is
+        called with the uuid, success, result, and the numbers completed
+        and in total, as each channel's operation completes.
+        """
+        concurrency = kwargs.pop('concurrency', None) or \
+            self.batch_concurrency
+        progress = kwargs.pop('progress', None)
+        uuids = list(uuids)
+        semaphore = defer.DeferredSemaphore(concurrency)
+        results = {}
+        def run(uuid):
+            # a channel that is not tracked is not started being tracked,
+            ## since the uuid may be stale, or mistyped
+            channel = self.channels.get(uuid) or \
+                self.channel_class(self.eventsocket, uuid)
+            if callable(operation):
+                return operation(channel)
+            return getattr(channel, operation)(*args, **kwargs)
+        def finished(result, uuid, success):
+            if success and isinstance(result, basestring) and \
+                    result.startswith('-ERR'):
+                success = False
+            results[uuid] = (success, result)
+            if progress:
+                progress(uuid, success, result, len(results), len(uuids))
+        deferreds = []
+        for uuid in uuids:
+            d = semaphore.run(run, uuid)
+            d.addCallbacks(finished, finished, callbackArgs=(uuid, True),
+                errbackArgs=(uuid, False))
+            deferreds.append(d)
+        d = defer.DeferredList(deferreds)
+        d.addCallback(lambda ignored: results)
+        return d
+
+    def _channelEvent(self, event):
+        uuid = event.dict.get('Unique-ID')
+        if not uuid:
+            return None
+        channel = self.channel(uuid)
+        channel.update(event)
+        # any event of its own (CHANNEL_CREATE or CHANNEL_ORIGINATE first,
+        ## unless the channel was up before this connection was) shows the
+        ## channel exists
+        self.channels.activate(uuid)
+        return channel
+
+    def onChannelCreate(self, event, content):
+        self._channelEvent(event)
 
     def onChannelOriginate(self, event, content):
-        # TODO: create a channel object here, and add to channels dict
-        pass
+        self._channelEvent(event)
+
+    def onChannelAnswer(self, event, content):
+        self._channelEvent(event)
+
+    def onChannelBridge(self, event, content):
+        channel = self._channelEvent(event)
+        peer_uuid = event.dict.get('Other-Leg-Unique-ID')
+        if channel and peer_uuid:
+            channel.bridge_peer = peer_uuid
+            self.channel(peer_uuid).bridge_peer = channel.uuid
+
+    def onChannelUnbridge(self, event, content):
+        channel = self._channelEvent(event)
+        if channel and channel.bridge_peer:
+            peer = self.channels.get(channel.bridge_peer)
+            if peer and peer.bridge_peer == channel.uuid:
+                peer.bridge_peer = None
+            channel.bridge_peer = None
+
+    def onChannelExecuteComplete(self, event, content):
+        # the application may have changed the channel's variables
+        self._channelEvent(event)
+
+    def onChannelHangup(self, event, content):
+        self._channelEvent(event)
 
+    def onChannelDestroy(self, event, content):
+        channel = self._channelEvent(event)
+        if channel:
+            channel.destroyed = True
+            self.channels.deactivate(channel.uuid)
@@ -1,36 +1,130 @@
+from collections import OrderedDict
+import json
 import logging
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.python import failure
+from parseltone.api.commands import send_command
+from parseltone.eventsocket import utils
 from parseltone.utils.decorators import requires_attr
 
 # create a log target for this module
 logger = logging.getLogger(__name__)
 
 
-# TODO: I don't really like the way this is done very much, but for now, 
-## it accomplishes the goal of reducing repetitive code
-def bgapi_wrapper(command, 
-        success_func=lambda data: d.callback(data), 
-        failure_func=lambda failure: logger.error(failure.getErrorMessage())):
-    d = defer.Deferred()
-    self.eventsocket.bgapi(command).addCallback(
-        success_func).addErrback(failure_func)
-    return d
-
-
 class ChannelEvents(object):
+    __slots__ = ('channel', 'eventsocket', '__weakref__')
+
     def __init__(self, channel, eventsocket):
         self.channel = channel
         self.eventsocket = eventsocket
-        self.eventsocket.subscribe(self)
+        # only receive the events of this channel, when it is known
+        filters = None
+        if channel.uuid:
+            filters = {'Unique-ID': channel.uuid}
+        self.eventsocket.subscribe(self, filters=filters)
 
 
 class Channel(object):
+    # a Subsystem keeps one of these for every channel, so instances have
+    ## no __dict__ (subclasses not declaring __slots__ still get one)
+    __slots__ = ('eventsocket', 'uuid', 'variables', 'eventlistener',
+        'state', 'call_state', 'answer_state', 'hangup_cause', 'bridge_peer',
+        'destroyed', 'variables_time', 'pending_variables',
+        '_pending_deferreds', '_flush_call', '__weakref__')
+    # NOTE: the settings below are class attributes, which the instances
+    ## can not override; to change them for some channels only, set them on
+    ## a subclass, and give that to the Subsystem as its channel_class
+    # seconds variables set with setvar and setvars are held for, so that
+    ## those set together are sent as a single uuid_setvar_multi; 0 sends
+    ## them once the current reactor iteration is done
+    setvar_delay = 0
+    # seconds the variables learned from events and uuid_dump are trusted
+    ## by getvar; None trusts them until an event invalidates them
+    variable_ttl = None
+    # events after which the known variables may be out of date, unless the
+    ## event itself carries them (an application may have set variables)
+    invalidating_events = frozenset(['CHANNEL_EXECUTE_COMPLETE'])
+    # source of delayed calls; may be replaced with a task.Clock for testing
+    clock = reactor
     _uuid_required_error = "Channel not established, method '{func}' invalid."
 
     def __init__(self, eventsocket, uuid=None):
         self.eventsocket = eventsocket
-        self.eventlistener = ChannelEvents(self, eventsocket)
         self.uuid = uuid
+        # the last known state of the channel, as given by its events (see
+        ## update), or None when no event has been seen yet
+        self.state = None
+        self.call_state = None
+        self.answer_state = None
+        self.hangup_cause = None
+        # the uuid of the channel this one is bridged to
+        self.bridge_peer = None
+        self.destroyed = False
+        self.variables = {}
+        # when the variables were last learned from FreeSWITCH (by
+        ## clock.seconds), or None when they are not known to be current
+        self.variables_time = None
+        # variables waiting to be sent by flush, and the deferreds of the
+        ## setvar and setvars calls that set them
+        self.pending_variables = None
+        self._pending_deferreds = None
+        self._flush_call = None
+        self.eventlistener = ChannelEvents(self, eventsocket)
+
+    def update(self, event):
+        """
+        Updates the known state and variables of this channel from one of
+        its events.
+        """
+        headers = event.dict
+        self.state = headers.get('Channel-State', self.state)
+        self.call_state = headers.get('Channel-Call-State', self.call_state)
+        self.answer_state = headers.get('Answer-State', self.answer_state)
+        self.hangup_cause = headers.get('Hangup-Cause', self.hangup_cause)
+        if not self._cacheVariables(headers) and \
+                headers.get('Event-Name') in self.invalidating_events:
+            self.invalidate()
+
+    def _cacheVariables(self, headers):
+        """
+        Stores the variable_* headers of an event (or of uuid_dump) as the
+        current variables, returning whether there were any.
+        """
+        found = False
+        for key, value in utils.prefixed(headers, 'variable_'):
+            self.variables[utils.header_name(key[9:])] = value
+            found = True
+        if found:
+            self.variables_time = self.clock.seconds()
+        return found
+
+    def invalidate(self):
+        """
+        Stops getvar from answering with the known variables, until they are
+        learned again from an event or dump.
+        """
+        self.variables_time = None
+
+    @property
+    def fresh(self):
+        """
+        Whether the known variables may be used in place of asking
+        FreeSWITCH.
+        """
+        if self.variables_time is None:
+            return False
+        return self.variable_ttl is None or \
+            self.clock.seconds() - self.variables_time < self.variable_ttl
+
+    def bgapi(self, command, timeout=None):
+        """
+        Runs the command as a background job; see commands.send_command. A
+        timeout (in seconds) overrides the eventsocket's default
+        job_timeout.
+        """
+        # variables still held go first, as the command may depend on them
+        self._flushHeld()
+        return send_command(self.eventsocket.bgapi, command, timeout=timeout)
 
     # TODO: create_uuid --- may not actually be useful, since we have 
     ## python's uuid module
@@ -40,14 +134,14 @@ class Channel(object):
         """
         Pause media.
         """
-        return bgapi_wrapper('pause {uuid} on'.format(uuid=self.uuid))
+        return self.bgapi('pause {uuid} on'.format(uuid=self.uuid))
 
     @requires_attr('uuid')
     def resume(self):
         """
         Resume media.
         """
-        return bgapi_wrapper('pause {uuid} off'.format(uuid=self.uuid))
+        return self.bgapi('pause {uuid} off'.format(uuid=self.uuid))
 
     @requires_attr('uuid')
     def set_read_volume(self, level=0, mute=False):
@@ -61,13 +155,13 @@ class Channel(object):
         TODO: test if stopping the media bug here also stops any write bug.
         """
         if mute:
-            return bgapi_wrapper('uuid_audio {uuid} start read mute'.format(
+            return self.bgapi('uuid_audio {uuid} start read mute'.format(
                 uuid=self.uuid))
         elif level == 0:
-            return bgapi_wrapper('uuid_audio {uuid} stop'.format(
+            return self.bgapi('uuid_audio {uuid} stop'.format(
                 uuid=self.uuid))
         else:
-            return bgapi_wrapper('uuid_audio {uuid} start read level '
+            return self.bgapi('uuid_audio {uuid} start read level '
                 '{level}'.format(uuid=self.uuid, level=level))
 
     @requires_attr('uuid')
@@ -82,13 +176,13 @@ class Channel(object):
         TODO: test if stopping the media bug here also stops any read bug.
         """
         if mute:
-            return bgapi_wrapper('uuid_audio {uuid} start write mute'.format(
+            return self.bgapi('uuid_audio {uuid} start write mute'.format(
                 uuid=self.uuid))
         elif level == 0:
-            return bgapi_wrapper('uuid_audio {uuid} stop'.format(
+            return self.bgapi('uuid_audio {uuid} stop'.format(
                 uuid=self.uuid))
         else:
-            return bgapi_wrapper('uuid_audio {uuid} start write level '
+            return self.bgapi('uuid_audio {uuid} start write level '
                 '{level}'.format(uuid=self.uuid, level=level))
 
     @requires_attr('uuid')
@@ -99,7 +193,7 @@ class Channel(object):
         the CURRENTLY PLAYING media and the call will move on in the dialplan, 
         script, or whatever is controlling the call.
         """
-        return bgapi_wrapper('uuid_break {uuid}'.format(uuid=self.uuid))
+        return self.bgapi('uuid_break {uuid}'.format(uuid=self.uuid))
 
     @requires_attr('uuid')
     def break_all(self):
@@ -109,14 +203,14 @@ class Channel(object):
         discontinue ALL QUEUED media and the call will move on in the dialplan, 
         script, or whatever is controlling the call.
         """
-        return bgapi_wrapper('uuid_break {uuid} all'.format(uuid=self.uuid))
+        return self.bgapi('uuid_break {uuid} all'.format(uuid=self.uuid))
 
     @requires_attr('uuid')
     def bridge(self, to_uuid):
         """
         Bridges the channel to the to_uuid.
         """
-        return bgapi_wrapper('uuid_bridge {uuid} {other_uuid}'.format(
+        return self.bgapi('uuid_bridge {uuid} {other_uuid}'.format(
             uuid=self.uuid, other_uuid=to_uuid))
 
     @requires_attr('uuid')
@@ -125,7 +219,7 @@ class Channel(object):
         Execute an arbitrary dialplan application on this channel.
         """
         app_with_args = '::'.join(app_args.insert(0, app_name))
-        return bgapi_wrapper('uuid_broadcast {uuid} {app_with_args} aleg'.format(
+        return self.bgapi('uuid_broadcast {uuid} {app_with_args} aleg'.format(
             uuid=self.uuid,
             app_with_args=app_with_args,
         ))
@@ -135,7 +229,7 @@ class Channel(object):
         """
         Play a filename on this channel.
         """
-        return bgapi_wrapper('uuid_broadcast {uuid} {filename} aleg'.format(
+        return self.bgapi('uuid_broadcast {uuid} {filename} aleg'.format(
             uuid=self.uuid,
             filename=filename,
         ))
@@ -145,14 +239,14 @@ class Channel(object):
         """
         List the media bugs on this channel.
         """
-        return bgapi_wrapper('uuid_buglist {uuid}'.format(uuid=self.uuid))
+        return self.bgapi('uuid_buglist {uuid}'.format(uuid=self.uuid))
 
     @requires_attr('uuid')
     def chat(self, message):
         """
         If the endpoint has a receive_event handler, this sends a chat message.
         """
-        return bgapi_wrapper('uuid_chat {uuid} {message}'.format(
+        return self.bgapi('uuid_chat {uuid} {message}'.format(
             uuid=self.uuid,
             message=message,
         ))
@@ -165,7 +259,7 @@ class Channel(object):
         Plays limit seconds of the filepath to the channel, mixing transmitted
         audio if mux is True.
         """
-        return bgapi_wrapper('uuid_displace {uuid} {filepath} {limit} '
+        return self.bgapi('uuid_displace {uuid} {filepath} {limit} '
             '{mux}'.format(
                 uuid=self.uuid,
                 filepath=filepath,
@@ -178,37 +272,53 @@ class Channel(object):
         """
         Updates the display if the endpoint supports this feature.
         """
-        return bgapi_wrapper('uuid_display {uuid} {text}'.format(
+        return self.bgapi('uuid_display {uuid} {text}'.format(
             uuid=self.uuid, text=text))
 
-    # TODO: uuid_dump -- may be redundant, depending on how we implement
-    ## channel variable support
+    @requires_attr('uuid')
+    def dump(self):
+        """
+        Fetches all of the channel's headers and variables, returning a
+        deferred which is called back with them as a dictionary. The
+        variables are kept as the current ones, for getvar.
+        """
+        def dumped(result):
+            if result.startswith('-ERR'):
+                raise ValueError(result.strip())
+            headers = json.loads(result)
+            self._cacheVariables(headers)
+            return headers
+        return self.bgapi('uuid_dump {uuid} json'.format(
+            uuid=self.uuid)).addCallback(dumped)
 
     @requires_attr('uuid')
     def exists(self):
         """
         Check whether this channel exists.
         """
-        return bgapi_wrapper('uuid_exists {uuid}'.format(uuid=self.uuid))
+        return self.bgapi('uuid_exists {uuid}'.format(uuid=self.uuid))
 
     @requires_attr('uuid')
     def flush_dtmf(self):
         """
         Flush queued DTML digits.
         """
-        return bgapi_wrapper('uuid_flush_dtml {uuid}'.format(uuid=self.uuid))
+        return self.bgapi('uuid_flush_dtml {uuid}'.format(uuid=self.uuid))
 
     # TODO: uuid_fileman
 
     @requires_attr('uuid')
     def getvar(self, varname):
         """
-        Get a variable.
-
-        TODO: Possibly redundant, depending on how we implement channel 
-        variable support
+        Get a variable. A variable still waiting to be set, or known from
+        the channel's events while they are fresh, is answered without
+        asking FreeSWITCH.
         """
-        return bgapi_wrapper('uuid_getvar {uuid} {varname}'.format(
+        if self.pending_variables and varname in self.pending_variables:
+            return defer.succeed(self.pending_variables[varname])
+        if varname in self.variables and self.fresh:
+            return defer.succeed(self.variables[varname])
+        return self.bgapi('uuid_getvar {uuid} {varname}'.format(
             uuid=self.uuid, varname=varname))
 
     @requires_attr('uuid')
@@ -216,21 +326,21 @@ class Channel(object):
         """
         Place channel on hold.
         """
-        return bgapi_wrapper('uuid_hold {uuid}'.format(uuid=self.uuid))
+        return self.bgapi('uuid_hold {uuid}'.format(uuid=self.uuid))
 
     @requires_attr('uuid')
     def unhold(self):
         """
         Take channel off hold.
         """
-        return bgapi_wrapper('uuid_hold {uuid} off'.format(uuid=self.uuid))
+        return self.bgapi('uuid_hold {uuid} off'.format(uuid=self.uuid))
 
     @requires_attr('uuid')
     def kill(self, cause=''):
         """
         Reset this channel.
         """
-        return bgapi_wrapper('uuid_kill {uuid} {cause}'.format(
+        return self.bgapi('uuid_kill {uuid} {cause}'.format(
             uuid=self.uuid, cause=cause))
 
     # TODO: uuid_limit
@@ -242,7 +352,7 @@ class Channel(object):
         """
         Park this channel.
         """
-        return bgapi_wrapper('uuid_park {uuid}'.format(uuid=self.uuid))
+        return self.bgapi('uuid_park {uuid}'.format(uuid=self.uuid))
 
     # TODO: uuid_preprocess
 
@@ -255,20 +365,114 @@ class Channel(object):
     @requires_attr('uuid')
     def setvar(self, varname, value):
         """
-        Set a variable on the channel.
+        Set a variable on the channel. The variable is held for setvar_delay
+        seconds, and sent along with any others set in the meantime; see
+        flush.
         """
-        return bgapi_wrapper('uuid_setvar {uuid} {varname} {value}'.format(
-            uuid=self.uuid, varname=varname, value=value))
+        return self._queueVariables([(varname, value)])
 
     @requires_attr('uuid')
     def setvars(self, **data):
         """
-        Set multiple variables on the channel.
+        Set multiple variables on the channel. Like setvar, these are sent
+        along with any others set within setvar_delay seconds.
         """
-        return bgapi_wrapper('uuid_setvar_multi {uuid} {varstring}'.format(
-            uuid=self.uuid,
-            varstring=';'.join(['='.join([k, v]) for k, v in data.items()])
-        ))
+        return self._queueVariables(data.items())
+
+    def _queueVariables(self, items):
+        if self.pending_variables is None:
+            self.pending_variables = OrderedDict()
+            self._pending_deferreds = []
+        for varname, value in items:
+            # a variable set again is sent once, with its latest value
+            self.pending_variables.pop(varname, None)
+            self.pending_variables[varname] = str(value)
+        d = defer.Deferred()
+        self._pending_deferreds.append(d)
+        if self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.setvar_delay,
+                self._flushLater)
+        return d
+
+    def _flushLater(self):
+        self._flush_call = None
+        self._flushHeld()
+
+    def _flushHeld(self):
+        """
+        Sends the variables still held, if any, ahead of other commands.
+        """
+        if self.pending_variables:
+            # failures are logged by bgapi, and passed on to the setvar
+            ## callers
+            self.flush().addErrback(lambda reason: None)
+
+    @requires_attr('uuid')
+    def flush(self):
+        """
+        Sends the variables set with setvar and setvars that are still held,
+        as one uuid_setvar_multi. (Values containing a semicolon, which
+        separates the variables of uuid_setvar_multi, are sent on their own
+        with uuid_setvar.) This is done before any other command of the
+        channel is sent, so the variables are set ahead of the commands
+        given after them.
+
+        Returns a deferred which is called back once the variables are set,
+        with the result of the last command sent, or of the first that
+        failed; the deferreds returned by setvar and setvars fire with the
+        same result. The variables FreeSWITCH confirms are then known to
+        getvar; until then, and if setting them fails, getvar asks for them.
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        variables, waiting = self.pending_variables, self._pending_deferreds
+        self.pending_variables = self._pending_deferreds = None
+        if not variables:
+            return defer.succeed(None)
+        # the known values are out of date until FreeSWITCH confirms these
+        for varname in variables:
+            self.variables.pop(varname, None)
+        multi = [(k, v) for k, v in variables.iteritems() if ';' not in v]
+        single = [(k, v) for k, v in variables.iteritems() if ';' in v]
+        if len(multi) == 1:
+            single, multi = multi + single, []
+        # the variables set by each command, in the order of the commands
+        batches = [[item] for item in single]
+        commands = [self.bgapi('uuid_setvar {uuid} {varname} {value}'.format(
+            uuid=self.uuid, varname=k, value=v)) for k, v in single]
+        if multi:
+            batches.append(multi)
+            commands.append(self.bgapi(
+                'uuid_setvar_multi {uuid} {varstring}'.format(
+                    uuid=self.uuid,
+                    varstring=';'.join(['='.join([k, v]) for k, v in multi])
+                )))
+        d = defer.DeferredList(commands, consumeErrors=True)
+        d.addCallback(self._flushed, waiting, batches)
+        return d
+
+    def _flushed(self, results, waiting, batches):
+        outcome = None
+        failed = False
+        for (success, result), items in zip(results, batches):
+            if not success or (isinstance(result, basestring) and
+                    result.startswith('-ERR')):
+                if not failed:
+                    outcome = result
+                    failed = True
+                continue
+            for varname, value in items:
+                self.variables[utils.header_name(varname)] = value
+            if not failed:
+                outcome = result
+        for d in waiting:
+            if isinstance(outcome, failure.Failure):
+                d.errback(outcome)
+            else:
+                d.callback(outcome)
+        return outcome
 
     @requires_attr('uuid')
     def simplify(self):
@@ -276,7 +480,7 @@ class Channel(object):
         Directs FreeSWITCH to remove itself from the SIP signalling path 
         if possible.
         """
-        return bgapi_wrapper('uuid_simplify {uuid}'.format(uuid=self.uuid))
+        return self.bgapi('uuid_simplify {uuid}'.format(uuid=self.uuid))
 
     @requires_attr('uuid')
     def transfer(self, destination, dialplan='directory', context='default'):
@@ -284,7 +488,7 @@ class Channel(object):
         Transfers this channel to a specific extension within the dialplan 
         and context. Dialplan may be 'xml' or 'directory'.
         """
-        return bgapi_wrapper(
+        return self.bgapi(
             'uuid_transfer {uuid} {destination} {dialplan} {context}'.format(
             uuid=self.uuid, 
             destination=destination, 
@@ -300,7 +504,7 @@ class Channel(object):
         available. If media setup has not happened yet for this channel, the 
         file will contain silent audio until media is available.
         """
-        return bgapi_wrapper('uuid_record {uuid} start {path} {limit}'.format(
+        return self.bgapi('uuid_record {uuid} start {path} {limit}'.format(
             uuid=self.uuid,
             path=path,
             limit=limit if limit else '',
@@ -312,7 +516,7 @@ class Channel(object):
         Stop recording the audio associated with this channel into the path 
         given.
         """
-        return bgapi_wrapper('uuid_record {uuid} stop {path}'.format(
+        return self.bgapi('uuid_record {uuid} stop {path}'.format(
             uuid=self.uuid,
             path=path,
         ))
@@ -322,10 +526,8 @@ class Channel(object):
         """
         Stop recording the audio associated with this channel into all files.
         """
-        return bgapi_wrapper('uuid_record {uuid} stop {path}'.format(
-            uuid=self.uuid,
-            path=path,
-        ))
+        return self.bgapi('uuid_record {uuid} stop all'.format(
+            uuid=self.uuid))
 
     @requires_attr('uuid')
     def hangup(self, cause='', delay_secs=0):
@@ -335,7 +537,7 @@ class Channel(object):
         TODO: is this even useful? rather than using sched_hangup, just have 
         apps use reactor.callLater, and make this method call self.kill?
         """
-        return bgapi_wrapper('sched_hangup +{delay} {uuid} {cause}'.format(
+        return self.bgapi('sched_hangup +{delay} {uuid} {cause}'.format(
             uuid=self.uuid, delay=delay_secs, cause=cause))
 
     # TODO: tone_detect
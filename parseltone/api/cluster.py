@@ -0,0 +1,256 @@
+"""
+A client for a fleet of FreeSWITCH servers, presenting them through a single
+Subsystem.
+
+Subscribers receive the events of every node; each event carries the
+FreeSWITCH-Hostname header of the node it came from, and the name of the
+node (its address, unless named otherwise) as event.protocol.node. Commands
+naming a channel go to the node that channel is on, as learned from its
+CHANNEL_CREATE event, and new calls are placed on nodes by consistent
+hashing of the destination, so adding or removing a node only moves the
+destinations that hashed to it.
+"""
+from bisect import bisect
+import hashlib
+import logging
+import re
+from twisted.internet import defer
+from parseltone import utils
+from parseltone.api.base import Subsystem
+from parseltone.eventsocket.inbound import EventSocketClientFactory
+from parseltone.eventsocket.pool import EventSocketPool, Subscriptions
+from parseltone.eventsocket.protocol import EventError, EventSocket
+
+# create a log target for this module
+logger = logging.getLogger(__name__)
+
+UUID_RE = re.compile(
+    r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', re.I)
+ORIGINATION_UUID_RE = re.compile(r'origination_uuid=(%s)' % UUID_RE.pattern,
+    re.I)
+
+
+class ClusterNode(object):
+    """
+    One FreeSWITCH server of the cluster, and the notify target for its
+    connections.
+    """
+    def __init__(self, cluster, name, pool):
+        self.cluster = cluster
+        self.name = name
+        self.pool = pool
+        self.hostname = None
+
+    def inboundStarted(self):
+        logger.info('FreeSWITCH: attempting connection to node %s.',
+            self.name)
+
+    def inboundConnected(self, protocol_instance):
+        protocol_instance.node = self.name
+        logger.info('FreeSWITCH: connected to node %s.', self.name)
+
+    def inboundFailed(self, reason):
+        pass
+
+    def inboundLost(self, reason):
+        pass
+
+    def inboundDisconnected(self, reason):
+        logger.info('FreeSWITCH: disconnected from node %s: %s',
+            self.name, reason.getErrorMessage())
+
+    @property
+    def authorized(self):
+        return self.pool.authorized
+
+    def outstanding(self):
+        return sum([count for count in self.pool.outstanding() if count])
+
+
+class Cluster(object):
+    """
+    Stands in for the eventsocket of a Subsystem, over any number of nodes.
+    Every node is a pool of pool_size connections (see EventSocketPool).
+    """
+    # points on the hash ring per node; more spread the load more evenly
+    replicas = 128
+
+    def __init__(self, password='ClueCon', pool_size=1, protocol=EventSocket,
+            factory=EventSocketClientFactory):
+        self.password = password
+        self.pool_size = pool_size
+        self.protocol = protocol
+        self.factory = factory
+        self.nodes = {}
+        # channel uuid to the name of the node the channel is on
+        self.channel_nodes = {}
+        # (hash, node name) points, sorted by hash
+        self.ring = []
+        # the subscribers, for new nodes
+        self.subscriptions = Subscriptions()
+        self.subscribe(self, weak=False)
+
+    def addNode(self, address, name=None, password=None):
+        """
+        Connects to another FreeSWITCH server, which is named by its address
+        unless a name is given.
+        """
+        name = name or address
+        if name in self.nodes:
+            raise ValueError('Node %s is already part of the cluster.' % name)
+        pool = EventSocketPool(self.pool_size,
+            password=password or self.password, protocol=self.protocol,
+            factory=self.factory)
+        node = self.nodes[name] = ClusterNode(self, name, pool)
+        pool.notifyTarget = node
+        for obj, filters, weak, queue in self.subscriptions:
+            pool.subscribe(obj, filters=filters, weak=weak, queue=queue)
+        self._buildRing()
+        host, port = utils.parse_host_port(address, 8021)
+        pool.connect(host, port)
+        return node
+
+    def removeNode(self, name):
+        """
+        Stops using the named node. Its channels are forgotten, and the
+        destinations placed on it move to the other nodes.
+        """
+        node = self.nodes.pop(name)
+        for member_factory in node.pool.factories:
+            member_factory.stopTrying()
+        for p in node.pool.protocols:
+            if p:
+                p.transport.loseConnection()
+        for uuid, channel_node in self.channel_nodes.items():
+            if channel_node == name:
+                del self.channel_nodes[uuid]
+        self._buildRing()
+
+    def _buildRing(self):
+        self.ring = sorted([(self._hash('%s-%d' % (name, replica)), name)
+            for name in self.nodes for replica in xrange(self.replicas)])
+
+    def _hash(self, key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def placement(self, key):
+        """
+        Returns the name of the node that key hashes to, skipping nodes that
+        are not connected, or None if no node is.
+        """
+        if not self.ring:
+            return None
+        start = bisect(self.ring, (self._hash(key), None))
+        for offset in xrange(len(self.ring)):
+            name = self.ring[(start + offset) % len(self.ring)][1]
+            if self.nodes[name].authorized:
+                return name
+        return None
+
+    def subscribe(self, obj, filters=None, weak=True, queue=None):
+        """
+        Subscribe obj to the events of every node; see EventSocket.subscribe.
+        """
+        if not self.subscriptions.add(obj, filters=filters, weak=weak,
+                queue=queue):
+            return
+        for node in self.nodes.values():
+            node.pool.subscribe(obj, filters=filters, weak=weak, queue=queue)
+
+    def unsubscribe(self, obj):
+        self.subscriptions.remove(obj)
+        for node in self.nodes.values():
+            node.pool.unsubscribe(obj)
+
+    def subscriberCounts(self):
+        counts = {}
+        for node in self.nodes.values():
+            for eventkey, count in node.pool.subscriberCounts().iteritems():
+                counts[eventkey] = max(counts.get(eventkey, 0), count)
+        return counts
+
+    def route(self, command, args=()):
+        """
+        Returns the name of the node a command should be sent to: the node
+        of the channel it names, for originate the node the destination
+        hashes to, and otherwise the least busy node.
+        """
+        line = ' '.join((command,) + tuple(args))
+        if line.startswith('originate '):
+            destination = line.split()[1]
+            # channel variables are not part of the destination
+            key = re.sub(r'^(\{[^}]*\}|\[[^]]*\]|<[^>]*>)+', '', destination)
+            name = self.placement(key)
+            if name:
+                match = ORIGINATION_UUID_RE.search(destination)
+                if match:
+                    self.channel_nodes[match.group(1).lower()] = name
+                return name
+        for uuid in UUID_RE.findall(line):
+            name = self.channel_nodes.get(uuid.lower())
+            if name and self.nodes[name].authorized:
+                return name
+        best, best_load = None, None
+        for name, node in self.nodes.iteritems():
+            if not node.authorized:
+                continue
+            load = node.outstanding()
+            if best is None or load < best_load:
+                best, best_load = name, load
+        return best
+
+    def _send(self, method, command, args, kwargs):
+        name = self.route(command, args)
+        if name is None:
+            return defer.fail(EventError('No FreeSWITCH node is available '
+                'for %s %s.' % (method, command)))
+        d = getattr(self.nodes[name].pool, method)(command, *args, **kwargs)
+        if command.startswith('originate'):
+            # the uuid of a new call is in the result, if it was answered
+            def originated(result):
+                if isinstance(result, basestring) and \
+                        result.startswith('+OK '):
+                    self.channel_nodes[result[4:].strip().lower()] = name
+                return result
+            d.addCallback(originated)
+        return d
+
+    def api(self, command, *args, **kwargs):
+        return self._send('api', command, args, kwargs)
+
+    def bgapi(self, command, *args, **kwargs):
+        return self._send('bgapi', command, args, kwargs)
+
+    def onChannelCreate(self, event, content):
+        uuid = event.dict.get('Unique-ID')
+        node = getattr(event.protocol, 'node', None)
+        if uuid and node in self.nodes:
+            self.channel_nodes[uuid.lower()] = node
+            if not self.nodes[node].hostname:
+                self.nodes[node].hostname = event.dict.get(
+                    'FreeSWITCH-Hostname')
+
+    def onChannelDestroy(self, event, content):
+        uuid = event.dict.get('Unique-ID')
+        if uuid:
+            self.channel_nodes.pop(uuid.lower(), None)
+
+
+class ClusterEventSocket(object):
+    """
+    Like InboundEventSocket, but connects to every address given, with
+    self.freeswitch being a Subsystem over all of them.
+    """
+    def clusterConnect(self, addresses, password='ClueCon', pool_size=1,
+            protocol=EventSocket, factory=EventSocketClientFactory,
+            subscribers=None):
+        self.cluster = Cluster(password=password, pool_size=pool_size,
+            protocol=protocol, factory=factory)
+        self.freeswitch = Subsystem(self.cluster)
+        subscribers = list(subscribers or ())
+        if self not in subscribers:
+            subscribers.append(self)
+        for s in subscribers:
+            self.freeswitch.subscribe(s)
+        for address in addresses:
+            self.cluster.addNode(address)
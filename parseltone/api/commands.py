@@ -1,16 +1,45 @@
 import logging
 from twisted.internet import defer
-from parseltone.api.channel import Channel
 
 # create a log target for this module
 logger = logging.getLogger(__name__)
 
 
+def send_command(method, command, timeout=None):
+    """
+    Sends the command with method (the api or bgapi of an eventsocket),
+    returning a deferred which is called back with the result. Failures are
+    logged, and passed on to the deferred. Cancelling the deferred gives up
+    on the command; a timeout (in seconds) overrides the eventsocket's
+    default.
+    """
+    kwargs = {}
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+    sent = method(command, **kwargs)
+    d = defer.Deferred(lambda d: sent.cancel())
+    def success(data):
+        d.callback(data)
+    def error(failure):
+        if not d.called:
+            logger.error(failure.getErrorMessage())
+            d.errback(failure)
+    sent.addCallback(success).addErrback(error)
+    return d
+
+
 class Commands(object):
     def __init__(self, eventsocket):
         self.eventsocket = eventsocket
         self.eventsocket.subscribe(self)
 
+    def bgapi(self, command, timeout=None):
+        """
+        Runs the command as a background job; see send_command. A timeout
+        (in seconds) overrides the eventsocket's default job_timeout.
+        """
+        return send_command(self.eventsocket.bgapi, command, timeout=timeout)
+
     def system(self, command):
         """
         Execute a command in the system shell on the FreeSWITCH machine.
@@ -26,14 +55,7 @@ class Commands(object):
             log_caller_name ; rm -rf /
         """
         command = 'system {command}'.format(command=command)
-        d = defer.Deferred()
-        def success(data):
-            d.callback(data)
-        def error(failure):
-            logger.error(failure.getErrorMessage())
-        self.eventsocket.bgapi(
-            command).addCallback(success).addErrback(error)
-        return d
+        return self.bgapi(command)
 
     def get_user_attr(self, user, domain, attr):
         """
@@ -41,14 +63,7 @@ class Commands(object):
         """
         command = 'user_data {user}@{domain} attr {attr}'.format(
             user=user, domain=domain, attr=attr)
-        d = defer.Deferred()
-        def success(data):
-            d.callback(data)
-        def error(failure):
-            logger.error(failure.getErrorMessage())
-        self.eventsocket.bgapi(
-            command).addCallback(success).addErrback(error)
-        return d
+        return self.bgapi(command)
         
 
     def get_user_var(self, user, domain, var):
@@ -57,14 +72,7 @@ class Commands(object):
         """
         command = 'user_data {user}@{domain} var {attr}'.format(
             user=user, domain=domain, var=var)
-        d = defer.Deferred()
-        def success(data):
-            d.callback(data)
-        def error(failure):
-            logger.error(failure.getErrorMessage())
-        self.eventsocket.bgapi(
-            command).addCallback(success).addErrback(error)
-        return d
+        return self.bgapi(command)
 
     def get_user_param(self, user, domain, param):
         """
@@ -72,14 +80,7 @@ class Commands(object):
         """
         command = 'user_data {user}@{domain} param {attr}'.format(
             user=user, domain=domain, param=param)
-        d = defer.Deferred()
-        def success(data):
-            d.callback(data)
-        def error(failure):
-            logger.error(failure.getErrorMessage())
-        self.eventsocket.bgapi(
-            command).addCallback(success).addErrback(error)
-        return d
+        return self.bgapi(command)
 
     def does_user_exist(self, user, domain, key='id'):
         """
@@ -87,15 +88,8 @@ class Commands(object):
         """
         command = 'user_exists {key} {user} {domain}'.format(
             key=key, user=user, domain=domain)
-        d = defer.Deferred()
-        def success(data):
-            result = data.lower() == 'true'
-            d.callback(result)
-        def error(failure):
-            logger.error(failure.getErrorMessage())
-        self.eventsocket.bgapi(
-            command).addCallback(success).addErrback(error)
-        return d
+        return self.bgapi(command).addCallback(
+            lambda data: data.lower() == 'true')
 
     def originate_to_ext(self, destination, extension, 
             dialplan='', context='', timeout_sec=0,
@@ -131,14 +125,7 @@ class Commands(object):
                 cid_num=caller_id_number,
                 timeout_sec=timeout_sec if timeout_sec else '',
             )
-        d = defer.Deferred()
-        def success(data):
-            d.callback(data)
-        def error(failure):
-            logger.error(failure.getErrorMessage())
-        self.eventsocket.bgapi(
-            command).addCallback(success).addErrback(error)
-        return d
+        return self.bgapi(command)
 
     def originate_to_app(self, destination, app_name, 
             dialplan='', context='', timeout_sec=0, 
@@ -175,12 +162,5 @@ class Commands(object):
                 cid_num=caller_id_number,
                 timeout_sec=timeout_sec if timeout_sec else '',
             )
-        d = defer.Deferred()
-        def success(data):
-            d.callback(data)
-        def error(failure):
-            logger.error(failure.getErrorMessage())
-        self.eventsocket.bgapi(
-            command).addCallback(success).addErrback(error)
-        return d
+        return self.bgapi(command)
 
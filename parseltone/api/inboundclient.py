@@ -4,22 +4,41 @@ from parseltone import utils
 from parseltone.api.base import Subsystem
 from parseltone.eventsocket.protocol import EventSocket
 from parseltone.eventsocket.inbound import EventSocketClientFactory
+from parseltone.eventsocket.pool import EventSocketPool
 
 # create a log target for this module
 logger = logging.getLogger(__name__)
 
 
 class InboundEventSocket(object):
+    inbound_pool = None
+
     def inboundConnect(self, address, password='ClueCon',
             protocol=EventSocket, factory=EventSocketClientFactory,
-            subscribers=[]):
-        self.inbound_factory = factory(password=password, notifyTarget=self)
-        self.inbound_factory.protocol = protocol
+            subscribers=[], pool_size=1):
+        """
+        Connects to FreeSWITCH at address. With a pool_size above one, that
+        many connections are opened: one for events, and the rest for api
+        and bgapi commands, so slow commands run in parallel (see
+        parseltone.eventsocket.pool).
+        """
         if self not in subscribers:
             subscribers.append(self)
         self.auto_subscribers = subscribers
         self.address = address
         host, port = utils.parse_host_port(address, 8021)
+        if pool_size > 1:
+            self.inbound_pool = EventSocketPool(pool_size, password=password,
+                protocol=protocol, factory=factory, notifyTarget=self)
+            self.inbound_factory = self.inbound_pool.factories[0]
+            # the pool outlives its connections, and so does the subsystem
+            self.freeswitch = Subsystem(self.inbound_pool)
+            for s in self.auto_subscribers:
+                self.freeswitch.subscribe(s)
+            self.inbound_pool.connect(host, port)
+            return
+        self.inbound_factory = factory(password=password, notifyTarget=self)
+        self.inbound_factory.protocol = protocol
         reactor.connectTCP(host, port, self.inbound_factory)
 
     def inboundStarted(self):
@@ -27,11 +46,12 @@ class InboundEventSocket(object):
             self.inbound_factory.ip, self.inbound_factory.port)
 
     def inboundConnected(self, protocol_instance):
-        self.freeswitch = Subsystem(protocol_instance)
+        if not self.inbound_pool:
+            self.freeswitch = Subsystem(protocol_instance)
+            for s in self.auto_subscribers:
+                self.freeswitch.subscribe(s)
         logger.info('FreeSWITCH: connected to %s:%d',
             self.inbound_factory.ip, self.inbound_factory.port)
-        for s in self.auto_subscribers:
-            self.freeswitch.subscribe(s)
 
     def inboundDisconnected(self, reason):
         logger.info('FreeSWITCH: disconnected from %s:%d: %s',
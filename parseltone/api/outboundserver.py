@@ -1,12 +1,127 @@
 import logging
-from twisted.internet import reactor
-from parseltone.eventsocket.protocol import EventSocket
+import socket
+import uuid
+from twisted.internet import defer, reactor
+from parseltone import utils
+from parseltone.api.channel import Channel
+from parseltone.api.commands import send_command
+from parseltone.eventsocket.outbound import EventSocketServerFactory, \
+    OutboundEventSocketProtocol
 
 # create a log target for this module
 logger = logging.getLogger(__name__)
 
 
-# TODO
-class OutboundEventSocket:
-    pass
+class OutboundSession(Channel):
+    """
+    A channel controlled over the connection FreeSWITCH made for it. The
+    channel data sent by FreeSWITCH upon connecting is available as the
+    channel_data dictionary.
+    """
+    def __init__(self, eventsocket):
+        Channel.__init__(self, eventsocket, uuid=eventsocket.uuid)
+        self.channel_data = eventsocket.channel_data
+        self._cacheVariables(self.channel_data)
+        self.pending_executes = {}
+        # the subscription is needed for application completion events
+        self.eventsocket.subscribe(self)
 
+    def bgapi(self, command, timeout=None):
+        """
+        Runs the command; see commands.send_command. A timeout (in seconds)
+        overrides the eventsocket's default command_timeout.
+
+        NOTE: FreeSWITCH only sends this connection the events of its own
+        call, which does not include BACKGROUND_JOB, so api is used instead;
+        a slow command only holds up this call's connection.
+        """
+        self._flushHeld()
+        return send_command(self.eventsocket.api, command, timeout=timeout)
+
+    def execute(self, app_name, app_arg=None):
+        """
+        Execute a dialplan application on this call. The returned deferred is
+        called back with the CHANNEL_EXECUTE_COMPLETE event once the
+        application has finished.
+        """
+        # variables still held go first, as the application may use them
+        self._flushHeld()
+        event_uuid = str(uuid.uuid4())
+        d = self.pending_executes[event_uuid] = defer.Deferred()
+        def failed(error):
+            self.pending_executes.pop(event_uuid, None)
+            d.errback(error)
+        self.eventsocket.execute(app_name, app_arg,
+            event_uuid=event_uuid).addErrback(failed)
+        return d
+
+    def ended(self, reason):
+        """
+        Called when the connection for this call is gone, failing any
+        applications still waiting to complete.
+        """
+        while self.pending_executes:
+            self.pending_executes.popitem()[1].errback(reason)
+
+    def onChannelExecuteComplete(self, event, content):
+        self.update(event)
+        d = self.pending_executes.pop(event.dict.get('Application-UUID'), None)
+        if d:
+            d.callback(event)
+
+
+class OutboundEventSocket(object):
+    """
+    Listens for the connections FreeSWITCH makes for calls running the socket
+    dialplan application, creating a session object (an OutboundSession,
+    unless session_class says otherwise) for each call. Override
+    outboundSession and outboundSessionEnded to control the calls.
+    """
+    session_class = OutboundSession
+
+    def outboundListen(self, address, protocol=OutboundEventSocketProtocol,
+            factory=EventSocketServerFactory, backlog=50):
+        self._outboundFactory(protocol, factory)
+        host, port = utils.parse_host_port(address, 8084)
+        self.outbound_port = reactor.listenTCP(port, self.outbound_factory,
+            backlog=backlog, interface=host)
+        logger.info('FreeSWITCH: listening for outbound sessions on %s:%d',
+            host, port)
+        return self.outbound_port
+
+    def outboundAdopt(self, fileno, protocol=OutboundEventSocketProtocol,
+            factory=EventSocketServerFactory):
+        """
+        Like outboundListen, but accepts connections on a socket that is
+        already listening, given by its file descriptor, such as one shared
+        by several worker processes (see parseltone.api.workers).
+        """
+        self._outboundFactory(protocol, factory)
+        self.outbound_port = reactor.adoptStreamPort(fileno, socket.AF_INET,
+            self.outbound_factory)
+        address = self.outbound_port.getHost()
+        logger.info('FreeSWITCH: accepting outbound sessions on %s:%d',
+            address.host, address.port)
+        return self.outbound_port
+
+    def _outboundFactory(self, protocol, factory):
+        self.outbound_factory = factory(notifyTarget=self)
+        self.outbound_factory.protocol = protocol
+        self.sessions = {}
+
+    def outboundConnected(self, protocol_instance):
+        session = self.session_class(protocol_instance)
+        self.sessions[session.uuid] = session
+        self.outboundSession(session)
+
+    def outboundDisconnected(self, protocol_instance, reason):
+        session = self.sessions.pop(protocol_instance.uuid, None)
+        if session:
+            session.ended(reason)
+            self.outboundSessionEnded(session, reason)
+
+    def outboundSession(self, session):
+        pass
+
+    def outboundSessionEnded(self, session, reason):
+        pass
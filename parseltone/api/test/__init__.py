@@ -0,0 +1,5 @@
+"""
+Tests for parseltone.api, run with trial:
+
+    trial parseltone.api.test
+"""
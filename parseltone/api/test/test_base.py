@@ -0,0 +1,113 @@
+"""
+Tests for Subsystem and its Channels, over an EventSocket whose replies and
+events are fed to it by hand.
+"""
+from parseltone.api.base import Channels, Subsystem
+from parseltone.api.channel import Channel
+from parseltone.eventsocket.test.test_protocol import (EventSocketTestCase,
+    plain_event)
+
+
+class SubsystemTestCase(EventSocketTestCase):
+    """
+    A Subsystem on the EventSocket, with the delayed calls of its channels
+    on the same task.Clock.
+    """
+    def setUp(self):
+        EventSocketTestCase.setUp(self)
+        self.patch(Channel, 'clock', self.clock)
+        self.patch(Channels, 'clock', self.clock)
+        self.subsystem = Subsystem(self.protocol)
+        self.sent()
+
+    def event(self, name, uuid, *headers):
+        self.protocol.dataReceived(plain_event([('Event-Name', name),
+            ('Unique-ID', uuid)] + list(headers)))
+
+
+class ChannelClassTests(SubsystemTestCase):
+    def test_settings(self):
+        """
+        The channels of a subsystem are of its channel_class, whose
+        settings they use.
+        """
+        class DelayedChannel(Channel):
+            setvar_delay = 0.5
+        self.subsystem.channel_class = DelayedChannel
+        channel = self.subsystem.channel('u-1')
+        self.assertIsInstance(channel, DelayedChannel)
+        self.sent()
+        channel.setvar('a', '1')
+        self.clock.advance(0.4)
+        self.assertEqual(self.sent(), [])
+        self.clock.advance(0.1)
+        self.assertEqual([command.split('\n')[0] for command in self.sent()],
+            ['bgapi uuid_setvar u-1 a 1'])
+        self.assertIs(type(Subsystem(self.protocol).channel('u-2')), Channel)
+
+
+class ChannelIndexTests(SubsystemTestCase):
+    def assertIndexed(self, uuid, active, inactive):
+        channels = self.subsystem.channels
+        self.assertEqual((uuid in channels.active(),
+            uuid in channels.inactive()), (active, inactive))
+
+    def test_lifecycle(self):
+        """
+        A channel is active from its CHANNEL_CREATE on, and inactive once
+        destroyed, though still known.
+        """
+        self.event('CHANNEL_CREATE', 'a')
+        self.assertIndexed('a', True, False)
+        self.event('CHANNEL_HANGUP', 'a', ('Hangup-Cause', 'NORMAL_CLEARING'))
+        self.assertIndexed('a', True, False)
+        self.event('CHANNEL_DESTROY', 'a')
+        self.assertIndexed('a', False, True)
+        channel = self.subsystem.channels['a']
+        self.assertTrue(channel.destroyed)
+        self.assertEqual(channel.hangup_cause, 'NORMAL_CLEARING')
+        # a late event does not bring the channel back
+        self.event('CHANNEL_HANGUP', 'a')
+        self.assertIndexed('a', False, True)
+
+    def test_peer(self):
+        """
+        The peer of a bridge is only active once an event of its own
+        arrives.
+        """
+        self.event('CHANNEL_CREATE', 'a')
+        self.event('CHANNEL_BRIDGE', 'a', ('Other-Leg-Unique-ID', 'b'))
+        self.assertEqual(self.subsystem.channels['b'].bridge_peer, 'a')
+        self.assertIndexed('b', False, False)
+        self.event('CHANNEL_ANSWER', 'b')
+        self.assertIndexed('b', True, False)
+
+    def test_expiry(self):
+        """
+        Destroyed channels are forgotten after inactive_ttl seconds.
+        """
+        self.event('CHANNEL_CREATE', 'a')
+        self.event('CHANNEL_DESTROY', 'a')
+        self.clock.advance(Channels.inactive_ttl - 1)
+        self.event('CHANNEL_CREATE', 'b')
+        self.event('CHANNEL_DESTROY', 'b')
+        self.assertIndexed('a', False, True)
+        self.clock.advance(1)
+        self.assertIndexed('a', False, False)
+        self.assertNotIn('a', self.subsystem.channels)
+        self.assertIndexed('b', False, True)
+
+    def test_limit(self):
+        """
+        Beyond inactive_limit destroyed channels, the oldest ones are
+        forgotten.
+        """
+        self.patch(Channels, 'inactive_limit', 2)
+        for uuid in 'abc':
+            self.event('CHANNEL_CREATE', uuid)
+        for uuid in 'abc':
+            self.event('CHANNEL_DESTROY', uuid)
+        self.assertEqual(sorted(self.subsystem.channels), ['b', 'c'])
+        self.assertEqual(list(self.subsystem.channels.inactive()),
+            ['b', 'c'])
+        self.assertEqual(self.subsystem.channels.active(), {})
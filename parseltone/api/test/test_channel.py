@@ -0,0 +1,200 @@
+"""
+Tests for Channel, over an EventSocket whose replies and events are fed to
+it by hand.
+"""
+import re
+from twisted.internet import defer
+from parseltone.api.base import Subsystem
+from parseltone.api.channel import Channel
+from parseltone.eventsocket.test.test_protocol import (EventSocketTestCase,
+    background_job, command_reply, plain_event)
+
+
+class ChannelTestCase(EventSocketTestCase):
+    """
+    A Channel on the EventSocket, with its delayed calls on the same
+    task.Clock.
+    """
+    def setUp(self):
+        EventSocketTestCase.setUp(self)
+        self.patch(Channel, 'clock', self.clock)
+        self.channel = Channel(self.protocol, 'u-1')
+        self.sent()
+
+    def commands(self):
+        """
+        Returns the command lines sent since the last call, without the
+        Job-UUID of bgapi commands.
+        """
+        return [command.split('\n')[0] for command in self.sent()]
+
+
+class CommandTests(ChannelTestCase):
+    def test_cancel(self):
+        """
+        Cancelling the deferred of a command abandons its job.
+        """
+        d = self.channel.bgapi('status')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.protocol.pending_jobs, {})
+
+    def test_failure(self):
+        """
+        A command FreeSWITCH refuses fails the deferred.
+        """
+        d = self.channel.bgapi('bogus', timeout=5)
+        self.protocol.dataReceived(command_reply('-ERR bogus'))
+        self.failureResultOf(d)
+        self.assertEqual(self.protocol.pending_jobs, {})
+
+
+class SetvarTests(ChannelTestCase):
+    def test_coalesced(self):
+        """
+        Variables set together are sent as one uuid_setvar_multi, once the
+        reactor iteration is done.
+        """
+        self.channel.setvar('a', '1')
+        self.channel.setvar('b', '2')
+        self.channel.setvars(c='3')
+        self.channel.setvar('a', '4')
+        self.assertEqual(self.commands(), [])
+        self.clock.advance(0)
+        self.assertEqual(self.commands(),
+            ['bgapi uuid_setvar_multi u-1 b=2;c=3;a=4'])
+
+    def test_delay(self):
+        """
+        Variables are held for setvar_delay seconds.
+        """
+        self.patch(Channel, 'setvar_delay', 0.5)
+        self.channel.setvar('a', '1')
+        self.clock.advance(0.4)
+        self.channel.setvar('b', '2')
+        self.assertEqual(self.commands(), [])
+        self.clock.advance(0.1)
+        self.assertEqual(self.commands(),
+            ['bgapi uuid_setvar_multi u-1 a=1;b=2'])
+
+    def test_semicolon(self):
+        """
+        A value containing a semicolon is sent on its own with uuid_setvar,
+        as is a single variable.
+        """
+        self.channel.setvar('a', 'x;y')
+        self.channel.setvar('b', '2')
+        self.channel.setvar('c', '3')
+        self.clock.advance(0)
+        self.assertEqual(self.commands(), ['bgapi uuid_setvar u-1 a x;y',
+            'bgapi uuid_setvar_multi u-1 b=2;c=3'])
+        self.channel.setvar('d', '4')
+        self.clock.advance(0)
+        self.assertEqual(self.commands(), ['bgapi uuid_setvar u-1 d 4'])
+
+    def test_orderKept(self):
+        """
+        Variables still held are sent ahead of the next command of the
+        channel, which may depend on them.
+        """
+        self.channel.setvars(effective_caller_id_name='Sales')
+        self.channel.setvar('hangup_after_bridge', 'true')
+        self.channel.transfer('1000', 'XML', 'default')
+        self.assertEqual(self.commands(), [
+            'bgapi uuid_setvar_multi u-1 effective_caller_id_name=Sales;'
+                'hangup_after_bridge=true',
+            'bgapi uuid_transfer u-1 1000 XML default'])
+        self.assertEqual(self.channel._flush_call, None)
+        self.clock.advance(0)
+        self.assertEqual(self.commands(), [])
+
+
+class VariableCacheTests(ChannelTestCase):
+    """
+    The variables of a channel tracked by a Subsystem, as learned from its
+    events.
+    """
+    def setUp(self):
+        ChannelTestCase.setUp(self)
+        self.subsystem = Subsystem(self.protocol)
+        self.channel = self.subsystem.channel('u-1')
+        self.sent()
+
+    def event(self, name, *headers):
+        self.protocol.dataReceived(plain_event([('Event-Name', name),
+            ('Unique-ID', 'u-1')] + list(headers)))
+
+    def getvar(self, varname):
+        """
+        Returns the value getvar answers with at once, or None if it asks
+        FreeSWITCH, checking that it only does so then.
+        """
+        d = self.channel.getvar(varname)
+        commands = self.commands()
+        if d.called:
+            self.assertEqual(commands, [])
+            return self.successResultOf(d)
+        self.assertEqual(commands, ['bgapi uuid_getvar u-1 %s' % varname])
+        return None
+
+    def test_hit(self):
+        """
+        Variables learned from an event are answered without asking
+        FreeSWITCH, while within variable_ttl.
+        """
+        self.patch(Channel, 'variable_ttl', 10)
+        self.event('CHANNEL_ANSWER', ('variable_foo', 'bar'))
+        self.clock.advance(9)
+        self.assertEqual(self.getvar('foo'), 'bar')
+
+    def test_expired(self):
+        """
+        Once variable_ttl has passed, FreeSWITCH is asked.
+        """
+        self.patch(Channel, 'variable_ttl', 10)
+        self.event('CHANNEL_ANSWER', ('variable_foo', 'bar'))
+        self.clock.advance(10)
+        self.assertEqual(self.getvar('foo'), None)
+
+    def test_unknown(self):
+        """
+        Variables not carried by the events are asked for.
+        """
+        self.event('CHANNEL_ANSWER', ('variable_foo', 'bar'))
+        self.assertEqual(self.getvar('other'), None)
+
+    def test_invalidate(self):
+        """
+        The variables are asked for after invalidate, and after an event
+        that may have changed them without carrying them, until an event
+        carrying them arrives.
+        """
+        self.event('CHANNEL_ANSWER', ('variable_foo', 'bar'))
+        self.channel.invalidate()
+        self.assertEqual(self.getvar('foo'), None)
+        self.event('CHANNEL_ANSWER', ('variable_foo', 'baz'))
+        self.assertEqual(self.getvar('foo'), 'baz')
+        self.event('CHANNEL_EXECUTE_COMPLETE')
+        self.assertEqual(self.getvar('foo'), None)
+
+    def test_refresh(self):
+        """
+        A later event carrying the variables replaces the known values.
+        """
+        self.event('CHANNEL_ANSWER', ('variable_foo', 'bar'))
+        self.event('CHANNEL_EXECUTE_COMPLETE', ('variable_foo', 'baz'))
+        self.assertEqual(self.getvar('foo'), 'baz')
+
+    def test_flushed(self):
+        """
+        Variables being set are answered with the value they are set to,
+        and are known once FreeSWITCH confirms them.
+        """
+        self.event('CHANNEL_ANSWER', ('variable_foo', 'bar'))
+        self.channel.setvar('foo', 'baz')
+        self.assertEqual(self.getvar('foo'), 'baz')
+        self.channel.flush()
+        job_uuid = re.search(r'Job-UUID: (\S+)', self.sent()[0]).group(1)
+        self.assertEqual(self.getvar('foo'), None)
+        self.protocol.dataReceived(background_job(job_uuid, '+OK'))
+        self.assertEqual(self.getvar('foo'), 'baz')
@@ -0,0 +1,255 @@
+"""
+Runs an outbound event socket server in several worker processes, so call
+control is not limited to the single core a reactor runs on.
+
+The supervisor spawns one worker process per core (by default), restarts
+any that die, and adds up the session counts they report. Either every
+worker binds the address itself with SO_REUSEPORT, letting the kernel spread
+the connections from FreeSWITCH between them, or the supervisor binds a
+single listening socket that all of the workers accept from.
+
+The server is named as 'module:attribute', importable by the workers, and
+is instantiated without arguments; it should be an OutboundEventSocket:
+
+    python -m parseltone.api.workers -a 0.0.0.0:8084 -w 4 myapp:CallControl
+"""
+from optparse import OptionParser
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+from twisted.internet import defer, protocol, reactor, task
+from parseltone import utils
+from parseltone.utils.processes import ProcessSupervisor, load_object
+
+# create a log target for this module
+logger = logging.getLogger(__name__)
+
+# not defined by the socket module of python 2; this is the linux value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+# descriptors of the worker processes for the stats reports and for the
+## listening socket shared by the supervisor
+STATS_FD = 3
+LISTEN_FD = 4
+
+
+def bind_socket(host, port, reuse_port=False, backlog=50):
+    """
+    Returns a non-blocking socket listening on the given address.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.buffer = ''
+
+    def childDataReceived(self, fd, data):
+        if fd != STATS_FD:
+            return
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            try:
+                self.supervisor.workerStats(self.index, json.loads(line))
+            except ValueError:
+                logger.warning('Worker %d sent invalid stats: %r',
+                    self.index, line)
+
+    def processEnded(self, reason):
+        self.supervisor.workerEnded(self.index, reason)
+
+
+class OutboundSupervisor(ProcessSupervisor):
+    """
+    Spawns the worker processes running the named outbound server, and keeps
+    them running until the reactor stops, restarting any that die (see
+    ProcessSupervisor).
+    """
+    # seconds between the stats reports of every worker
+    stats_interval = 5
+    # level and syslog name of the logging set up in the workers; their
+    ## stdout and stderr are those of the supervisor
+    log_level = logging.DEBUG
+    syslog_name = None
+
+    def __init__(self, server, workers=None, reuse_port=None, backlog=1024):
+        ProcessSupervisor.__init__(self)
+        self.server = server
+        self.worker_count = workers or multiprocessing.cpu_count()
+        if reuse_port is None:
+            reuse_port = sys.platform.startswith('linux')
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.socket = None
+        self.worker_stats = {}
+        # sessions handled by workers that have since exited
+        self.retired = {'connected': 0, 'completed': 0}
+
+    def start(self, address):
+        self.address = address
+        host, port = utils.parse_host_port(address, 8084)
+        if not self.reuse_port:
+            self.socket = bind_socket(host, port, backlog=self.backlog)
+        logger.info('Starting %d outbound workers on %s:%d (%s).',
+            self.worker_count, host, port,
+            'SO_REUSEPORT' if self.reuse_port else 'shared socket')
+        for index in xrange(self.worker_count):
+            self.spawn(index)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        self.stats_call = task.LoopingCall(self.logStats)
+        self.stats_call.start(self.stats_interval, now=False)
+
+    def spawn(self, index):
+        args = [sys.executable, '-m', 'parseltone.api.workers',
+            '--worker', str(index),
+            '--address', self.address, '--backlog', str(self.backlog),
+            '--stats-interval', str(self.stats_interval),
+            '--log-level', str(self.log_level)]
+        if self.syslog_name:
+            args.extend(['--syslog-name', self.syslog_name])
+        child_fds = {0: 0, 1: 1, 2: 2, STATS_FD: 'r'}
+        if self.socket:
+            child_fds[LISTEN_FD] = self.socket.fileno()
+            args.extend(['--fileno', str(LISTEN_FD)])
+        args.append(self.server)
+        self.processes[index] = reactor.spawnProcess(
+            WorkerProcess(self, index), sys.executable, args, env=os.environ,
+            childFDs=child_fds)
+        logger.debug('Spawned outbound worker %d (pid %d).',
+            index, self.processes[index].pid)
+
+    def workerStats(self, index, stats):
+        self.worker_stats[index] = stats
+        # a worker reporting in has started properly
+        self.workerStarted(index)
+
+    def workerEnded(self, index, reason):
+        stats = self.worker_stats.pop(index, None) or {}
+        for key in self.retired:
+            self.retired[key] += stats.get(key, 0)
+        delay = self.processEnded(index)
+        if delay is not None:
+            logger.error('Outbound worker %d died (%s) with %d active '
+                'sessions; restarting in %d seconds.', index,
+                reason.getErrorMessage(), stats.get('active', 0), delay)
+
+    def stats(self):
+        """
+        Returns the session counts of all workers added up, as last reported
+        by each, along with the number of running workers and restarts.
+        """
+        totals = dict(self.retired, active=0)
+        for stats in self.worker_stats.values():
+            for key in totals:
+                totals[key] += stats.get(key, 0)
+        totals['workers'] = len(self.processes)
+        totals['restarts'] = self.restarts
+        return totals
+
+    def logStats(self):
+        logger.info('Outbound workers: %(workers)d running, %(restarts)d '
+            'restarts; sessions: %(active)d active, %(connected)d connected, '
+            '%(completed)d completed.', self.stats())
+
+    def stop(self):
+        """
+        Terminates the workers, returning a deferred which is called back
+        once all of them have exited.
+        """
+        self.stopping = True
+        if self.stats_call.running:
+            self.stats_call.stop()
+        if not self.processes:
+            return defer.succeed(None)
+        for process in self.processes.values():
+            try:
+                process.signalProcess('TERM')
+            except Exception, e:
+                logger.warning('Unable to stop pid %d: %s', process.pid, e)
+        return self.stopped
+
+
+def run_worker(options, path):
+    if options.syslog_name:
+        log.configure_syslog_handler('%s[%s]' % (options.syslog_name,
+            options.worker), False)
+    log.configure_handlers(int(options.log_level))
+    server = load_object(path)()
+    # the reactor keeps its own copy of the socket
+    if options.fileno is None:
+        host, port = utils.parse_host_port(options.address, 8084)
+        sock = bind_socket(host, port, reuse_port=True,
+            backlog=options.backlog)
+        server.outboundAdopt(sock.fileno())
+        sock.close()
+    else:
+        server.outboundAdopt(options.fileno)
+        os.close(options.fileno)
+    stats_file = os.fdopen(STATS_FD, 'w')
+    def report():
+        stats = dict(server.outbound_factory.stats, pid=os.getpid())
+        try:
+            stats_file.write(json.dumps(stats) + '\n')
+            stats_file.flush()
+        except IOError:
+            # the supervisor is gone
+            reactor.stop()
+    task.LoopingCall(report).start(options.stats_interval)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    # set up the logging of the supervisor and its workers; not done on
+    ## import, as the module is also imported by applications
+    from parseltone.utils import log
+    parser = OptionParser(usage='%prog [options] module:server')
+    parser.add_option('-a', '--address', dest='address',
+        default='127.0.0.1:8084',
+        help='Address to listen at, with port if needed. (default: %default)')
+    parser.add_option('-w', '--workers', type='int', default=None,
+        help='Number of worker processes. (default: one per core)')
+    parser.add_option('-s', '--shared-socket', action='store_false',
+        dest='reuse_port', default=None,
+        help='Accept from one socket bound by the supervisor, rather than '
+        'binding in every worker with SO_REUSEPORT.')
+    parser.add_option('-b', '--backlog', type='int', default=1024,
+        help='Listen queue length of each socket, which FreeSWITCH fills '
+        'quickly during call bursts. (default: %default)')
+    parser.add_option('--stats-interval', type='float', default=5,
+        help='Seconds between worker stats reports. (default: %default)')
+    parser.add_option('--log-level', default=log.DEFAULT_LEVEL,
+        help='Numeric logging level of the workers. (default: %default)')
+    parser.add_option('--syslog-name', default=None,
+        help='Name for syslog messages, which are censored otherwise.')
+    parser.add_option('--worker', default=None, help='(internal)')
+    parser.add_option('--fileno', type='int', default=None,
+        help='(internal)')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('the outbound server to run must be given')
+
+    if options.worker is not None:
+        run_worker(options, args[0])
+    else:
+        if options.syslog_name:
+            log.configure_syslog_handler(options.syslog_name, False)
+        log.configure_handlers(int(options.log_level))
+        supervisor = OutboundSupervisor(args[0], workers=options.workers,
+            reuse_port=options.reuse_port, backlog=options.backlog)
+        supervisor.stats_interval = options.stats_interval
+        supervisor.log_level = options.log_level
+        supervisor.syslog_name = options.syslog_name
+        supervisor.start(options.address)
+        reactor.run()
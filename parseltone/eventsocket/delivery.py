@@ -0,0 +1,174 @@
+"""
+Asynchronous delivery of events to slow subscribers.
+
+Subscription functions are normally called as each event is parsed, so a
+slow one holds up the connection and every other subscriber. A subscriber
+given a SubscriberQueue when subscribing instead has its events queued,
+and delivered to it by a cooperative task, in between the reactor's other
+work:
+
+    queue = SubscriberQueue(maxlen=1000, overflow=COALESCE)
+    eventsocket.subscribe(cdr_writer, queue=queue)
+
+The queue is bounded; once it is full, the overflow policy decides which
+events are lost. Its stats tell how far behind the subscriber is.
+"""
+from collections import deque
+import logging
+from twisted.internet import reactor, task
+
+# create a log target for this module
+logger = logging.getLogger(__name__)
+
+# overflow policies: lose the oldest queued event, lose the new event, or
+## replace the queued event of the same channel (and subscription function)
+## with the new one, losing the oldest event when there is none
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce'
+
+
+class SubscriberQueue(object):
+    """
+    A bounded queue of events for the subscription functions of one
+    subscriber, delivered in the order they arrived.
+    """
+    # source of the time events are queued and delivered at
+    clock = reactor
+
+    def __init__(self, maxlen=1000, overflow=DROP_OLDEST, cooperator=None):
+        if overflow not in (DROP_OLDEST, DROP_NEWEST, COALESCE):
+            raise ValueError('Unknown overflow policy %r.' % overflow)
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self.cooperator = cooperator
+        # [ref, event, content, time queued] entries; lists, so coalescing
+        ## can replace an event in place
+        self.entries = deque()
+        # the queued entry for each (channel uuid, ref), when coalescing
+        self.channel_entries = {}
+        self.task = None
+        self.stats = {
+            'queued': 0,
+            'delivered': 0,
+            'dropped': 0,
+            'coalesced': 0,
+            'failed': 0,
+            'peak': 0,
+            # seconds the last and slowest events spent in the queue
+            'lag': 0.0,
+            'max_lag': 0.0,
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lag(self):
+        """
+        Returns the seconds the oldest queued event has been waiting.
+        """
+        if not self.entries:
+            return 0.0
+        return self.clock.seconds() - self.entries[0][3]
+
+    def put(self, ref, event, content):
+        """
+        Queues the event for the subscription function ref refers to.
+        """
+        self.stats['queued'] += 1
+        key = None
+        if self.overflow == COALESCE:
+            key = (event.dict.get('Unique-ID'), ref)
+        if len(self.entries) >= self.maxlen:
+            if self.overflow == DROP_NEWEST:
+                self.stats['dropped'] += 1
+                return
+            if key is not None and key[0] and key in self.channel_entries:
+                # keep the place of the queued event, with the new one
+                entry = self.channel_entries[key]
+                entry[1], entry[2] = event, content
+                self.stats['coalesced'] += 1
+                return
+            self._discard(self.entries.popleft())
+            self.stats['dropped'] += 1
+        entry = [ref, event, content, self.clock.seconds()]
+        self.entries.append(entry)
+        if key is not None and key[0]:
+            self.channel_entries[key] = entry
+        if len(self.entries) > self.stats['peak']:
+            self.stats['peak'] = len(self.entries)
+        if self.task is None:
+            self._start()
+
+    def _start(self):
+        cooperate = self.cooperator.cooperate if self.cooperator \
+            else task.cooperate
+        self.task = cooperate(self._deliver())
+        self.task.whenDone().addBoth(self._finished)
+
+    def _discard(self, entry):
+        if self.channel_entries:
+            key = (entry[1].dict.get('Unique-ID'), entry[0])
+            if self.channel_entries.get(key) is entry:
+                del self.channel_entries[key]
+
+    def _deliver(self):
+        # delivers one event per iteration, so the cooperator can go back to
+        ## the reactor whenever its time slice is used up
+        while self.entries:
+            entry = self.entries.popleft()
+            self._discard(entry)
+            ref, event, content, queued = entry
+            lag = self.clock.seconds() - queued
+            self.stats['lag'] = lag
+            if lag > self.stats['max_lag']:
+                self.stats['max_lag'] = lag
+            func = ref()
+            if func is not None:
+                try:
+                    func(event, content)
+                except Exception:
+                    self.stats['failed'] += 1
+                    logger.exception('Subscription function %r failed.',
+                        func)
+                self.stats['delivered'] += 1
+            yield None
+
+    def _finished(self, result):
+        self.task = None
+        # events queued after the last one was delivered
+        if self.entries:
+            self._start()
+
+
+class QueuedMethod(object):
+    """
+    Stands in for the reference to a subscription function (see
+    utils.WeakMethod), queueing the events delegated to it on a
+    SubscriberQueue rather than calling the function.
+    """
+    def __init__(self, ref, queue):
+        self.ref = ref
+        self.queue = queue
+
+    def __call__(self):
+        if self.ref() is None:
+            return None
+        return self.deliver
+
+    def deliver(self, event, content):
+        self.queue.put(self.ref, event, content)
+
+    def __eq__(self, other):
+        return isinstance(other, QueuedMethod) and self.ref == other.ref
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def im_self(self):
+        return self.ref.im_self
+
+    @property
+    def owner(self):
+        return self.ref.owner
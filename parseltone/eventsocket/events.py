@@ -1,5 +1,6 @@
-from collections import OrderedDict
+import json
 import logging
+from xml.etree import cElementTree
 from twisted.internet import defer
 from parseltone.eventsocket import utils
 
@@ -9,12 +10,15 @@ logger = logging.getLogger(__name__)
 
 
 class Event(object):
+    # events are received by the thousand, so instances have no __dict__;
+    ## subclasses add no attributes, and only declare empty __slots__
+    __slots__ = ('protocol', 'type', 'dict', 'content', '_deferred')
     subscription_funcname = None
     successful = True
 
     def __init__(self, protocol, event_dict, content):
         self.protocol = protocol
-        self.deferred = defer.Deferred()
+        self._deferred = None
         self.type = event_dict.content_type
         self.dict = event_dict
         self.content = content
@@ -26,6 +30,21 @@ class Event(object):
     def __str__(self):
         return self.type
 
+    @property
+    def deferred(self):
+        """
+        The deferred triggered by the command/reply to this event's response,
+        or by this event itself when it replies to a command. Most events
+        need neither, so it is only created when first used.
+        """
+        if self._deferred is None:
+            self._deferred = defer.Deferred()
+        return self._deferred
+
+    @deferred.setter
+    def deferred(self, deferred):
+        self._deferred = deferred
+
     def parse(self):
         """
         Override to provide custom event parsing.
@@ -48,14 +67,15 @@ class Event(object):
 
     def finish(self):
         """
-        If the protocol has a deferred waiting, this method will trigger it
-        with the event. If the successful attribute on this event instance 
-        returns True, the deferred callback chain will be triggered, otherwise
-        the errback chain will.
+        If the protocol has a command waiting on a reply, this method will
+        trigger the deferred of the oldest one with the event. If the 
+        successful attribute on this event instance returns True, the 
+        deferred callback chain will be triggered, otherwise the errback 
+        chain will.
         """
-        if self.protocol._deferred:
-            self.deferred = self.protocol._deferred
-            self.protocol._deferred = None
+        deferred = self.protocol._nextPendingCommand()
+        if deferred:
+            self.deferred = deferred
             if self.successful:
                 self.deferred.callback(self)
             else:
@@ -63,6 +83,8 @@ class Event(object):
 
 
 class AuthRequestEvent(Event):
+    __slots__ = ()
+
     def response(self):
         def error(message):
             logger.error(message)
@@ -72,13 +94,15 @@ class AuthRequestEvent(Event):
 
 
 class CommandReplyEvent(Event):
+    __slots__ = ()
+
     def __str__(self):
         try:
-            command = self.deferred.command
+            command = self._deferred.command
         except AttributeError:
             command = None
         try:
-            command = ' '.join((command,) + self.deferred.args)
+            command = ' '.join((command,) + self._deferred.args)
         except AttributeError:
             pass
         if command:
@@ -99,12 +123,23 @@ class CommandReplyEvent(Event):
 
 
 class ApiResponseEvent(CommandReplyEvent):
+    __slots__ = ()
+
     @property
     def result(self):
         return self.content
 
 
+class DisconnectNoticeEvent(Event):
+    __slots__ = ()
+
+    def parse(self):
+        self.protocol.disconnectNotice(self)
+
+
 class PlainTextEvent(Event):
+    __slots__ = ()
+
     def __str__(self):
         template = '{type} {name}'
         if self.subclass:
@@ -118,11 +153,15 @@ class PlainTextEvent(Event):
             info=self.info, subclass=self.subclass)
 
     def parse(self):
-        # content contains key:value pairs for plain text events
-        content_dict = utils.EventDict(self.content)
-        self.dict.update(content_dict)
-        self.dict = OrderedDict(sorted(self.dict.items(), 
-                                       key=lambda t: t[0].lower()))
+        # content contains key:value pairs for plain text events, which are
+        ## only decoded as they are looked up
+        content_dict = utils.LazyEventDict(self.content)
+        # keep the outer headers only where the event doesn't override them
+        for key, value in self.dict.iteritems():
+            content_dict.setdefault(key, value)
+        # NOTE: the headers are deliberately left unsorted; render() sorts
+        ## them only when the event is actually displayed
+        self.dict = content_dict
         self.content = content_dict.content
         # delegate the event to any subscription functions
         self.delegate()
@@ -143,3 +182,37 @@ class PlainTextEvent(Event):
     def subclass(self):
         return self.dict.get('Event-Subclass', '').strip()
 
+
+class JsonEvent(PlainTextEvent):
+    __slots__ = ()
+
+    def parse(self):
+        # the event headers arrive as a single json object, with values that
+        ## are not url encoded, and any content block as the _body member
+        headers = json.loads(self.content)
+        # keep the outer headers only where the event doesn't override them
+        for key, value in self.dict.iteritems():
+            headers.setdefault(key, value)
+        self.content = headers.pop('_body', None)
+        self.dict = headers
+        # delegate the event to any subscription functions
+        self.delegate()
+
+
+class XmlEvent(PlainTextEvent):
+    __slots__ = ()
+
+    def parse(self):
+        # the event headers arrive as child elements of <headers> (if there
+        ## are any), url encoded as in plain events, and any content block
+        ## as the text of <body>
+        root = cElementTree.fromstring(self.content)
+        headers = dict((header.tag, utils.value_cleanup(header.text or ''))
+            for header in root.findall('headers/*'))
+        for key, value in self.dict.iteritems():
+            headers.setdefault(key, value)
+        body = root.find('body')
+        self.content = body.text if body is not None else None
+        self.dict = headers
+        # delegate the event to any subscription functions
+        self.delegate()
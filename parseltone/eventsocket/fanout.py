@@ -0,0 +1,246 @@
+"""
+Hands the events received by an EventSocket to a pool of worker processes,
+for subscribers doing more work than one core (and one reactor) can keep up
+with, such as CDR enrichment or fraud scoring.
+
+Frames are forwarded as received, before their headers are parsed, and the
+parsing is left to the workers along with the handling. All events of a
+channel go to the same worker, as chosen by their Unique-ID, so each worker
+sees the events of its channels in order. The subscriber run by the workers
+is named as 'module:attribute', importable by the workers, and instantiated
+without arguments:
+
+    fanout = EventFanout('myapp.fraud:Scorer', workers=4,
+        events=['CHANNEL_CREATE'])
+    fanout.start()
+    eventsocket.fanout = fanout
+
+Subscribers of the EventSocket itself still receive every event as usual.
+"""
+from collections import deque
+from optparse import OptionParser
+import logging
+import multiprocessing
+import os
+import re
+import struct
+import sys
+import zlib
+from zope.interface import implements
+from twisted.internet import defer, interfaces, protocol, reactor, stdio
+from twisted.protocols import basic
+from parseltone.eventsocket import utils
+from parseltone.eventsocket.protocol import EventSocket
+from parseltone.utils.processes import ProcessSupervisor, load_object
+
+# create a log target for this module
+logger = logging.getLogger(__name__)
+
+# frames are sent to the workers as a 4 byte length, then the content type
+## and the event data, separated by a linefeed
+FRAME_LENGTH = struct.Struct('!I')
+# the Unique-ID of plain, json and xml events
+## (the header itself, not Other-Leg-Unique-ID, Caller-Unique-ID and such)
+UNIQUE_ID_RE = re.compile(
+    r'(?:^|\n|"|<)Unique-ID(?::\s*|"\s*:\s*"|>)([0-9a-fA-F-]{36})')
+EVENT_NAME_RE = re.compile(
+    r'(?:^|\n|"|<)Event-Name(?::\s*|"\s*:\s*"|>)([A-Z_]+)')
+
+
+class FanoutWorker(protocol.ProcessProtocol):
+    """
+    One worker process, and the producer of the frames written to it. While
+    the pipe to the worker is full, up to max_backlog frames are held for
+    it; the frames beyond that are dropped.
+    """
+    implements(interfaces.IPushProducer)
+
+    def __init__(self, fanout, index):
+        self.fanout = fanout
+        self.index = index
+        self.paused = False
+        self.backlog = deque()
+        self.stats = {'sent': 0, 'bytes': 0, 'dropped': 0, 'peak_backlog': 0}
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+
+    def send(self, payload):
+        data = FRAME_LENGTH.pack(len(payload)) + payload
+        if self.paused or self.backlog:
+            if len(self.backlog) >= self.fanout.max_backlog:
+                self.stats['dropped'] += 1
+                return
+            self.backlog.append(data)
+            if len(self.backlog) > self.stats['peak_backlog']:
+                self.stats['peak_backlog'] = len(self.backlog)
+            return
+        self._write(data)
+
+    def _write(self, data):
+        self.stats['sent'] += 1
+        self.stats['bytes'] += len(data)
+        self.transport.write(data)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self.backlog and not self.paused:
+            self._write(self.backlog.popleft())
+
+    def stopProducing(self):
+        self.paused = True
+
+    def processEnded(self, reason):
+        self.fanout.workerEnded(self.index, reason)
+
+
+class EventFanout(ProcessSupervisor):
+    """
+    Spawns the worker processes running the named subscriber, and forwards
+    them the events given to dispatch (see EventSocket.fanout); only the
+    named events, if a list of them is given. A worker that dies is
+    restarted (see ProcessSupervisor), and the events of its channels are
+    dropped until it is back.
+    """
+    content_types = ('text/event-plain', 'text/event-json', 'text/event-xml')
+    # frames held for a worker that is not keeping up
+    max_backlog = 10000
+    # level of the logging set up in the workers
+    log_level = logging.DEBUG
+
+    def __init__(self, subscriber, workers=None, events=None):
+        ProcessSupervisor.__init__(self)
+        self.subscriber = subscriber
+        self.worker_count = workers or multiprocessing.cpu_count()
+        self.events = set(events) if events else None
+        self.workers = {}
+        # the worker given the next event without a Unique-ID
+        self._next_worker = 0
+        # when each worker was spawned
+        self.started = {}
+        # events dropped for lack of a running worker
+        self.dropped = 0
+        # frames sent to workers that have since exited
+        self.retired = {'sent': 0, 'bytes': 0, 'dropped': 0}
+
+    def start(self):
+        for index in xrange(self.worker_count):
+            self.spawn(index)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, index):
+        args = [sys.executable, '-m', 'parseltone.eventsocket.fanout',
+            '--log-level', str(self.log_level), self.subscriber]
+        worker = FanoutWorker(self, index)
+        self.processes[index] = reactor.spawnProcess(worker, sys.executable,
+            args, env=os.environ, childFDs={0: 'w', 1: 1, 2: 2})
+        self.workers[index] = worker
+        self.started[index] = self.clock.seconds()
+        logger.debug('Spawned event worker %d (pid %d).', index,
+            self.processes[index].pid)
+
+    def dispatch(self, content_type, content):
+        """
+        Forwards the data of an event, as received, to the worker for its
+        channel.
+        """
+        if self.events is not None:
+            match = EVENT_NAME_RE.search(content)
+            if not match or match.group(1) not in self.events:
+                return
+        match = UNIQUE_ID_RE.search(content)
+        if match:
+            index = zlib.crc32(match.group(1).lower()) % self.worker_count
+        else:
+            index = self._next_worker
+            self._next_worker = (index + 1) % self.worker_count
+        worker = self.workers.get(index)
+        if worker is None:
+            self.dropped += 1
+            return
+        worker.send('%s\n%s' % (content_type, content))
+
+    def workerEnded(self, index, reason):
+        worker = self.workers.pop(index, None)
+        if worker:
+            self.dropped += len(worker.backlog)
+            for key in self.retired:
+                self.retired[key] += worker.stats[key]
+        # a worker that ran for a while did start properly
+        if self.clock.seconds() - self.started[index] > self.max_restart_delay:
+            self.workerStarted(index)
+        delay = self.processEnded(index)
+        if delay is not None:
+            logger.error('Event worker %d died (%s); restarting in %d '
+                'seconds.', index, reason.getErrorMessage(), delay)
+
+    def stats(self):
+        """
+        Returns the frames and bytes sent to the workers, the frames
+        dropped, and those held for the workers not keeping up, along with
+        the number of running workers and restarts.
+        """
+        totals = dict(self.retired, backlog=0)
+        totals['dropped'] += self.dropped
+        for worker in self.workers.values():
+            totals['sent'] += worker.stats['sent']
+            totals['bytes'] += worker.stats['bytes']
+            totals['dropped'] += worker.stats['dropped']
+            totals['backlog'] += len(worker.backlog)
+        totals['workers'] = len(self.processes)
+        totals['restarts'] = self.restarts
+        return totals
+
+    def stop(self):
+        """
+        Closes the pipes to the workers, which exit once they have handled
+        the events already sent; returns a deferred which is called back
+        once all of them have.
+        """
+        self.stopping = True
+        if not self.processes:
+            return defer.succeed(None)
+        for process in self.processes.values():
+            process.closeStdin()
+        return self.stopped
+
+
+class FanoutReceiver(basic.Int32StringReceiver):
+    """
+    The worker side of the pipe, delivering the events it is sent to the
+    subscriber through an EventSocket of its own, which is not connected to
+    FreeSWITCH.
+    """
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def __init__(self, subscriber):
+        self.eventsocket = EventSocket()
+        self.eventsocket.subscribe(subscriber, weak=False)
+
+    def stringReceived(self, payload):
+        content_type, content = payload.split('\n', 1)
+        event_dict = utils.EventDict('Content-Type: %s\nContent-Length: %d' % (
+            content_type, len(content)))
+        self.eventsocket.eventReceived(event_dict, content)
+
+    def connectionLost(self, reason):
+        # the pipe from the parent is closed
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    # set up the logging of the worker; not done on import, as the module
+    ## is also imported by the application running the fanout
+    from parseltone.utils import log
+    parser = OptionParser(usage='%prog [options] module:subscriber')
+    parser.add_option('--log-level', default=log.DEFAULT_LEVEL,
+        help='Numeric logging level. (default: %default)')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('the subscriber to run must be given')
+    log.configure_handlers(int(options.log_level))
+    stdio.StandardIO(FanoutReceiver(load_object(args[0])()))
+    reactor.run()
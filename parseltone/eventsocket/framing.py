@@ -0,0 +1,98 @@
+import logging
+from parseltone.eventsocket import utils
+
+
+# create a log target for this module
+logger = logging.getLogger(__name__)
+
+
+class FrameBuffer(object):
+    """
+    Incrementally splits the event socket byte stream into frames.
+
+    Incoming data is appended to a single bytearray, and a read cursor marks
+    the start of the first unconsumed frame. Each frame is a header block
+    terminated by a blank line, optionally followed by a body whose size is
+    given by the Content-Length header. Scanning resumes where the previous
+    scan stopped, so a large body arriving in many small chunks is only
+    examined once, and the consumed part of the buffer is discarded in bulk
+    instead of on every chunk.
+
+        >>> frames = FrameBuffer()
+        >>> frames.feed('Content-Type: api/response\\nContent-Length: 3\\n\\n+O')
+        >>> frames.next() is None
+        True
+        >>> frames.feed('K')
+        >>> event_dict, body = frames.next()
+        >>> event_dict.content_type, body.tobytes()
+        ('api/response', '+OK')
+    """
+    delimiter = '\n\n'
+    # the consumed part of the buffer is only discarded once it grows past
+    ## this size (or the whole buffer has been consumed), keeping the cost of
+    ## compaction proportional to the amount of data received
+    compact_threshold = 65536
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # start of the first unconsumed frame
+        self._cursor = 0
+        # position to resume scanning for the header delimiter from
+        self._scan = 0
+        # parsed headers of a frame still waiting on its body
+        self._event_dict = None
+
+    def __len__(self):
+        """
+        Returns the number of buffered bytes not yet handed out as frames.
+        """
+        return len(self._buffer) - self._cursor
+
+    def feed(self, data):
+        """
+        Append data received from the transport. Any body returned by an
+        earlier call to next() must no longer be referenced, since the
+        buffer may be compacted here.
+        """
+        if self._cursor:
+            if self._cursor == len(self._buffer):
+                del self._buffer[:]
+                self._scan = 0
+                self._cursor = 0
+            elif self._cursor >= self.compact_threshold:
+                del self._buffer[:self._cursor]
+                self._scan -= self._cursor
+                self._cursor = 0
+        self._buffer.extend(data)
+
+    def next(self):
+        """
+        Returns the next complete frame as an (event_dict, body) tuple, or
+        None if more data is needed. The body is a memoryview into the
+        internal buffer (or None when the frame has no Content-Length), and
+        is only valid until the next call to feed().
+        """
+        buf = self._buffer
+        if self._event_dict is None:
+            # skip any stray blank lines between frames
+            while buf.startswith('\n', self._cursor):
+                self._cursor += 1
+            end = buf.find(self.delimiter, max(self._scan, self._cursor))
+            if end == -1:
+                # resume from the last byte next time, in case the delimiter
+                ## is split across two chunks
+                self._scan = max(self._cursor, len(buf) - 1)
+                return None
+            event_dict = utils.EventDict(str(buf[self._cursor:end]))
+            self._cursor = self._scan = end + len(self.delimiter)
+            if not event_dict.content_length:
+                return event_dict, None
+            self._event_dict = event_dict
+        # wait until the whole body has been received
+        start = self._cursor
+        stop = start + self._event_dict.content_length
+        if len(buf) < stop:
+            return None
+        event_dict, self._event_dict = self._event_dict, None
+        self._cursor = self._scan = stop
+        return event_dict, memoryview(buf)[start:stop]
@@ -0,0 +1,110 @@
+"""
+http://wiki.freeswitch.org/wiki/Mod_event_socket#Outbound
+
+Outbound mode means you make a call with the socket application, and
+FreeSWITCH connects to your application; every call gets its own
+connection, over which that call is controlled.
+"""
+import logging
+from twisted.internet import protocol
+from parseltone.eventsocket.protocol import EventSocket
+
+
+# create a log target for this module
+logger = logging.getLogger(__name__)
+
+
+class OutboundEventSocketProtocol(EventSocket):
+    """
+    The connection made by FreeSWITCH for a single call. Upon connecting, the
+    channel data is requested with 'connect', the events of the call are
+    subscribed to with 'myevents', and with linger enabled, FreeSWITCH keeps
+    the connection open after hangup until the remaining events are sent.
+    """
+    linger = True
+    channel_data = None
+    uuid = None
+
+    def connectionMade(self):
+        EventSocket.connectionMade(self)
+        def failed(error):
+            logger.error(error.getErrorMessage())
+            self.transport.loseConnection()
+        self.sendCommand('connect').addCallback(
+            self.sessionConnected).addErrback(failed)
+
+    def sessionConnected(self, event):
+        # the reply to connect carries all of the channel data
+        self.channel_data = event.dict
+        self.uuid = event.dict.get('Unique-ID')
+        def failed(error):
+            logger.error(error.getErrorMessage())
+        # NOTE: FreeSWITCH only sends the events of this call from here on,
+        ## so no other event registration is done on this connection
+        self.sendCommand('myevents %s' % self.event_format).addErrback(failed)
+        if self.linger:
+            self.sendCommand('linger').addErrback(failed)
+        if self.debug:
+            logger.debug('Outbound session connected for channel %s.',
+                self.uuid)
+        self.factory.sessionConnected(self)
+
+    def connectionLost(self, reason):
+        EventSocket.connectionLost(self, reason)
+        if self.channel_data is not None:
+            self.factory.sessionLost(self, reason)
+
+    def execute(self, app_name, app_arg=None, event_uuid=None):
+        """
+        Execute a dialplan application on the call. The returned deferred is
+        triggered by the command/reply, once the application is queued. If
+        an event_uuid is given, the CHANNEL_EXECUTE_COMPLETE event for the
+        application will carry it as its Application-UUID header.
+        """
+        lines = ['sendmsg', 'call-command: execute',
+            'execute-app-name: %s' % app_name]
+        if app_arg is not None:
+            lines.append('execute-app-arg: %s' % app_arg)
+        if event_uuid:
+            lines.append('Event-UUID: %s' % event_uuid)
+        return self.sendCommand(str('\n'.join(lines)), command='execute',
+            args=(app_name,) + ((app_arg,) if app_arg is not None else ()))
+
+
+class EventSocketServerFactory(protocol.ServerFactory):
+    """
+    A factory accepting the connections FreeSWITCH makes for each call that
+    runs the socket dialplan application, for example:
+
+        <action application="socket" data="127.0.0.1:8084 async full"/>
+
+    Once a call's channel data is known, and again when its connection is
+    lost, the outboundConnected and outboundDisconnected methods will be
+    called on the notifyTarget object.
+    """
+    protocol = OutboundEventSocketProtocol
+
+    def __init__(self, notifyTarget=None):
+        self.__notifyTarget = notifyTarget
+        self.stats = {
+            'connected': 0,
+            'active': 0,
+            'completed': 0,
+        }
+
+    def buildProtocol(self, addr):
+        p = self.protocol()
+        p.factory = self
+        return p
+
+    def sessionConnected(self, protocol_instance):
+        self.stats['connected'] += 1
+        self.stats['active'] += 1
+        if self.__notifyTarget:
+            self.__notifyTarget.outboundConnected(protocol_instance)
+
+    def sessionLost(self, protocol_instance, reason):
+        self.stats['active'] -= 1
+        self.stats['completed'] += 1
+        if self.__notifyTarget:
+            self.__notifyTarget.outboundDisconnected(protocol_instance, reason)
@@ -0,0 +1,232 @@
+"""
+A pool of inbound connections to one FreeSWITCH server, so that slow api
+commands (such as 'show calls', or an originate waiting on an answer) do not
+hold up every command sent after them.
+
+The first connection carries the event stream and all subscriptions, in the
+order FreeSWITCH sends them. The others carry commands, each api or bgapi
+command going to the connection with the fewest replies outstanding.
+Commands on different connections may complete in any order, so commands
+that depend on each other should be chained on their deferreds.
+"""
+import logging
+import weakref
+from twisted.internet import defer, reactor
+from parseltone.eventsocket.inbound import EventSocketClientFactory
+from parseltone.eventsocket import utils
+from parseltone.eventsocket.protocol import EventError, EventSocket
+
+
+# create a log target for this module
+logger = logging.getLogger(__name__)
+
+
+class PoolMember(object):
+    """
+    Notify target of the factory for one connection of the pool, passing
+    the notifications on to the pool along with the connection's index.
+    """
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+
+    def inboundStarted(self):
+        self.pool.memberStarted(self.index)
+
+    def inboundConnected(self, protocol_instance):
+        self.pool.memberConnected(self.index, protocol_instance)
+
+    def inboundFailed(self, reason):
+        self.pool.memberLost(self.index, reason, failed=True)
+
+    def inboundLost(self, reason):
+        self.pool.memberLost(self.index, reason)
+
+    def inboundDisconnected(self, reason):
+        self.pool.memberDisconnected(self.index, reason)
+
+
+class Subscriptions(object):
+    """
+    The subscribers of a stand-in for an EventSocket, with the arguments
+    they were subscribed with, so that they can be subscribed again on new
+    protocol instances. Subscribers are keyed by id(obj), and those only
+    weakly referred to are dropped once they are garbage collected.
+    """
+    def __init__(self):
+        # (reference, filters, weak, queue) for every subscriber, by id
+        self.subscriptions = {}
+
+    def add(self, obj, filters=None, weak=True, queue=None):
+        """
+        Keeps obj, replacing any earlier subscription of it. Returns False,
+        keeping nothing, if obj has no subscription functions.
+        """
+        if not utils.subscription_functions(obj):
+            self.remove(obj)
+            return False
+        key = id(obj)
+        if weak:
+            def collected(ref):
+                if self.subscriptions.get(key, (None,))[0] is ref:
+                    del self.subscriptions[key]
+            ref = weakref.ref(obj, collected)
+        else:
+            ref = lambda: obj
+        self.subscriptions[key] = (ref, filters, weak, queue)
+        return True
+
+    def remove(self, obj):
+        subscription = self.subscriptions.get(id(obj))
+        if subscription and subscription[0]() is obj:
+            del self.subscriptions[id(obj)]
+
+    def __iter__(self):
+        """
+        Yields (obj, filters, weak, queue) for every live subscriber.
+        """
+        for ref, filters, weak, queue in self.subscriptions.values():
+            obj = ref()
+            if obj is not None:
+                yield obj, filters, weak, queue
+
+
+class EventSocketPool(object):
+    """
+    Opens size authenticated connections to FreeSWITCH and stands in for a
+    single EventSocket protocol instance, for use as the eventsocket of a
+    Subsystem. The notifications of the event connection (the first one)
+    are passed on to the notifyTarget object, as if it were the only one.
+
+    Subscriptions are kept by the pool, and made again on the new protocol
+    instance whenever the event connection is reestablished. A pool of size
+    one has no command connections, sending everything over the event
+    connection, and is just a reconnecting stand-in for it.
+    """
+    def __init__(self, size=2, password='ClueCon', protocol=EventSocket,
+            factory=EventSocketClientFactory, notifyTarget=None):
+        if size < 1:
+            raise ValueError('A pool needs at least an event connection.')
+        self.notifyTarget = notifyTarget
+        self.factories = []
+        for index in xrange(size):
+            member_factory = factory(password=password,
+                notifyTarget=PoolMember(self, index))
+            member_factory.protocol = protocol
+            self.factories.append(member_factory)
+        # protocol instances, None while disconnected
+        self.protocols = [None] * size
+        # the number of commands sent over each connection
+        self.routed = [0] * size
+        self.subscriptions = Subscriptions()
+
+    def connect(self, host, port):
+        for member_factory in self.factories:
+            reactor.connectTCP(host, port, member_factory)
+
+    @property
+    def eventsocket(self):
+        """
+        The protocol instance of the event connection, or None.
+        """
+        return self.protocols[0]
+
+    @property
+    def authorized(self):
+        return bool(self.eventsocket and self.eventsocket.authorized)
+
+    def memberStarted(self, index):
+        if index == 0 and self.notifyTarget:
+            self.notifyTarget.inboundStarted()
+
+    def memberConnected(self, index, protocol_instance):
+        self.protocols[index] = protocol_instance
+        if index == 0:
+            for obj, filters, weak, queue in self.subscriptions:
+                protocol_instance.subscribe(obj, filters=filters, weak=weak,
+                    queue=queue)
+            if self.notifyTarget:
+                self.notifyTarget.inboundConnected(protocol_instance)
+        else:
+            logger.debug('FreeSWITCH: command connection %d established.',
+                index)
+
+    def memberLost(self, index, reason, failed=False):
+        self.protocols[index] = None
+        if index == 0 and self.notifyTarget:
+            if failed:
+                self.notifyTarget.inboundFailed(reason)
+            else:
+                self.notifyTarget.inboundLost(reason)
+
+    def memberDisconnected(self, index, reason):
+        if index == 0 and self.notifyTarget:
+            self.notifyTarget.inboundDisconnected(reason)
+        elif index:
+            logger.debug('FreeSWITCH: command connection %d lost: %s',
+                index, reason.getErrorMessage())
+
+    def subscribe(self, obj, filters=None, weak=True, queue=None):
+        """
+        Subscribe obj to events on the event connection; see
+        EventSocket.subscribe.
+        """
+        if not self.subscriptions.add(obj, filters=filters, weak=weak,
+                queue=queue):
+            return
+        if self.eventsocket:
+            self.eventsocket.subscribe(obj, filters=filters, weak=weak,
+                queue=queue)
+
+    def unsubscribe(self, obj):
+        self.subscriptions.remove(obj)
+        if self.eventsocket:
+            self.eventsocket.unsubscribe(obj)
+
+    def subscriberCounts(self):
+        if self.eventsocket:
+            return self.eventsocket.subscriberCounts()
+        return {}
+
+    def outstanding(self):
+        """
+        Returns the number of commands awaiting a reply on each connection,
+        including those still queued to be sent, or None for connections
+        that are not established.
+        """
+        return [len(p.pending_commands) + len(p.command_queue) if p else None
+            for p in self.protocols]
+
+    def _route(self):
+        """
+        Returns the index of the authorized command connection with the
+        fewest replies outstanding, or of the event connection while none
+        of them are available.
+        """
+        best, best_load = None, None
+        for index in xrange(1, len(self.protocols)):
+            p = self.protocols[index]
+            if p is None or not p.authorized:
+                continue
+            load = len(p.pending_commands) + len(p.command_queue)
+            if best is None or load < best_load:
+                best, best_load = index, load
+        if best is None and self.authorized:
+            best = 0
+        return best
+
+    def api(self, command, *args, **kwargs):
+        index = self._route()
+        if index is None:
+            return defer.fail(EventError('No FreeSWITCH connection is '
+                'available for api %s.' % command))
+        self.routed[index] += 1
+        return self.protocols[index].api(command, *args, **kwargs)
+
+    def bgapi(self, command, *args, **kwargs):
+        index = self._route()
+        if index is None:
+            return defer.fail(EventError('No FreeSWITCH connection is '
+                'available for bgapi %s.' % command))
+        self.routed[index] += 1
+        return self.protocols[index].bgapi(command, *args, **kwargs)
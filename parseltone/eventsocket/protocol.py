@@ -1,8 +1,12 @@
+from collections import deque
+import heapq
+import itertools
 import logging
 import string
-from twisted.internet import defer
-from twisted.protocols import basic
-from parseltone.eventsocket import events, utils
+import uuid
+from zope.interface import implements
+from twisted.internet import defer, interfaces, protocol, reactor
+from parseltone.eventsocket import delivery, events, framing, utils
 
 
 # create a log target for this module
@@ -13,62 +17,72 @@ class EventError(Exception):
     pass
 
 
-class RawEventSocket(basic.LineReceiver):
+class CommandTimeoutError(EventError):
+    pass
+
+
+class JobTimeoutError(CommandTimeoutError):
+    pass
+
+
+class RawEventSocket(protocol.Protocol):
     delimiter = '\n\n'
     password = 'ClueCon'
-    _event_dict = None
-    _content = ''
+    # a recording.Recorder the received data is also written to
+    recorder = None
 
     def connectionMade(self):
-        self.setLineMode()
-
-    def lineReceived(self, line):
-            event_dict = utils.EventDict(line)
-            # more content may be expected
-            if event_dict.content_length:
-                # preserve the event so that we can use it after receiving
-                ## the expected content
-                self._event_dict = event_dict
-                # tell twisted that we want to receive raw data for our
-                ## content
-                self.setRawMode()
-                return
-            # event did not specify that it included any content, so it
-            ## is complete
-            self.eventReceived(event_dict)
-
-    def rawDataReceived(self, data):
-            # retrieve the event information
-            event_dict = self._event_dict
-            # append data to the content
-            self._content += data
-            # if not finished receiving content data yet, just return
-            if len(self._content) < event_dict.content_length:
+        self._frames = framing.FrameBuffer()
+
+    def dataReceived(self, data):
+        if self.recorder is not None:
+            self.recorder.record(data)
+        self._frames.feed(data)
+        while True:
+            frame = self._frames.next()
+            if frame is None:
                 return
-            # we have complete content
-            content = self._content
-            # reset the class attributes to defaults
-            self._content = ''
-            self._event_dict = None
-            # if the content length is too long, trim the extra, and pass
-            ## it back to twisted when setting the linemode
-            extra = ''
-            if len(content) > event_dict.content_length:
-                extra = content[event_dict.content_length:]
-                content = content[:event_dict.content_length]
-            # switch back to linemode, passing in any extra data received
-            self.setLineMode(extra=extra)
+            event_dict, body = frame
+            # the event handlers work with strings, so the body is copied
+            ## out of the frame buffer exactly once, here
+            content = body.tobytes() if body is not None else None
             self.eventReceived(event_dict, content=content)
 
+    def sendLine(self, line):
+        """
+        Sends a command to the distant end, terminated by the delimiter.
+        """
+        return self.transport.write(line + self.delimiter)
+
     def eventReceived(self, event_dict, content=None):
         raise NotImplementedError('eventReceived method must be implemented '
             'by %r subclass.' % self.__class__.__name__)
 
 
 class BasicEventSocket(RawEventSocket):
+    """
+    Sends commands and matches up their replies. The protocol is the
+    producer of the commands written to its transport: while the transport
+    has too much buffered, or too many commands (max_outstanding) or bytes
+    of them (max_outstanding_bytes) are awaiting a reply, further commands
+    wait in command_queue, and are sent by priority once there is room.
+    """
+    implements(interfaces.IPushProducer)
     debug = False
     verboseEvents = False
-    _deferred = None
+    # limits on the commands sent but not yet replied to; None is unlimited
+    max_outstanding = None
+    max_outstanding_bytes = None
+    # queued commands are sent lowest priority first, and in the order they
+    ## were given within a priority; commands are looked up by name here,
+    ## or have default_priority
+    default_priority = 5
+    command_priorities = {
+        'auth': 0, 'connect': 0, 'myevents': 0, 'linger': 0, 'event': 0,
+        'nixevent': 0, 'noevents': 0, 'filter': 0,
+        'uuid_kill': 1, 'sched_hangup': 1, 'hupall': 1,
+        'show': 9, 'status': 9, 'uuid_dump': 9,
+    }
 
     def __init__(self):
         self.event_handlers = {
@@ -77,6 +91,59 @@ class BasicEventSocket(RawEventSocket):
             'text/event-plain': self._eventPlainText,
             'api/response': self._eventApiResponse,
         }
+        self._initCommands()
+
+    def _initCommands(self):
+        # deferreds for commands sent but not yet replied to, in the order
+        ## they were sent; FreeSWITCH replies to commands in order
+        self.pending_commands = deque()
+        self.outstanding_bytes = 0
+        # (priority, sequence, line, deferred) heap of the commands waiting
+        ## to be sent
+        self.command_queue = []
+        self._command_sequence = itertools.count()
+        self.paused = False
+        self.stats = {'queued_peak': 0, 'pauses': 0}
+
+    def connectionMade(self):
+        RawEventSocket.connectionMade(self)
+        self.transport.registerProducer(self, True)
+
+    def connectionLost(self, reason):
+        # nothing more will be replied to, so fail anything still waiting
+        while self.pending_commands:
+            self.pending_commands.popleft().errback(reason)
+        self.outstanding_bytes = 0
+        while self.command_queue:
+            deferred = heapq.heappop(self.command_queue)[3]
+            if not deferred.called:
+                deferred.errback(reason)
+
+    def pauseProducing(self):
+        # the transport has more buffered than it wants
+        self.paused = True
+        self.stats['pauses'] += 1
+
+    def resumeProducing(self):
+        self.paused = False
+        self._sendQueued()
+
+    def stopProducing(self):
+        self.paused = True
+
+    def queueStats(self):
+        """
+        Returns the current depth of the command queue, along with the
+        commands and bytes awaiting a reply, and the counters in stats.
+        """
+        stats = dict(self.stats)
+        stats.update({
+            'queued': len(self.command_queue),
+            'outstanding': len(self.pending_commands),
+            'outstanding_bytes': self.outstanding_bytes,
+            'paused': self.paused,
+        })
+        return stats
 
     def eventReceived(self, event_dict, content=None):
         # find the event handler, and warn if one doesn't exist for this event
@@ -94,66 +161,148 @@ class BasicEventSocket(RawEventSocket):
     def authFailure(self, failure):
         logger.error(failure.getErrorMessage())
 
+    def sendCommand(self, line, command=None, args=(), priority=None):
+        """
+        Sends a command line to FreeSWITCH and returns a deferred that will
+        be triggered by the command/reply or api/response answering it. Any
+        number of commands may be outstanding at once. The command and args
+        are kept on the deferred for rendering the reply in the logs, and
+        default to the line itself.
+
+        The command is sent at once unless commands are queued (see the
+        class docstring), in which case its priority (by default, looked up
+        in command_priorities) decides its place in the queue.
+
+        Cancelling the deferred of a queued command keeps it from being sent.
+        Once sent, it stays in place in pending_commands, so the reply to the
+        command is still matched to it, and then ignored.
+        """
+        deferred = defer.Deferred()
+        deferred.command = command or line
+        deferred.args = args
+        size = len(line) + len(self.delimiter)
+        if not self.command_queue and self._canSend(size):
+            self._transmit(line, deferred)
+            return deferred
+        if priority is None:
+            name = deferred.command.split(' ', 1)[0]
+            priority = self.command_priorities.get(name,
+                self.default_priority)
+        heapq.heappush(self.command_queue,
+            (priority, next(self._command_sequence), line, deferred))
+        if len(self.command_queue) > self.stats['queued_peak']:
+            self.stats['queued_peak'] = len(self.command_queue)
+        self._sendQueued()
+        return deferred
+
+    def _canSend(self, size):
+        if self.paused:
+            return False
+        if not self.pending_commands:
+            # a single command is always let through, however large
+            return True
+        if self.max_outstanding is not None and \
+                len(self.pending_commands) >= self.max_outstanding:
+            return False
+        if self.max_outstanding_bytes is not None and \
+                self.outstanding_bytes + size > self.max_outstanding_bytes:
+            return False
+        return True
+
+    def _transmit(self, line, deferred):
+        """
+        Writes the command, queueing its deferred for the reply.
+        """
+        deferred.size = len(line) + len(self.delimiter)
+        self.pending_commands.append(deferred)
+        self.outstanding_bytes += deferred.size
+        self.sendLine(line)
+
+    def _sendQueued(self):
+        """
+        Sends queued commands for as long as there is room for them.
+        """
+        while self.command_queue:
+            priority, sequence, line, deferred = self.command_queue[0]
+            if deferred.called:
+                # cancelled while waiting to be sent
+                heapq.heappop(self.command_queue)
+                continue
+            if not self._canSend(len(line) + len(self.delimiter)):
+                return
+            heapq.heappop(self.command_queue)
+            self._transmit(line, deferred)
+
+    def _nextPendingCommand(self):
+        """
+        Returns the deferred for the oldest outstanding command, removing it
+        from the queue, or None if no command is waiting on a reply.
+        """
+        if not self.pending_commands:
+            return None
+        deferred = self.pending_commands.popleft()
+        self.outstanding_bytes -= getattr(deferred, 'size', 0)
+        # the reply makes room for a queued command
+        if self.command_queue:
+            self._sendQueued()
+        return deferred
+
     def _eventAuthRequest(self, event_dict, content):
         # render to logs, if enabled
         if self.verboseEvents:
             logger.info('Event received:\n%s' % utils.format_event(
                 event_dict.content_type, event_dict, content=content))
-        # construct a deferred object to use when we receive the
-        ## command/reply event in response to the sendLine below
-        self._deferred = defer.Deferred()
-        self._deferred.command = 'auth'
-        self._deferred.addCallback(self.authSuccess).addErrback(
+        # send the auth command, handling the command/reply event for it
+        self.sendCommand('auth {password}'.format(password=self.password),
+            command='auth').addCallback(self.authSuccess).addErrback(
             self.authFailure)
-        # send the auth command
-        self.sendLine('auth {password}'.format(password=self.password))
 
     def _eventCommandReply(self, event_dict, content):
+        # this reply answers the oldest outstanding command
+        deferred = self._nextPendingCommand()
         # render to logs, if enabled
         if self.verboseEvents:
             title = event_dict.content_type
-            if hasattr(self._deferred, 'command'):
-                command = self._deferred.command
-                if hasattr(self._deferred, 'args'):
-                    command = ' '.join((command,) + self._deferred.args)
+            if hasattr(deferred, 'command'):
+                command = deferred.command
+                if hasattr(deferred, 'args'):
+                    command = ' '.join((command,) + deferred.args)
                 title = ' '.join([title, repr(command)])
             logger.info('Event received:\n%s' % utils.format_event(
                 title, event_dict, content=content))
         # determine how to handle the result
         result = event_dict['Reply-Text']
         if result.startswith('-ERR'):
-            if self._deferred:
-                self._deferred.errback(result)
-                self._deferred = None
+            if deferred:
+                deferred.errback(result)
                 return
             raise EventError(result)
-        if self._deferred:
-            self._deferred.callback(result)
-            self._deferred = None
+        if deferred:
+            deferred.callback(result)
             return
         logger.info(result)
 
     def _eventApiResponse(self, event_dict, content):
+        # this response answers the oldest outstanding command
+        deferred = self._nextPendingCommand()
         # render to logs, if enabled
         if self.verboseEvents:
             title = event_dict.content_type
-            if hasattr(self._deferred, 'command'):
-                command = self._deferred.command
-                if hasattr(self._deferred, 'args'):
-                    command = ' '.join((command,) + self._deferred.args)
+            if hasattr(deferred, 'command'):
+                command = deferred.command
+                if hasattr(deferred, 'args'):
+                    command = ' '.join((command,) + deferred.args)
                 title = ' '.join([title, repr(command)])
             logger.info('Event received:\n%s' % utils.format_event(
                 title, event_dict, content=content))
         # determine how to handle the result
         if content.startswith('-ERR'):
-            if self._deferred:
-                self._deferred.errback(content)
-                self._deferred = None
+            if deferred:
+                deferred.errback(content)
                 return
             raise EventError(content)
-        if self._deferred:
-            self._deferred.callback(content)
-            self._deferred = None
+        if deferred:
+            deferred.callback(content)
             return
         logger.info(content)
 
@@ -202,22 +351,34 @@ class BasicEventSocket(RawEventSocket):
         subscription_func(obj, content)
 
     def api(self, command, *args):
-        self._deferred = defer.Deferred()
-        self._deferred.command = command
-        self._deferred.args = args
-        self.sendLine('api %s %s' % (command, ' '.join(args)))
-        return self._deferred
+        return self.sendCommand('api %s %s' % (command, ' '.join(args)),
+            command=command, args=args)
 
     def bgapi(self, command, *args):
-        self._deferred = defer.Deferred()
-        self._deferred.command = command
-        self._deferred.args = args
-        self.sendLine('bgapi %s %s' % (command, ' '.join(args)))
-        return self._deferred
+        return self.sendCommand('bgapi %s %s' % (command, ' '.join(args)),
+            command=command, args=args)
 
 
 class EventSocket(BasicEventSocket):
     response_substitutions = {}
+    # seconds to wait for the BACKGROUND_JOB event of a bgapi command before
+    ## giving up on it; None waits forever
+    job_timeout = 300
+    # seconds to wait for the reply to an api command before giving up on
+    ## it, unless given with the command; None waits forever
+    command_timeout = None
+    # source of delayed calls; may be replaced with a task.Clock for testing
+    clock = reactor
+    # format FreeSWITCH sends events in: 'plain', 'json' or 'xml'; json
+    ## skips the url decoding of every header value that plain requires
+    event_format = 'plain'
+    # whether subscriptions with header filters also install the matching
+    ## filters in FreeSWITCH, so unwanted events are never sent at all
+    server_filters = True
+    # an EventFanout (see the fanout module) the events are also forwarded
+    ## to, before they are parsed
+    fanout = None
+    _prune_call = None
 
     def __init__(self):
         self.authorized = False
@@ -225,45 +386,245 @@ class EventSocket(BasicEventSocket):
             'auth/request': events.AuthRequestEvent,
             'command/reply': events.CommandReplyEvent,
             'text/event-plain': events.PlainTextEvent,
+            'text/event-json': events.JsonEvent,
+            'text/event-xml': events.XmlEvent,
             'api/response': events.ApiResponseEvent,
+            'text/disconnect-notice': events.DisconnectNoticeEvent,
         }
+        self._initCommands()
         self.pending_jobs = {}
+        # the number of commands given up on for taking too long
+        self.stats['timeouts'] = 0
         # NOTE: always subscribe to BACKGROUND_JOB for bgapi responses
         self.event_subscriptions = {
             'BACKGROUND_JOB': [],
         }
+        # subscriptions limited to events with specific header values, as
+        ## {(header, value): {eventkey: [(subscriber, predicates), ...]}},
+        ## where predicates are any further (header, value) pairs to match
+        self.filtered_subscriptions = {}
+        # the events FreeSWITCH has been asked to send us, and the filters
+        ## installed for them
+        self.registered_events = set()
+        self.installed_filters = set()
+        # the number of subscription functions for each event key, filtered
+        ## or not; FreeSWITCH is asked to send the events counted here
+        self.event_counts = {}
+        # the (header_value, eventkey) places each subscriber (by id) has
+        ## subscription functions in, header_value being None when unfiltered
+        self._subscriber_locations = {}
+        # subscribers (by id) which died since the last pruning
+        self._dead_subscribers = set()
+        self._compileDispatchTable()
         # this class is always a subscriber
         self.subscribe(self)
 
+    def connectionLost(self, reason):
+        BasicEventSocket.connectionLost(self, reason)
+        # background jobs report back over this connection only, so they
+        ## can not complete any more either
+        for job_uuid in self.pending_jobs.keys():
+            self._popJob(job_uuid).errback(reason)
+
     def authSuccess(self, response):
         self.authorized = True
         self.registerSubscribedEvents()
 
+    def disconnectNotice(self, event):
+        """
+        Called when FreeSWITCH announces it is about to close the connection,
+        such as once the call of an outbound connection has hung up.
+        """
+        if self.debug:
+            logger.debug('Disconnect notice: %s', (event.content or '').strip())
+
     def registerSubscribedEvents(self):
         if not self.authorized:
             return
+        events = self._subscribedEvents()
         # if any subscribers are interested in all events, we just need to
         ## register for all of them, and we're done
-        if self.event_subscriptions.get('ALL', []):
+        if 'ALL' in events:
             if self.debug:
                 logger.debug('Registering for all events.')
-            self.sendLine('event plain all')
+            self._sendEventCommand('event %s all' % self.event_format)
+        else:
+            eventlist = self._eventList(events)
+            # register for the events with FreeSWITCH
+            if self.debug:
+                logger.debug('Registering for event(s): %s' % ' '.join(
+                    eventlist))
+            self._sendEventCommand('event %s %s' % (self.event_format,
+                ' '.join(eventlist)))
+        self.registered_events = events
+        self.updateFilters()
+
+    def updateSubscribedEvents(self, eventkeys=None, header_values=None):
+        """
+        Brings the events registered with FreeSWITCH in line with the current
+        subscriptions, only sending the events that were added or removed,
+        then does the same for the filters (see updateFilters). If the event
+        keys and filters whose subscriptions changed are given, only those
+        are looked at.
+        """
+        if not self.authorized:
+            return
+        events = self._subscribedEvents()
+        if 'ALL' in events:
+            if 'ALL' not in self.registered_events:
+                if self.debug:
+                    logger.debug('Registering for all events.')
+                self._sendEventCommand('event %s all' % self.event_format)
+            # NOTE: while registered for all events, individual events must
+            ## not be removed, or FreeSWITCH would stop sending them
+            self.registered_events = events
+            self.updateFilters(header_values)
+            return
+        if 'ALL' in self.registered_events:
+            # nobody wants all events any more, so start over with just the
+            ## events that are still subscribed to
+            if self.debug:
+                logger.debug('Unregistering from all events.')
+            self._sendEventCommand('noevents')
+            self.registerSubscribedEvents()
+            return
+        if eventkeys is None:
+            eventkeys = events | self.registered_events
+        # an event is registered when its count goes from 0 to 1, and
+        ## unregistered when it drops back to 0
+        added = set(eventkey for eventkey in eventkeys 
+            if eventkey in events and eventkey not in self.registered_events)
+        removed = set(eventkey for eventkey in eventkeys 
+            if eventkey not in events and eventkey in self.registered_events)
+        if added:
+            eventlist = self._eventList(added)
+            if self.debug:
+                logger.debug('Registering for event(s): %s' % ' '.join(
+                    eventlist))
+            self._sendEventCommand('event %s %s' % (self.event_format,
+                ' '.join(eventlist)))
+        if removed:
+            eventlist = self._eventList(removed)
+            if self.debug:
+                logger.debug('Unregistering from event(s): %s' % ' '.join(
+                    eventlist))
+            self._sendEventCommand('nixevent %s' % ' '.join(eventlist))
+        self.registered_events = (self.registered_events | added) - removed
+        self.updateFilters(header_values)
+
+    def updateFilters(self, header_values=None):
+        """
+        Brings the filters installed in FreeSWITCH in line with the current
+        subscriptions, adding and deleting only the filters that changed. If
+        the (header, value) filters whose subscriptions changed are given,
+        only those are looked at, unless filtering as a whole was just
+        turned on or off.
+        """
+        if not self.authorized:
             return
-        eventlist = [e for e in self.event_subscriptions.keys() \
-            if not e.startswith('CUSTOM')]
-        customeventlist = [e.split()[-1] for e in \
-            self.event_subscriptions.keys() if e.startswith('CUSTOM')]
+        if header_values is None or \
+                self._filtersActive() != bool(self.installed_filters):
+            filters = self._subscribedFilters()
+            header_values = filters | self.installed_filters
+            wanted = filters.__contains__
+        else:
+            wanted = self._filterWanted
+        added = [header_value for header_value in header_values 
+            if header_value not in self.installed_filters and 
+            wanted(header_value)]
+        removed = [header_value for header_value in header_values 
+            if header_value in self.installed_filters and 
+            not wanted(header_value)]
+        # add the filters letting unfiltered subscriptions through first, and
+        ## delete them last, so those events are never dropped in between
+        def passthrough_last(header_value):
+            return (header_value[0] in ('Event-Name', 'Event-Subclass'),
+                header_value)
+        for header, value in sorted(added, key=passthrough_last, 
+                reverse=True):
+            self._sendEventCommand('filter %s %s' % (header, value))
+        for header, value in sorted(removed, key=passthrough_last):
+            self._sendEventCommand('filter delete %s %s' % (header, value))
+        self.installed_filters.update(added)
+        self.installed_filters.difference_update(removed)
+
+    def _subscribedEvents(self):
+        """
+        Returns the set of event keys that have at least one subscriber.
+        """
+        events = set(self.event_counts)
+        events.add('BACKGROUND_JOB')
+        return events
+
+    def _filtersActive(self):
+        # unfiltered interest in everything means nothing can be filtered
+        return bool(self.server_filters and self.filtered_subscriptions and
+            not self.event_subscriptions.get('ALL'))
+
+    def _subscribedFilters(self):
+        """
+        Returns the set of (header, value) filters FreeSWITCH should apply.
+        Once any filter is installed, FreeSWITCH only sends events matching
+        at least one of them, so every unfiltered subscription needs a filter
+        letting its events through as well.
+        """
+        if not self._filtersActive():
+            return set()
+        filters = set(self.filtered_subscriptions)
+        for eventkey, subscribers in self.event_subscriptions.iteritems():
+            if subscribers or eventkey == 'BACKGROUND_JOB':
+                filters.add(self._passthroughFilter(eventkey))
+        return filters
+
+    def _filterWanted(self, header_value):
+        """
+        Returns whether the (header, value) filter should be installed, just
+        as _subscribedFilters would, without building every filter.
+        """
+        if not self._filtersActive():
+            return False
+        if header_value in self.filtered_subscriptions:
+            return True
+        # there are only as many unfiltered event keys as event types
+        for eventkey, subscribers in self.event_subscriptions.iteritems():
+            if (subscribers or eventkey == 'BACKGROUND_JOB') and \
+                    self._passthroughFilter(eventkey) == header_value:
+                return True
+        return False
+
+    def _passthroughFilter(self, eventkey):
+        """
+        Returns the filter letting through the events of an event key.
+        """
+        name, _, subclass = eventkey.partition(' ')
+        if subclass:
+            return ('Event-Subclass', subclass)
+        return ('Event-Name', name)
+
+    def _eventList(self, events):
+        """
+        Converts event keys into the list of event names to send with the
+        event and nixevent commands.
+        """
+        eventlist = [e for e in events if not e.startswith('CUSTOM')]
+        customeventlist = [e.split()[-1] for e in events 
+            if e.startswith('CUSTOM')]
         # append custom event subclasses to the end of the list
         if customeventlist:
             eventlist.append('CUSTOM')
             for c in customeventlist:
                 eventlist.append(c)
-        # register for the events with FreeSWITCH
-        if self.debug:
-            logger.debug('Registering for event(s): %s' % ' '.join(eventlist))
-        self.sendLine('event plain %s' % ' '.join(eventlist))
+        return eventlist
+
+    def _sendEventCommand(self, line):
+        def failed(error):
+            logger.error(error.getErrorMessage())
+        self.sendCommand(line).addErrback(failed)
 
     def eventReceived(self, event_dict, content=None):
+        if self.fanout is not None and \
+                event_dict.content_type in self.fanout.content_types:
+            self.fanout.dispatch(event_dict.content_type, content)
         # pass to event handler
         event_handler = self.event_handlers.get(event_dict.content_type,
             events.Event)
@@ -275,8 +636,8 @@ class EventSocket(BasicEventSocket):
         ## wire to the distant end
         response = event.response()
         if response:
-            # set the deferred to callback when command/reply is recv'd
-            self._deferred = event.deferred
+            # the deferred is triggered when the command/reply is recv'd
+            deferred = event.deferred
             # provide support for specific substitutions in the response
             response = string.Template(response).safe_substitute(
                 self.response_substitutions)
@@ -285,118 +646,393 @@ class EventSocket(BasicEventSocket):
             # in order to avoid accidentally exposing the password outside
             ## of the code, add it only after logging is done, and deferred
             ## command info is set
-            self._deferred.command = response
+            deferred.command = response
             response = string.Template(response).safe_substitute(
                 {'password': self.password})
-            # send response to distant end
-            self.sendLine(str(response))
+            # send response to distant end, queueing the deferred for the
+            ## command/reply that will answer it
+            self._transmit(str(response), deferred)
 
-    def subscribe(self, obj):
+    def subscribe(self, obj, filters=None, weak=True, queue=None):
         """
-        Subscribe obj to receive events.
+        Subscribe obj to receive events. If a dictionary of filters is given,
+        obj only receives events whose headers have all of the given values,
+        for example {'Unique-ID': uuid} for the events of a single channel.
+
+        Only weak references to obj are kept unless weak is False, so obj is
+        unsubscribed automatically once nothing else refers to it.
+
+        If a queue (a delivery.SubscriberQueue) is given, events are queued
+        for obj and delivered to it asynchronously, so that a slow obj does
+        not hold up the connection or the other subscribers.
         """
-        # function to append subscribers to the proper list
-        def append_event(eventname, subclass, subscriber):
-            eventkey = eventname
+        functions = self._subscriptionFunctions(obj)
+        if not functions:
+            return
+        header_value = None
+        predicates = ()
+        if filters:
+            # events are routed by one filter (preferably the channel uuid,
+            ## being the most selective), and checked against any others 
+            ## upon delivery
+            predicates = sorted(filters.items(), 
+                key=lambda item: (item[0] != 'Unique-ID', item))
+            header_value = predicates[0]
+            predicates = tuple(predicates[1:])
+        owner = id(obj)
+        locations = self._subscriber_locations.setdefault(owner, set())
+        changed = set()
+        for funcname, eventname, subclass in functions:
+            subscriber = utils.subscriber_ref(getattr(obj, funcname), 
+                weak=weak, callback=self._subscriberDied)
+            subscriber.owner = owner
+            if queue is not None:
+                subscriber = delivery.QueuedMethod(subscriber, queue)
             # custom events will have a subclass
+            eventkey = eventname
             if subclass:
                 eventkey = ' '.join([eventname, subclass])
-            subscribers = self.event_subscriptions.get(eventkey, [])
-            if subscriber not in subscribers:
-                subscribers.append(subscriber)
-            self.event_subscriptions[eventkey] = subscribers
-        # find functions that meet a specific naming convention, denoting
-        ## that they are subscribing to an event, then determine which
-        ## event they are subscribing to
-        for funcname in dir(obj):
-            if not funcname.startswith('on'):
+            if header_value is None:
+                subscribers = self.event_subscriptions.setdefault(
+                    eventkey, [])
+            else:
+                subscribers = self.filtered_subscriptions.setdefault(
+                    header_value, {}).setdefault(eventkey, [])
+                subscriber = (subscriber, predicates)
+            if subscriber in subscribers:
                 continue
-            if not callable(getattr(obj, funcname, None)):
+            subscribers.append(subscriber)
+            self._countEvent(eventkey, 1)
+            locations.add((header_value, eventkey))
+            changed.add((header_value, eventkey))
+        if not locations:
+            del self._subscriber_locations[owner]
+        self._subscriptionsChanged(changed)
+
+    def unsubscribe(self, obj):
+        """
+        Stop delivering events to obj. FreeSWITCH is told to stop sending
+        any events (and remove any filters) that no longer have a subscriber.
+        """
+        self._removeSubscribers([id(obj)], lambda ref: ref.im_self is obj)
+
+    def subscriberCounts(self):
+        """
+        Returns a dictionary of the number of live subscription functions
+        for each event, filtered or not.
+        """
+        counts = {}
+        for eventkey, subscribers in self.event_subscriptions.iteritems():
+            counts[eventkey] = len(
+                [ref for ref in subscribers if ref() is not None])
+        for subscriptions in self.filtered_subscriptions.itervalues():
+            for eventkey, subscribers in subscriptions.iteritems():
+                counts[eventkey] = counts.get(eventkey, 0) + len(
+                    [ref for ref, predicates in subscribers 
+                        if ref() is not None])
+        return counts
+
+    def _countEvent(self, eventkey, delta):
+        count = self.event_counts.get(eventkey, 0) + delta
+        if count:
+            self.event_counts[eventkey] = count
+        else:
+            del self.event_counts[eventkey]
+
+    def _subscriberDied(self, ref):
+        # this is called from within garbage collection, so the actual 
+        ## cleanup is left for the next reactor iteration; until then, the
+        ## dead references are simply skipped during delegation
+        self._dead_subscribers.add(ref.owner)
+        if not self._prune_call:
+            self._prune_call = self.clock.callLater(0, self._pruneSubscribers)
+
+    def _pruneSubscribers(self):
+        self._prune_call = None
+        owners, self._dead_subscribers = self._dead_subscribers, set()
+        self._removeSubscribers(owners, lambda ref: ref() is None)
+
+    def _removeSubscribers(self, owners, removed):
+        """
+        Removes the subscription function references of the given owners
+        (subscribers, by id) for which removed returns True, then updates
+        the dispatch table and FreeSWITCH. Only the places the owners have
+        subscription functions in are looked at.
+        """
+        changed = set()
+        for owner in owners:
+            locations = self._subscriber_locations.get(owner)
+            if not locations:
                 continue
-            eventname, subclass = utils.funcname2eventname(funcname)
-            append_event(eventname, subclass, getattr(obj, funcname, None))
-        self.registerSubscribedEvents()
+            for location in list(locations):
+                header_value, eventkey = location
+                if header_value is None:
+                    subscribers = self.event_subscriptions.get(eventkey, [])
+                else:
+                    subscribers = self.filtered_subscriptions.get(
+                        header_value, {}).get(eventkey, [])
+                kept = []
+                # another subscriber may have been given the id of one that
+                ## died, and still be subscribed here
+                remaining = False
+                for subscriber in subscribers:
+                    ref = subscriber if header_value is None else \
+                        subscriber[0]
+                    if removed(ref):
+                        continue
+                    kept.append(subscriber)
+                    remaining = remaining or ref.owner == owner
+                if len(kept) < len(subscribers):
+                    self._countEvent(eventkey, len(kept) - len(subscribers))
+                    self._storeSubscribers(location, kept)
+                    changed.add(location)
+                if not remaining:
+                    locations.discard(location)
+            if not locations:
+                del self._subscriber_locations[owner]
+        self._subscriptionsChanged(changed)
+
+    def _subscriptionsChanged(self, locations):
+        """
+        Brings the dispatch table, and the events and filters registered
+        with FreeSWITCH, up to date with the subscriptions in the given
+        (header_value, eventkey) places, leaving everything else alone.
+        """
+        if not locations:
+            return
+        eventkeys = set()
+        buckets = set()
+        passthroughs = set()
+        for header_value, eventkey in locations:
+            eventkeys.add(eventkey)
+            if header_value is not None:
+                buckets.add(header_value)
+            elif eventkey != 'ALL':
+                self._compileEvent(eventkey)
+                # its passthrough filter may be needed, or no longer
+                passthroughs.add(self._passthroughFilter(eventkey))
+        if (None, 'ALL') in locations:
+            # every entry of the table includes the subscribers for ALL
+            self._compileEventTable()
+        for header_value in buckets:
+            self._compileFilter(header_value)
+        self.updateSubscribedEvents(eventkeys, buckets | passthroughs)
+
+    def _storeSubscribers(self, location, subscribers):
+        header_value, eventkey = location
+        if header_value is None:
+            if subscribers or eventkey == 'BACKGROUND_JOB':
+                self.event_subscriptions[eventkey] = subscribers
+            else:
+                del self.event_subscriptions[eventkey]
+            return
+        subscriptions = self.filtered_subscriptions[header_value]
+        if subscribers:
+            subscriptions[eventkey] = subscribers
+            return
+        del subscriptions[eventkey]
+        if not subscriptions:
+            del self.filtered_subscriptions[header_value]
+
+    def _subscriptionFunctions(self, obj):
+        """
+        Returns (funcname, eventname, subclass) for each subscription
+        function of obj; see utils.subscription_functions.
+        """
+        return utils.subscription_functions(obj)
+
+    def _compileDispatchTable(self):
+        """
+        Builds the table of subscription functions for each event, keyed by
+        (Event-Name, Event-Subclass), with the subscribers for ALL events
+        already merged in, and the table of filtered subscriptions.
+        Delegating an event is then a handful of lookups. Afterwards, only
+        the entries whose subscriptions change are rebuilt.
+        """
+        self._compileEventTable()
+        # filtered subscriptions are indexed by header, then header value,
+        ## so only the subscribers matching an event are ever looked at
+        self._filter_table = {}
+        for header_value in self.filtered_subscriptions:
+            self._compileFilter(header_value)
+
+    def _compileEventTable(self):
+        everything = tuple(self.event_subscriptions.get('ALL', []))
+        table = {}
+        for eventkey, subscribers in self.event_subscriptions.iteritems():
+            if eventkey == 'ALL':
+                continue
+            name, _, subclass = eventkey.partition(' ')
+            table[(name, subclass)] = tuple(subscribers) + everything
+        # swap in the new table in one step, so an event being delegated
+        ## never sees a partially built one
+        self._dispatch_table = table
+        self._dispatch_all = everything
+
+    def _compileEvent(self, eventkey):
+        name, _, subclass = eventkey.partition(' ')
+        subscribers = self.event_subscriptions.get(eventkey)
+        if subscribers is None:
+            self._dispatch_table.pop((name, subclass), None)
+        else:
+            self._dispatch_table[(name, subclass)] = tuple(subscribers) + \
+                self._dispatch_all
+
+    def _compileFilter(self, header_value):
+        """
+        Rebuilds the entry of the filter table for one (header, value).
+        """
+        header, value = header_value
+        subscriptions = self.filtered_subscriptions.get(header_value)
+        if not subscriptions:
+            values = self._filter_table.get(header, {})
+            values.pop(value, None)
+            if not values:
+                self._filter_table.pop(header, None)
+            return
+        filtered_all = tuple(subscriptions.get('ALL', []))
+        filtered = {'ALL': filtered_all}
+        for eventkey, subscribers in subscriptions.iteritems():
+            if eventkey == 'ALL':
+                continue
+            name, _, subclass = eventkey.partition(' ')
+            filtered[(name, subclass)] = tuple(subscribers) + filtered_all
+        self._filter_table.setdefault(header, {})[value] = filtered
 
     def _eventPlainTextDelegator(self, event, name, subclass=None, content=None):
         # watch for background job events and provide additional handling for
         ## the pending_jobs deferred objects waiting for bgapi response data
         if name == 'BACKGROUND_JOB':
-            job_deferred = self.pending_jobs.get(event.dict['Job-UUID'], None)
+            job_deferred = self._popJob(event.dict['Job-UUID'])
             if job_deferred:
                 job_deferred.callback(content)
-        # determine the subscription function name
-        funcname = utils.eventname2funcname(name, subclass=subclass)
-        # construct the function list from all subscribers
-        # NOTE: we copy the retrieved list into a new list object, to
-        ## avoid object reference issues causing the list contained in
-        ## the event_subscriptions dict to be modified
-        if subclass:
-            funclist = list(self.event_subscriptions.get(
-                ' '.join([name, subclass]), []))
-        else:
-            funclist = list(self.event_subscriptions.get(name, []))
-        # make sure subscribers for ALL events get this one
-        funclist += self.event_subscriptions.get('ALL', [])
-        # construct an informative event title
-        title = name
-        if subclass:
-            title = ' '.join([title, subclass])
-        for func in funclist:
-            if not callable(func):
-                logger.error('Subscription function %r for event %s is '
-                    'not callable.' % (funcname, title))
-                continue
-            # invoke the subscription function
-            func(event, content)
+        # the dispatch table holds immutable tuples of function references, 
+        ## so subscriptions changing during delegation can't affect this 
+        ## event; events nobody subscribed to specifically still go to ALL
+        funclist = self._dispatch_table.get((name, subclass or ''),
+            self._dispatch_all)
+        # the filtered subscriptions are found by looking up this event's
+        ## value for each header subscriptions are filtered on, before any
+        ## function is called, as the table entries are updated in place
+        filtered_lists = []
+        for header, values in self._filter_table.iteritems():
+            filtered = values.get(event.dict.get(header))
+            if filtered:
+                filtered_lists.append(filtered.get((name, subclass or ''),
+                    filtered['ALL']))
+        for ref in funclist:
+            func = ref()
+            # invoke the subscription function, unless the subscriber died
+            if func is not None:
+                func(event, content)
+        for filtered in filtered_lists:
+            for ref, predicates in filtered:
+                if predicates and not all(event.dict.get(key) == value 
+                        for key, value in predicates):
+                    continue
+                func = ref()
+                if func is not None:
+                    func(event, content)
 
-    def api(self, command, *args):
-        # TODO: see the todo for bgapi below; calling api commands back-to-back
-        ## exhibits very similar behavior, and should be fixed with queueing as
-        ## well.
-        self._deferred = defer.Deferred()
-        self._deferred.command = command
-        self._deferred.args = args
-        # create a deferred object to be triggered when the command has finished
-        command_deferred = defer.Deferred()
+    def api(self, command, *args, **kwargs):
+        """
+        Runs the command, returning a deferred which is called back with its
+        output. The deferred may be cancelled, and fails with a
+        CommandTimeoutError when no reply arrives within timeout seconds
+        (by default, command_timeout). A priority may be given for the
+        command queue (see sendCommand).
+        """
+        timeout = kwargs.pop('timeout', self.command_timeout)
+        sent = self.sendCommand('api %s %s' % (command, ' '.join(args)),
+            command=command, args=args, priority=kwargs.pop('priority', None))
+        # create a deferred object to be triggered when the command has
+        ## finished; cancelling it leaves the reply to be ignored
+        command_deferred = defer.Deferred(lambda d: sent.cancel())
         def success(event):
             # FreeSWITCH executed the command
             command_deferred.callback(event.result)
         def failure(error):
-            # FreeSWITCH failed to execute the command, so we errback
-            command_deferred.errback(error)
-        self._deferred.addCallback(success).addErrback(failure)
-        self.sendLine('api %s %s' % (command, ' '.join(args)))
+            # FreeSWITCH failed to execute the command, so we errback, unless
+            ## the command was already given up on
+            if not command_deferred.called:
+                command_deferred.errback(error)
+        sent.addCallback(success).addErrback(failure)
+        if timeout and not command_deferred.called:
+            timeout_call = self.clock.callLater(timeout, self._commandTimedOut,
+                command_deferred, sent, timeout)
+            def finished(result):
+                if timeout_call.active():
+                    timeout_call.cancel()
+                return result
+            command_deferred.addBoth(finished)
         # return the command_deferred object, so the user can add callbacks
         return command_deferred
 
-    def bgapi(self, command, *args):
-        # TODO: calling multiple bgapi (or api) commands back-to-back
-        ## will break the deferred callback flow here, by reassigning
-        ## the self._deferred attribute to a new Deferred object, losing
-        ## the previous object. This means that the Job-UUID response
-        ## event for the previous bgapi call will end up being assigned
-        ## to the later bgapi call, and subsequent job response for that
-        ## Job-UUID will go to the later bgapi calls deferred object.
-        ## This needs to be fixed at a later time with some sort of bgapi
-        ## queueing, but for now can be worked around by chaining bgapi
-        ## calls through with deferred callbacks.
-
-        # create the default deferred object, for determining whether
-        ## FreeSWITCH successfully started the background job
-        self._deferred = defer.Deferred()
-        self._deferred.command = command
-        self._deferred.args = args
+    def _commandTimedOut(self, command_deferred, sent, timeout):
+        self.stats['timeouts'] += 1
+        command_deferred.errback(CommandTimeoutError('No reply to api %s '
+            'within %s seconds.' % (sent.command, timeout)))
+        # the reply may still come, and must then be ignored
+        sent.cancel()
+
+    def bgapi(self, command, *args, **kwargs):
+        """
+        Runs the command as a background job, returning a deferred which is
+        called back with its output. The deferred may be cancelled, and
+        fails with a JobTimeoutError when the job has not completed within
+        timeout seconds (by default, job_timeout). A priority may be given
+        for the command queue (see sendCommand).
+        """
+        timeout = kwargs.pop('timeout', self.job_timeout)
+        # the Job-UUID is assigned here rather than by FreeSWITCH, so the
+        ## job_deferred can be registered before the command is even sent,
+        ## and the BACKGROUND_JOB event can never arrive ahead of it
+        job_uuid = str(uuid.uuid4())
         # create a deferred object to be triggered when the job has finished
-        job_deferred = defer.Deferred()
-        def success(event):
-            # FreeSWITCH started the background job, so we want to update
-            ## the pending_jobs dictionary with our job_deferred object,
-            ## keyed by the job id that FreeSWITCH assigned
-            self.pending_jobs.update({event.dict['Job-UUID']: job_deferred})
+        job_deferred = defer.Deferred(lambda d: self._abandonJob(job_uuid))
+        job_deferred.job_uuid = job_uuid
+        job_deferred.timeout = timeout
+        self.pending_jobs[job_uuid] = job_deferred
+        if timeout:
+            job_deferred.timeout_call = self.clock.callLater(
+                timeout, self._jobTimedOut, job_uuid)
         def failure(error):
-            # FreeSWITCH failed to start the background job, so we errback
-            job_deferred.errback(error)
-        self._deferred.addCallback(success).addErrback(failure)
-        self.sendLine(str('bgapi %s %s' % (command, ' '.join(args))))
+            # FreeSWITCH failed to start the background job, so we errback,
+            ## unless the job was already given up on
+            if self._popJob(job_uuid):
+                job_deferred.errback(error)
+        job_deferred.sent = self.sendCommand(str('bgapi %s\nJob-UUID: %s' % (
+            ' '.join((command,) + args), job_uuid)),
+            command=command, args=args, priority=kwargs.pop('priority', None))
+        job_deferred.sent.addErrback(failure)
         # return the job_deferred object, so the user can add callbacks
         return job_deferred
+
+    def _popJob(self, job_uuid):
+        """
+        Stops tracking the background job, returning its deferred, or None
+        if the job is unknown.
+        """
+        job_deferred = self.pending_jobs.pop(job_uuid, None)
+        timeout_call = getattr(job_deferred, 'timeout_call', None)
+        if timeout_call and timeout_call.active():
+            timeout_call.cancel()
+        return job_deferred
+
+    def _abandonJob(self, job_uuid):
+        """
+        Stops waiting on the background job, and on the reply to the bgapi
+        command if it has not arrived yet (it is then ignored).
+        """
+        job_deferred = self._popJob(job_uuid)
+        if job_deferred:
+            job_deferred.sent.cancel()
+
+    def _jobTimedOut(self, job_uuid):
+        job_deferred = self._popJob(job_uuid)
+        if job_deferred:
+            self.stats['timeouts'] += 1
+            job_deferred.errback(JobTimeoutError('No BACKGROUND_JOB event '
+                'for job %s within %s seconds.' % (job_uuid,
+                job_deferred.timeout)))
+            job_deferred.sent.cancel()
@@ -0,0 +1,72 @@
+"""
+Recording of the raw byte stream an event socket receives, so that it can be
+replayed later without FreeSWITCH (see misc/bench/replay.py).
+
+A recording is a series of records, each a RECORD header (the time the data
+was received, and its length) followed by the data, exactly as it was given
+to dataReceived:
+
+    protocol.recorder = Recorder('/var/tmp/fs01.esl')
+"""
+import logging
+import struct
+from twisted.internet import reactor
+
+# create a log target for this module
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct('!dI')
+
+
+class Recorder(object):
+    """
+    Appends the data given to record to the file at path (or to a file
+    object already open for writing), as it is received.
+    """
+    # source of the time data is received at
+    clock = reactor
+
+    def __init__(self, path):
+        if isinstance(path, basestring):
+            self.file = open(path, 'ab')
+        else:
+            self.file = path
+        self.records = 0
+        self.bytes = 0
+
+    def record(self, data):
+        data = str(data)
+        self.file.write(RECORD.pack(self.clock.seconds(), len(data)) + data)
+        self.records += 1
+        self.bytes += len(data)
+
+    def close(self):
+        self.file.close()
+
+
+def read_recording(path):
+    """
+    Yields the (time, data) of each record of the recording at path (or in
+    an open file object). A record cut short, as by the recording process
+    dying, ends the recording.
+    """
+    if isinstance(path, basestring):
+        recording = open(path, 'rb')
+    else:
+        recording = path
+    try:
+        while True:
+            header = recording.read(RECORD.size)
+            if not header:
+                return
+            if len(header) < RECORD.size:
+                break
+            timestamp, length = RECORD.unpack(header)
+            data = recording.read(length)
+            if len(data) < length:
+                break
+            yield timestamp, data
+        logger.warning('The recording ends with an incomplete record.')
+    finally:
+        if recording is not path:
+            recording.close()
@@ -0,0 +1,5 @@
+"""
+Tests for parseltone.eventsocket, run with trial:
+
+    trial parseltone.eventsocket.test
+"""
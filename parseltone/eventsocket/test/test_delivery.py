@@ -0,0 +1,134 @@
+"""
+Tests for the queued delivery of events to subscribers, with a cooperator
+scheduling its work on the clock of the protocol, and a clock of their own
+for the times events are queued and delivered at.
+"""
+from twisted.internet import task
+from parseltone.eventsocket.delivery import (COALESCE, DROP_NEWEST,
+    DROP_OLDEST, SubscriberQueue)
+from parseltone.eventsocket.test.test_protocol import (EventSocketTestCase,
+    Subscriber, plain_event)
+
+
+class Failing(Subscriber):
+    def onChannelAnswer(self, event, content):
+        Subscriber.onChannelAnswer(self, event, content)
+        raise RuntimeError('failed')
+
+
+class SubscriberQueueTests(EventSocketTestCase):
+    def setUp(self):
+        EventSocketTestCase.setUp(self)
+        self.time = task.Clock()
+        self.patch(SubscriberQueue, 'clock', self.time)
+        self.cooperator = task.Cooperator(
+            scheduler=lambda work: self.clock.callLater(0, work))
+
+    def subscribe(self, maxlen=1000, overflow=DROP_OLDEST,
+            subscriber_class=Subscriber):
+        self.subscriber = subscriber_class()
+        self.queue = SubscriberQueue(maxlen, overflow, self.cooperator)
+        self.protocol.subscribe(self.subscriber, queue=self.queue)
+
+    def answer(self, *uuids):
+        for uuid in uuids:
+            self.protocol.dataReceived(plain_event([('Event-Name',
+                'CHANNEL_ANSWER'), ('Unique-ID', uuid[0]),
+                ('Variable-Step', uuid)]))
+
+    def delivered(self):
+        """
+        Runs the cooperator until the queue is empty, returning the events
+        delivered meanwhile by Variable-Step.
+        """
+        self.clock.advance(0)
+        self.assertEqual(len(self.queue), 0)
+        steps = [event.dict['Variable-Step']
+            for event in self.subscriber.events]
+        self.subscriber.events = []
+        return steps
+
+    def test_queued(self):
+        """
+        Events are queued as received, and delivered in order by the
+        cooperator.
+        """
+        self.subscribe()
+        self.answer('a1', 'b1', 'a2')
+        self.assertEqual(self.subscriber.events, [])
+        self.assertEqual(len(self.queue), 3)
+        self.assertEqual(self.delivered(), ['a1', 'b1', 'a2'])
+        self.answer('c1')
+        self.assertEqual(self.delivered(), ['c1'])
+        stats = self.queue.stats
+        self.assertEqual((stats['queued'], stats['delivered'],
+            stats['dropped'], stats['peak']), (4, 4, 0, 3))
+
+    def test_dropOldest(self):
+        """
+        A full queue loses its oldest event for the new one.
+        """
+        self.subscribe(2, DROP_OLDEST)
+        self.answer('a1', 'b1', 'c1', 'd1')
+        self.assertEqual(self.delivered(), ['c1', 'd1'])
+        stats = self.queue.stats
+        self.assertEqual((stats['queued'], stats['delivered'],
+            stats['dropped'], stats['peak']), (4, 2, 2, 2))
+
+    def test_dropNewest(self):
+        """
+        A full queue loses the new event.
+        """
+        self.subscribe(2, DROP_NEWEST)
+        self.answer('a1', 'b1', 'c1', 'd1')
+        self.assertEqual(self.delivered(), ['a1', 'b1'])
+        stats = self.queue.stats
+        self.assertEqual((stats['queued'], stats['delivered'],
+            stats['dropped'], stats['peak']), (4, 2, 2, 2))
+
+    def test_coalesce(self):
+        """
+        A full queue replaces the queued event of the same channel with the
+        new one, in its place, and loses the oldest event for the events of
+        other channels.
+        """
+        self.subscribe(2, COALESCE)
+        self.answer('a1', 'b1', 'a2', 'b2', 'c1', 'b3')
+        self.assertEqual(self.delivered(), ['b3', 'c1'])
+        stats = self.queue.stats
+        self.assertEqual((stats['queued'], stats['delivered'],
+            stats['dropped'], stats['coalesced']), (6, 2, 1, 3))
+        # the entries of delivered events are not coalesced into
+        self.answer('a3', 'a4')
+        self.assertEqual(self.delivered(), ['a3', 'a4'])
+        self.assertEqual(self.queue.channel_entries, {})
+
+    def test_lag(self):
+        """
+        The stats tell how long the last and slowest events waited.
+        """
+        self.subscribe()
+        self.answer('a1')
+        self.time.advance(3)
+        self.answer('b1')
+        self.assertEqual(self.queue.lag(), 3)
+        self.delivered()
+        self.assertEqual(self.queue.lag(), 0)
+        self.answer('c1')
+        self.delivered()
+        stats = self.queue.stats
+        self.assertEqual((stats['lag'], stats['max_lag']), (0, 3))
+
+    def test_failed(self):
+        """
+        A failing subscription function is counted, and the following events
+        are still delivered.
+        """
+        self.subscribe(subscriber_class=Failing)
+        self.answer('a1', 'b1')
+        self.assertEqual(self.delivered(), ['a1', 'b1'])
+        stats = self.queue.stats
+        self.assertEqual((stats['delivered'], stats['failed']), (2, 2))
+
+    def test_unknownPolicy(self):
+        self.assertRaises(ValueError, SubscriberQueue, overflow='drop-all')
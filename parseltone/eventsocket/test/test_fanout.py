@@ -0,0 +1,304 @@
+"""
+Tests for EventFanout and its workers, with the worker processes replaced
+by StringTransports.
+"""
+import json
+import zlib
+from twisted.internet import error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from parseltone.eventsocket import fanout
+from parseltone.eventsocket.fanout import (EventFanout, FanoutReceiver,
+    FRAME_LENGTH)
+from parseltone.eventsocket.test.test_protocol import Everything
+
+UUIDS = ['%08x-0000-0000-0000-000000000000' % n for n in xrange(20)]
+
+
+def plain(name, uuid=None):
+    content = 'Event-Name: %s\n' % name
+    if uuid is not None:
+        content += 'Unique-ID: %s\n' % uuid
+    return content + '\n'
+
+def frames(data):
+    """
+    Splits the data written to a worker into its frames.
+    """
+    payloads = []
+    while data:
+        length, = FRAME_LENGTH.unpack(data[:FRAME_LENGTH.size])
+        data = data[FRAME_LENGTH.size:]
+        payloads.append(data[:length])
+        data = data[length:]
+    return payloads
+
+
+class FakeProcess(object):
+    pid = 1
+
+    def __init__(self):
+        self.stdin_closed = False
+
+    def closeStdin(self):
+        self.stdin_closed = True
+
+
+class FanoutTestCase(unittest.TestCase):
+    """
+    Runs an EventFanout whose spawned workers are connected to
+    StringTransports, with a task.Clock for its restarts.
+    """
+    workers = 4
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.spawned = []
+        self.patch(fanout.reactor, 'spawnProcess', self.spawnProcess)
+        self.patch(fanout.reactor, 'addSystemEventTrigger',
+            lambda *args: None)
+        self.fanout = EventFanout('myapp:Subscriber', workers=self.workers)
+        self.fanout.clock = self.clock
+        self.fanout.start()
+
+    def spawnProcess(self, worker, executable, args, **kwargs):
+        self.spawned.append(worker.index)
+        worker.makeConnection(proto_helpers.StringTransport())
+        return FakeProcess()
+
+    def received(self, index):
+        """
+        Returns the frames written to a worker since the last call.
+        """
+        transport = self.fanout.workers[index].transport
+        payloads = frames(transport.value())
+        transport.clear()
+        return payloads
+
+    def die(self, index):
+        self.fanout.workers[index].processEnded(
+            failure.Failure(error.ProcessTerminated(1)))
+
+
+class DispatchTests(FanoutTestCase):
+    def test_sharding(self):
+        """
+        The events of a channel all go to the worker chosen by the CRC32 of
+        its Unique-ID, in any case and content type.
+        """
+        for uuid in UUIDS:
+            index = zlib.crc32(uuid) % self.workers
+            self.fanout.dispatch('text/event-plain', plain('CHANNEL_CREATE',
+                uuid.upper()))
+            self.fanout.dispatch('text/event-json', json.dumps({
+                'Event-Name': 'CHANNEL_ANSWER', 'Unique-ID': uuid}))
+            self.fanout.dispatch('text/event-xml', '<event><headers>'
+                '<Event-Name>CHANNEL_HANGUP</Event-Name>'
+                '<Unique-ID>%s</Unique-ID></headers></event>' % uuid)
+            received = self.received(index)
+            self.assertEqual([payload.split('\n', 1)[0]
+                for payload in received], list(EventFanout.content_types))
+            for other in range(self.workers):
+                self.assertEqual(self.received(other), [])
+
+    def test_otherUniqueIDs(self):
+        """
+        Headers merely ending with Unique-ID do not choose the worker.
+        """
+        uuid, other = UUIDS[:2]
+        self.fanout.dispatch('text/event-plain', 'Event-Name: CUSTOM\n'
+            'Other-Leg-Unique-ID: %s\nUnique-ID: %s\n\n' % (other, uuid))
+        self.assertEqual(len(self.received(
+            zlib.crc32(uuid) % self.workers)), 1)
+
+    def test_roundRobin(self):
+        """
+        Events without a Unique-ID are spread over the workers in turn.
+        """
+        for n in range(self.workers * 2):
+            self.fanout.dispatch('text/event-plain', plain('HEARTBEAT'))
+        for index in range(self.workers):
+            self.assertEqual(len(self.received(index)), 2)
+
+    def test_events(self):
+        """
+        Only the named events are forwarded, if a list of them is given.
+        """
+        self.fanout.events = set(['CHANNEL_ANSWER'])
+        self.fanout.dispatch('text/event-plain', plain('HEARTBEAT'))
+        self.fanout.dispatch('text/event-plain', plain('CHANNEL_ANSWER'))
+        received = sum([self.received(index)
+            for index in range(self.workers)], [])
+        self.assertEqual(received,
+            ['text/event-plain\n' + plain('CHANNEL_ANSWER')])
+
+    def test_framing(self):
+        """
+        Each event is written to the worker as a 4 byte length, then the
+        content type and the event data separated by a linefeed.
+        """
+        content = plain('HEARTBEAT')
+        self.fanout.dispatch('text/event-plain', content)
+        payload = 'text/event-plain\n' + content
+        self.assertEqual(self.fanout.workers[0].transport.value(),
+            '\x00\x00\x00%c%s' % (len(payload), payload))
+
+
+class BacklogTests(FanoutTestCase):
+    workers = 1
+
+    def setUp(self):
+        FanoutTestCase.setUp(self)
+        self.fanout.max_backlog = 3
+        self.worker = self.fanout.workers[0]
+
+    def send(self, count):
+        for n in range(count):
+            self.fanout.dispatch('text/event-plain', plain('HEARTBEAT'))
+
+    def test_registered(self):
+        """
+        The worker is registered as the streaming producer of its pipe.
+        """
+        self.assertIdentical(self.worker.transport.producer, self.worker)
+        self.assertTrue(self.worker.transport.streaming)
+
+    def test_pauseResume(self):
+        """
+        Frames are held while the pipe is paused, and written in order once
+        it resumes.
+        """
+        self.worker.pauseProducing()
+        self.fanout.dispatch('text/event-plain', plain('ONE'))
+        self.fanout.dispatch('text/event-plain', plain('TWO'))
+        self.assertEqual(self.received(0), [])
+        self.assertEqual(self.fanout.stats()['backlog'], 2)
+        self.worker.resumeProducing()
+        self.assertEqual(self.received(0), ['text/event-plain\n' +
+            plain('ONE'), 'text/event-plain\n' + plain('TWO')])
+        # the worker is not paused anymore
+        self.fanout.dispatch('text/event-plain', plain('THREE'))
+        self.assertEqual(self.received(0),
+            ['text/event-plain\n' + plain('THREE')])
+
+    def test_pausedWhileResuming(self):
+        """
+        A pause while the backlog is written keeps the rest of it, and
+        frames sent meanwhile are held after it.
+        """
+        self.worker.pauseProducing()
+        self.send(2)
+        write = self.worker.transport.write
+        def pausing(data):
+            write(data)
+            self.worker.pauseProducing()
+        self.worker.transport.write = pausing
+        self.worker.resumeProducing()
+        self.worker.transport.write = write
+        self.assertEqual(len(self.received(0)), 1)
+        self.send(1)
+        self.assertEqual(len(self.worker.backlog), 2)
+        self.worker.resumeProducing()
+        self.assertEqual(len(self.received(0)), 2)
+
+    def test_dropped(self):
+        """
+        Frames beyond max_backlog are dropped while the worker is paused.
+        """
+        self.worker.pauseProducing()
+        self.send(5)
+        self.assertEqual(self.worker.stats['dropped'], 2)
+        self.assertEqual(self.worker.stats['peak_backlog'], 3)
+        self.worker.resumeProducing()
+        self.assertEqual(len(self.received(0)), 3)
+        stats = self.fanout.stats()
+        self.assertEqual((stats['sent'], stats['dropped'], stats['backlog']),
+            (3, 2, 0))
+
+    def test_deadWorker(self):
+        """
+        The backlog of a worker that died is counted as dropped, along with
+        the events of its channels until it is restarted.
+        """
+        self.worker.pauseProducing()
+        self.send(2)
+        self.die(0)
+        self.send(1)
+        stats = self.fanout.stats()
+        self.assertEqual((stats['dropped'], stats['workers']), (3, 0))
+        self.clock.advance(self.fanout.restart_delay)
+        self.send(1)
+        self.assertEqual(self.fanout.stats()['sent'], 1)
+
+
+class RestartTests(FanoutTestCase):
+    workers = 2
+
+    def test_backoff(self):
+        """
+        A worker dying in a row is restarted after a delay doubling up to
+        max_restart_delay, while the other workers are left alone.
+        """
+        self.assertEqual(self.spawned, [0, 1])
+        delays = []
+        for n in range(7):
+            self.die(1)
+            delay = self.clock.getDelayedCalls()[0].getTime() - \
+                self.clock.seconds()
+            delays.append(delay)
+            self.clock.advance(delay)
+        self.assertEqual(delays, [1, 2, 4, 8, 16, 30, 30])
+        self.assertEqual(self.spawned, [0, 1] + [1] * 7)
+        self.assertEqual(self.fanout.stats()['restarts'], 7)
+        self.assertEqual(sorted(self.fanout.workers), [0, 1])
+
+    def test_ranForAWhile(self):
+        """
+        A worker that ran for longer than max_restart_delay started
+        properly, and is restarted after restart_delay again.
+        """
+        for n in range(3):
+            self.die(0)
+            self.clock.advance(self.fanout.max_restart_delay)
+        self.clock.advance(self.fanout.max_restart_delay + 1)
+        self.die(0)
+        delay = self.clock.getDelayedCalls()[0].getTime() - \
+            self.clock.seconds()
+        self.assertEqual(delay, self.fanout.restart_delay)
+
+    def test_stop(self):
+        """
+        Stopping closes the pipes to the workers, and the workers exiting
+        then are not restarted.
+        """
+        processes = self.fanout.processes.values()
+        stopped = self.fanout.stop()
+        self.assertEqual([process.stdin_closed for process in processes],
+            [True, True])
+        self.die(0)
+        self.assertNoResult(stopped)
+        self.die(1)
+        self.successResultOf(stopped)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.spawned, [0, 1])
+
+
+class ReceiverTests(unittest.TestCase):
+    def test_delivered(self):
+        """
+        The frames received by a worker are delivered to its subscriber as
+        events.
+        """
+        subscriber = Everything()
+        receiver = FanoutReceiver(subscriber)
+        receiver.makeConnection(proto_helpers.StringTransport())
+        for content_type, content in [
+                ('text/event-plain', plain('CHANNEL_CREATE', UUIDS[0])),
+                ('text/event-json', json.dumps({'Event-Name': 'CHANNEL_CREATE',
+                    'Unique-ID': UUIDS[1]}))]:
+            payload = '%s\n%s' % (content_type, content)
+            receiver.dataReceived(FRAME_LENGTH.pack(len(payload)) + payload)
+        self.assertEqual([(event.dict['Event-Name'], event.dict['Unique-ID'])
+            for event in subscriber.events],
+            [('CHANNEL_CREATE', UUIDS[0]), ('CHANNEL_CREATE', UUIDS[1])])
@@ -0,0 +1,501 @@
+"""
+Tests for the commands and subscriptions of EventSocket, with the replies
+and events of FreeSWITCH fed to the protocol by hand.
+"""
+import json
+import re
+import urllib
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from parseltone.eventsocket.protocol import (CommandTimeoutError, EventSocket,
+    JobTimeoutError)
+
+
+def command_reply(text='+OK'):
+    return 'Content-Type: command/reply\nReply-Text: %s\n\n' % text
+
+def api_response(body):
+    return 'Content-Type: api/response\nContent-Length: %d\n\n%s' % (
+        len(body), body)
+
+def plain_event(headers, body=None):
+    content = ''.join(['%s: %s\n' % header for header in headers])
+    if body is not None:
+        content += 'Content-Length: %d\n\n%s' % (len(body), body)
+    else:
+        content += '\n'
+    return 'Content-Length: %d\nContent-Type: text/event-plain\n\n%s' % (
+        len(content), content)
+
+def json_event(headers, body=None):
+    content = dict(headers)
+    if body is not None:
+        content['_body'] = body
+    content = json.dumps(content)
+    return 'Content-Length: %d\nContent-Type: text/event-json\n\n%s' % (
+        len(content), content)
+
+def xml_event(headers, body=None):
+    content = '<event>\n  <headers>\n%s  </headers>\n' % ''.join([
+        '    <%s>%s</%s>\n' % (key, value, key) for key, value in headers])
+    if body is not None:
+        content += '  <body>%s</body>\n' % body
+    content += '</event>'
+    return 'Content-Length: %d\nContent-Type: text/event-xml\n\n%s' % (
+        len(content), content)
+
+def background_job(job_uuid, body):
+    return plain_event([('Event-Name', 'BACKGROUND_JOB'),
+        ('Job-UUID', job_uuid)], body)
+
+
+class Subscriber(object):
+    def __init__(self):
+        self.events = []
+
+    def onChannelAnswer(self, event, content):
+        self.events.append(event)
+
+
+class Everything(Subscriber):
+    def onAll(self, event, content):
+        self.events.append(event)
+
+
+class EventSocketTestCase(unittest.TestCase):
+    """
+    Connects an EventSocket to a StringTransport, with a task.Clock for its
+    delayed calls, and authenticates it.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.protocol = EventSocket()
+        self.protocol.clock = self.clock
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.protocol.dataReceived('Content-Type: auth/request\n\n')
+        self.protocol.dataReceived(command_reply('+OK accepted'))
+        # the events of the protocol's own subscriptions are registered
+        ## upon authentication
+        self.assertTrue(self.protocol.authorized)
+        self.assertEqual(self.sent()[0].split()[:2], ['auth', 'ClueCon'])
+        self.protocol.dataReceived(command_reply())
+
+    def sent(self):
+        """
+        Returns the commands written since the last call, clearing them.
+        """
+        commands = self.transport.value().split('\n\n')[:-1]
+        self.transport.clear()
+        return commands
+
+
+class CommandTests(EventSocketTestCase):
+    def setUp(self):
+        EventSocketTestCase.setUp(self)
+        self.sent()
+
+    def test_repliesInOrder(self):
+        """
+        Replies are matched to the commands in the order they were sent,
+        with any number of commands outstanding.
+        """
+        first = self.protocol.api('status')
+        second = self.protocol.api('version')
+        self.assertEqual(self.sent(), ['api status ', 'api version '])
+        self.protocol.dataReceived(api_response('up'))
+        self.protocol.dataReceived(api_response('1.0'))
+        self.assertEqual(self.successResultOf(first), 'up')
+        self.assertEqual(self.successResultOf(second), '1.0')
+        self.assertEqual(len(self.protocol.pending_commands), 0)
+
+    def test_mixedReplies(self):
+        """
+        The command/reply to a bgapi command and the api/response to an api
+        command sent after it answer their own commands.
+        """
+        job = self.protocol.bgapi('originate', 'user/1000', '&park')
+        command = self.protocol.api('status')
+        self.protocol.dataReceived(command_reply('+OK Job-UUID: x'))
+        self.protocol.dataReceived(api_response('up'))
+        self.assertEqual(self.successResultOf(command), 'up')
+        self.assertNoResult(job)
+
+    def test_errorReply(self):
+        """
+        A -ERR reply fails the command it answers, and only that one.
+        """
+        first = self.protocol.api('bogus')
+        second = self.protocol.api('status')
+        self.protocol.dataReceived(api_response('-ERR bogus Command not '
+            'found!\n'))
+        self.protocol.dataReceived(api_response('up'))
+        self.failureResultOf(first)
+        self.assertEqual(self.successResultOf(second), 'up')
+
+    def test_apiTimeout(self):
+        """
+        An api command fails with CommandTimeoutError once its timeout has
+        passed, and its late reply does not answer the next command.
+        """
+        slow = self.protocol.api('show', 'calls', timeout=5)
+        self.clock.advance(4)
+        self.assertNoResult(slow)
+        self.clock.advance(1)
+        self.failureResultOf(slow, CommandTimeoutError)
+        self.assertEqual(self.protocol.stats['timeouts'], 1)
+        following = self.protocol.api('status')
+        self.protocol.dataReceived(api_response('late'))
+        self.assertNoResult(following)
+        self.protocol.dataReceived(api_response('up'))
+        self.assertEqual(self.successResultOf(following), 'up')
+
+    def test_defaultTimeout(self):
+        """
+        Commands given no timeout use command_timeout.
+        """
+        self.protocol.command_timeout = 2
+        command = self.protocol.api('status')
+        self.clock.advance(2)
+        self.failureResultOf(command, CommandTimeoutError)
+
+    def test_replyCancelsTimeout(self):
+        """
+        A command answered in time leaves no delayed call behind.
+        """
+        command = self.protocol.api('status', timeout=5)
+        self.protocol.dataReceived(api_response('up'))
+        self.assertEqual(self.successResultOf(command), 'up')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancelSent(self):
+        """
+        Cancelling a command that was sent leaves its reply to be ignored.
+        """
+        cancelled = self.protocol.api('status')
+        following = self.protocol.api('version')
+        cancelled.cancel()
+        self.failureResultOf(cancelled, defer.CancelledError)
+        self.protocol.dataReceived(api_response('up'))
+        self.assertNoResult(following)
+        self.protocol.dataReceived(api_response('1.0'))
+        self.assertEqual(self.successResultOf(following), '1.0')
+
+    def test_connectionLost(self):
+        """
+        Commands and background jobs still waiting fail when the connection
+        is lost.
+        """
+        command = self.protocol.api('status')
+        job = self.protocol.bgapi('status')
+        self.protocol.connectionLost(failure.Failure(Exception('lost')))
+        self.failureResultOf(command)
+        self.failureResultOf(job)
+        self.assertEqual(self.protocol.pending_jobs, {})
+
+
+class BackgroundJobTests(EventSocketTestCase):
+    def setUp(self):
+        EventSocketTestCase.setUp(self)
+        self.sent()
+
+    def bgapi(self, *args, **kwargs):
+        """
+        Sends a bgapi command, returning its deferred and the Job-UUID it
+        was sent with.
+        """
+        job = self.protocol.bgapi(*args, **kwargs)
+        match = re.search(r'\nJob-UUID: (\S+)$', self.sent()[-1])
+        self.assertNotEqual(match, None)
+        return job, match.group(1)
+
+    def test_jobUUIDAssigned(self):
+        """
+        The Job-UUID is sent along with the command, and the job is waited
+        on before the command is even answered.
+        """
+        job, job_uuid = self.bgapi('status')
+        self.assertIn(job_uuid, self.protocol.pending_jobs)
+        self.protocol.dataReceived(command_reply('+OK Job-UUID: %s' %
+            job_uuid))
+        self.protocol.dataReceived(background_job(job_uuid, '+OK up\n'))
+        self.assertEqual(self.successResultOf(job), '+OK up\n')
+        self.assertEqual(self.protocol.pending_jobs, {})
+
+    def test_eventBeforeReply(self):
+        """
+        A BACKGROUND_JOB event arriving ahead of the reply to the command
+        still completes the job.
+        """
+        job, job_uuid = self.bgapi('status')
+        self.protocol.dataReceived(background_job(job_uuid, '+OK up\n'))
+        self.assertEqual(self.successResultOf(job), '+OK up\n')
+        following = self.protocol.api('version')
+        self.protocol.dataReceived(command_reply('+OK Job-UUID: %s' %
+            job_uuid))
+        self.protocol.dataReceived(api_response('1.0'))
+        self.assertEqual(self.successResultOf(following), '1.0')
+
+    def test_jobsByUUID(self):
+        """
+        Jobs complete in whatever order their events arrive in.
+        """
+        first, first_uuid = self.bgapi('status')
+        second, second_uuid = self.bgapi('version')
+        self.protocol.dataReceived(background_job(second_uuid, '1.0'))
+        self.protocol.dataReceived(background_job(first_uuid, 'up'))
+        self.assertEqual(self.successResultOf(first), 'up')
+        self.assertEqual(self.successResultOf(second), '1.0')
+
+    def test_rejected(self):
+        """
+        A job FreeSWITCH refuses to start fails, and is forgotten.
+        """
+        job, job_uuid = self.bgapi('bogus')
+        self.protocol.dataReceived(command_reply('-ERR bogus'))
+        self.failureResultOf(job)
+        self.assertEqual(self.protocol.pending_jobs, {})
+
+    def test_jobTimeout(self):
+        """
+        A job whose event does not arrive within its timeout fails with
+        JobTimeoutError, and is forgotten.
+        """
+        job, job_uuid = self.bgapi('status', timeout=10)
+        self.protocol.dataReceived(command_reply('+OK Job-UUID: %s' %
+            job_uuid))
+        self.clock.advance(10)
+        self.failureResultOf(job, JobTimeoutError)
+        self.assertEqual(self.protocol.pending_jobs, {})
+        self.assertEqual(self.protocol.stats['timeouts'], 1)
+        # the late event is ignored
+        self.protocol.dataReceived(background_job(job_uuid, 'late'))
+
+    def test_defaultJobTimeout(self):
+        """
+        Jobs given no timeout use job_timeout, and complete jobs leave no
+        delayed call behind.
+        """
+        job, job_uuid = self.bgapi('status')
+        self.clock.advance(self.protocol.job_timeout - 1)
+        self.assertNoResult(job)
+        self.protocol.dataReceived(background_job(job_uuid, 'up'))
+        self.successResultOf(job)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancel(self):
+        """
+        Cancelling a job forgets it, and leaves the reply to the command to
+        be ignored.
+        """
+        job, job_uuid = self.bgapi('status')
+        following = self.protocol.api('version')
+        job.cancel()
+        self.failureResultOf(job, defer.CancelledError)
+        self.assertEqual(self.protocol.pending_jobs, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.protocol.dataReceived(command_reply('+OK Job-UUID: %s' %
+            job_uuid))
+        self.assertNoResult(following)
+        self.protocol.dataReceived(api_response('1.0'))
+        self.assertEqual(self.successResultOf(following), '1.0')
+
+
+class CommandQueueTests(EventSocketTestCase):
+    def setUp(self):
+        EventSocketTestCase.setUp(self)
+        self.sent()
+        self.protocol.max_outstanding = 1
+
+    def test_maxOutstanding(self):
+        """
+        Commands beyond max_outstanding wait until a reply makes room.
+        """
+        first = self.protocol.api('status')
+        second = self.protocol.api('version')
+        self.assertEqual(self.sent(), ['api status '])
+        self.assertEqual(self.protocol.queueStats()['queued'], 1)
+        self.protocol.dataReceived(api_response('up'))
+        self.assertEqual(self.successResultOf(first), 'up')
+        self.assertEqual(self.sent(), ['api version '])
+        self.protocol.dataReceived(api_response('1.0'))
+        self.assertEqual(self.successResultOf(second), '1.0')
+
+    def test_maxOutstandingBytes(self):
+        """
+        Commands that would take the bytes outstanding beyond
+        max_outstanding_bytes wait, though a single command always goes.
+        """
+        self.protocol.max_outstanding = None
+        self.protocol.max_outstanding_bytes = 20
+        self.protocol.api('status', 'x' * 30)
+        self.protocol.api('version')
+        self.assertEqual(len(self.sent()), 1)
+        self.protocol.dataReceived(api_response('up'))
+        self.assertEqual(self.sent(), ['api version '])
+
+    def test_priority(self):
+        """
+        Queued commands are sent by priority, and in the order they were
+        given within a priority.
+        """
+        self.protocol.api('status')
+        self.protocol.api('show', 'calls')
+        self.protocol.api('uuid_kill', 'a')
+        self.protocol.api('version')
+        self.protocol.api('uuid_kill', 'b')
+        self.protocol.api('echo', priority=0)
+        self.sent()
+        order = []
+        while self.protocol.pending_commands:
+            self.protocol.dataReceived(api_response('+OK'))
+            order.extend(self.sent())
+        self.assertEqual(order, ['api echo ', 'api uuid_kill a',
+            'api uuid_kill b', 'api version ', 'api show calls'])
+        self.assertEqual(self.protocol.queueStats()['queued_peak'], 5)
+
+    def test_cancelQueued(self):
+        """
+        A command cancelled while queued is never sent.
+        """
+        self.protocol.api('status')
+        cancelled = self.protocol.api('show', 'calls')
+        following = self.protocol.api('version')
+        cancelled.cancel()
+        self.failureResultOf(cancelled, defer.CancelledError)
+        self.sent()
+        self.protocol.dataReceived(api_response('up'))
+        self.assertEqual(self.sent(), ['api version '])
+        self.protocol.dataReceived(api_response('1.0'))
+        self.assertEqual(self.successResultOf(following), '1.0')
+
+    def test_pauseResume(self):
+        """
+        While the transport has paused the protocol, commands are queued,
+        and they are sent once it resumes.
+        """
+        self.protocol.max_outstanding = None
+        self.protocol.pauseProducing()
+        command = self.protocol.api('status')
+        self.assertEqual(self.sent(), [])
+        stats = self.protocol.queueStats()
+        self.assertEqual((stats['queued'], stats['paused'], stats['pauses']),
+            (1, True, 1))
+        self.protocol.resumeProducing()
+        self.assertEqual(self.sent(), ['api status '])
+        self.protocol.dataReceived(api_response('up'))
+        self.assertEqual(self.successResultOf(command), 'up')
+
+    def test_queuedTimeout(self):
+        """
+        A command timing out while queued is never sent.
+        """
+        self.protocol.api('status')
+        command = self.protocol.api('version', timeout=5)
+        self.clock.advance(5)
+        self.failureResultOf(command, CommandTimeoutError)
+        self.sent()
+        self.protocol.dataReceived(api_response('up'))
+        self.assertEqual(self.sent(), [])
+
+
+class SubscriptionTests(EventSocketTestCase):
+    def test_eventRegistration(self):
+        """
+        An event is registered with FreeSWITCH when its first subscriber
+        comes, and unregistered when its last one goes.
+        """
+        self.sent()
+        first, second = Subscriber(), Subscriber()
+        self.protocol.subscribe(first)
+        self.assertEqual(self.sent(), ['event plain CHANNEL_ANSWER'])
+        self.protocol.subscribe(second)
+        self.assertEqual(self.sent(), [])
+        self.protocol.unsubscribe(first)
+        self.assertEqual(self.sent(), [])
+        self.protocol.unsubscribe(second)
+        self.assertEqual(self.sent(), ['nixevent CHANNEL_ANSWER'])
+
+    def test_filters(self):
+        """
+        Filtered subscriptions install their filters, along with those
+        letting the events of unfiltered subscriptions through, and only the
+        filters that change are sent afterwards.
+        """
+        self.sent()
+        first, second = Subscriber(), Subscriber()
+        self.protocol.subscribe(first, filters={'Unique-ID': 'a'})
+        commands = self.sent()
+        self.assertEqual(commands[0], 'event plain CHANNEL_ANSWER')
+        self.assertEqual(commands[-1], 'filter Unique-ID a')
+        self.assertIn('filter Event-Name BACKGROUND_JOB', commands)
+        self.protocol.subscribe(second, filters={'Unique-ID': 'b'})
+        self.assertEqual(self.sent(), ['filter Unique-ID b'])
+        self.protocol.unsubscribe(first)
+        self.assertEqual(self.sent(), ['filter delete Unique-ID a'])
+
+    def test_delivery(self):
+        """
+        Events go to the subscribers whose filters they match.
+        """
+        first, second = Subscriber(), Subscriber()
+        self.protocol.subscribe(first, filters={'Unique-ID': 'a'})
+        self.protocol.subscribe(second)
+        self.protocol.dataReceived(plain_event([('Event-Name',
+            'CHANNEL_ANSWER'), ('Unique-ID', 'a')]))
+        self.protocol.dataReceived(plain_event([('Event-Name',
+            'CHANNEL_ANSWER'), ('Unique-ID', 'b')]))
+        self.assertEqual([event.dict['Unique-ID'] for event in first.events],
+            ['a'])
+        self.assertEqual([event.dict['Unique-ID'] for event in second.events],
+            ['a', 'b'])
+
+
+class EventFormatTests(EventSocketTestCase):
+    """
+    The same event, received as plain text, json or xml, is delivered with
+    the same headers and content.
+    """
+    headers = [('Event-Name', 'CHANNEL_ANSWER'), ('Unique-ID', 'a'),
+        ('Caller-Caller-ID-Name', 'Sales Desk & 100%'),
+        ('variable_sip_from_user', '1000')]
+    body = 'some content'
+
+    def deliver(self, frame):
+        subscriber = Subscriber()
+        self.protocol.subscribe(subscriber)
+        self.protocol.dataReceived(frame)
+        self.assertEqual(len(subscriber.events), 1)
+        event = subscriber.events[0]
+        return dict((key, event.dict.get(key)) for key, value in
+            self.headers), event.content
+
+    def encoded(self):
+        # plain and xml events carry url encoded values
+        return [(key, urllib.quote(value)) for key, value in self.headers]
+
+    def test_plain(self):
+        self.assertEqual(self.deliver(plain_event(self.encoded(),
+            self.body)), (dict(self.headers), self.body))
+
+    def test_json(self):
+        self.assertEqual(self.deliver(json_event(self.headers, self.body)),
+            (dict(self.headers), self.body))
+
+    def test_xml(self):
+        self.assertEqual(self.deliver(xml_event(self.encoded(), self.body)),
+            (dict(self.headers), self.body))
+
+    def test_xmlWithoutHeaders(self):
+        """
+        An xml event without a headers element is delivered with just the
+        headers of its frame.
+        """
+        subscriber = Everything()
+        self.protocol.subscribe(subscriber)
+        self.protocol.dataReceived('Content-Length: 15\n'
+            'Content-Type: text/event-xml\n\n<event></event>')
+        self.assertEqual([event.name for event in subscriber.events], [''])
+        self.assertEqual(subscriber.events[0].content, None)
@@ -0,0 +1,97 @@
+"""
+Tests for the recording of the data received by an event socket, and the
+reading of recordings.
+"""
+from StringIO import StringIO
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from parseltone.eventsocket.protocol import EventSocket
+from parseltone.eventsocket.recording import Recorder, read_recording
+from parseltone.eventsocket.test.test_protocol import (Everything,
+    command_reply, plain_event)
+
+# the data received by an event socket, as it arrived: an event split
+## across two reads, and another one given in the same read as a reply
+CHUNKS = [
+    'Content-Type: auth/request\n\n',
+    command_reply('+OK accepted'),
+    plain_event([('Event-Name', 'CHANNEL_CREATE'), ('Unique-ID', 'a')])[:30],
+    plain_event([('Event-Name', 'CHANNEL_CREATE'), ('Unique-ID', 'a')])[30:],
+    command_reply() + plain_event([('Event-Name', 'CUSTOM')], 'body'),
+]
+
+
+class RecordingTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(Recorder, 'clock', self.clock)
+
+    def feed(self, protocol, chunks):
+        protocol.makeConnection(proto_helpers.StringTransport())
+        for chunk in chunks:
+            self.clock.advance(1.5)
+            protocol.dataReceived(chunk)
+
+    def test_roundTrip(self):
+        """
+        The records read back are the data received by the protocol, with
+        the times it was received at.
+        """
+        path = self.mktemp()
+        protocol = EventSocket()
+        protocol.recorder = Recorder(path)
+        self.feed(protocol, CHUNKS)
+        protocol.recorder.close()
+        self.assertEqual(protocol.recorder.records, len(CHUNKS))
+        self.assertEqual(protocol.recorder.bytes, len(''.join(CHUNKS)))
+        self.assertEqual(list(read_recording(path)),
+            [(1.5 * (n + 1), chunk) for n, chunk in enumerate(CHUNKS)])
+
+    def test_replay(self):
+        """
+        Replaying a recording delivers the same events as the data it was
+        recorded from.
+        """
+        recording = StringIO()
+        recorder = Recorder(recording)
+        recorded, replayed = Everything(), Everything()
+        protocol = EventSocket()
+        protocol.recorder = recorder
+        protocol.subscribe(recorded)
+        self.feed(protocol, CHUNKS)
+        recording.seek(0)
+        protocol = EventSocket()
+        protocol.subscribe(replayed)
+        self.feed(protocol, [data for timestamp, data in
+            read_recording(recording)])
+        self.assertEqual([event.dict['Event-Name']
+            for event in replayed.events], ['CHANNEL_CREATE', 'CUSTOM'])
+        self.assertEqual([(event.dict, event.content)
+            for event in replayed.events], [(event.dict, event.content)
+            for event in recorded.events])
+
+    def test_appended(self):
+        """
+        A recorder appends to an existing recording.
+        """
+        path = self.mktemp()
+        for chunk in CHUNKS[:2]:
+            recorder = Recorder(path)
+            recorder.record(chunk)
+            recorder.close()
+        self.assertEqual([data for timestamp, data in read_recording(path)],
+            CHUNKS[:2])
+
+    def test_incomplete(self):
+        """
+        A record cut short ends the recording, in its header or its data.
+        """
+        recording = StringIO()
+        recorder = Recorder(recording)
+        for chunk in CHUNKS[:2]:
+            recorder.record(chunk)
+        data = recording.getvalue()
+        for cut in (len(CHUNKS[1]) // 2, len(CHUNKS[1]) + 6):
+            self.assertEqual([chunk for timestamp, chunk in
+                read_recording(StringIO(data[:-cut]))], CHUNKS[:1])
@@ -1,15 +1,43 @@
+from collections import MutableMapping
 import logging
+import re
 import string
 from urllib import unquote
+import weakref
 
 # create a log target for this module
 logger = logging.getLogger(__name__)
 
+# one shared copy of every header name seen, so that the parsed events and
+## the channels keeping their variables do not each hold their own; names
+## beyond the limit (such as arbitrary variable names) are simply not shared
+HEADER_NAMES = {}
+HEADER_NAMES_LIMIT = 10000
+# the patterns LazyEventDict.prefixed finds headers with, by prefix
+PREFIX_PATTERNS = {}
+# names of the subscription functions defined by each subscriber class
+SUBSCRIPTION_NAMES = {}
+
 def value_cleanup(value):
-    # remove url formatting from the value
-    value = unquote(value)
+    # remove url formatting from the value, if there is any
+    if '%' in value:
+        value = unquote(value)
     return value
 
+def header_name(name):
+    """
+    Returns the shared copy of the given header name.
+
+        >>> header_name('Unique-' + 'ID') is header_name('Unique-ID')
+        True
+    """
+    try:
+        return HEADER_NAMES[name]
+    except KeyError:
+        if len(HEADER_NAMES) < HEADER_NAMES_LIMIT:
+            HEADER_NAMES[name] = name
+        return name
+
 
 class EventDict(dict):
     """
@@ -27,7 +55,7 @@ class EventDict(dict):
         try:
             for key, value in [
                     pair.split(':', 1) for pair in data.split('\n') if pair]:
-                self[key.strip()] = value_cleanup(value.lstrip())
+                self[header_name(key.strip())] = value_cleanup(value.lstrip())
         except ValueError, e:
             logger.error('Unable to parse data: %r' % data)
             raise e
@@ -38,6 +66,207 @@ class EventDict(dict):
                 'content length.')
 
 
+class LazyEventDict(MutableMapping):
+    """
+    A drop-in replacement for EventDict which defers the parsing. The raw
+    data is kept as is, and a header is only located and url decoded the 
+    first time it is looked up, after which the value is cached. Anything
+    that needs every header (iteration, keys, items, len, etc.) parses the
+    remainder in bulk through materialize().
+    """
+    def __init__(self, data):
+        self.raw = data
+        self._values = {}
+        self._materialized = False
+        self._content = None
+        # some event data contains a content block within it
+        self._end = data.find('\n\n')
+        if self._end == -1:
+            self._end = len(data)
+
+    @property
+    def content(self):
+        if self._content is None and self._end < len(self.raw):
+            self._content = self.raw[self._end + 2:]
+            if self._content and len(self._content) != self.content_length:
+                logger.warning('Content-Length value does not match the '
+                    'actual content length.')
+        return self._content
+
+    @property
+    def content_type(self):
+        return self.get('Content-Type', '').strip()
+
+    @property
+    def content_length(self):
+        return int(self.get('Content-Length', 0))
+
+    def materialize(self):
+        """
+        Decodes every header not yet looked up, returning this mapping.
+        """
+        if self._materialized:
+            return self
+        data = self.raw[:self._end]
+        values = {}
+        try:
+            for key, value in [
+                    pair.split(':', 1) for pair in data.split('\n') if pair]:
+                values[header_name(key.strip())] = value
+        except ValueError, e:
+            logger.error('Unable to parse data: %r' % data)
+            raise e
+        # values already looked up or assigned take precedence
+        for key, value in values.iteritems():
+            if key not in self._values:
+                self._values[key] = value_cleanup(value.lstrip())
+        self._materialized = True
+        return self
+
+    def prefixed(self, prefix):
+        """
+        Returns the (key, value) of every header whose name starts with the
+        prefix, such as the variable_ headers, decoding only those.
+        """
+        if self._materialized:
+            return [(key, value) for key, value in self._values.iteritems()
+                if key.startswith(prefix)]
+        try:
+            pattern = PREFIX_PATTERNS[prefix]
+        except KeyError:
+            # a pattern starting with a literal is searched for quickly, so
+            ## the header block is given a leading linefeed to match instead
+            ## of using ^
+            pattern = PREFIX_PATTERNS[prefix] = re.compile(
+                r'\n(%s[^:\n]*):[ \t]*([^\n]*)' % re.escape(prefix))
+        # the last of any repeated header wins, as with materialize(), and
+        ## values already looked up or assigned take precedence
+        values = dict(pattern.findall('\n' + self.raw[:self._end]))
+        known = self._values
+        return [(key, known[key] if key in known else value_cleanup(value))
+            for key, value in values.iteritems()]
+
+    def _lookup(self, key):
+        # the header is either on the first line, or follows a linefeed
+        needle = '\n%s:' % key
+        start = self.raw.rfind(needle, 0, self._end)
+        if start != -1:
+            start += len(needle)
+        elif self.raw.startswith(needle[1:]):
+            start = len(needle) - 1
+        else:
+            raise KeyError(key)
+        stop = self.raw.find('\n', start, self._end)
+        if stop == -1:
+            stop = self._end
+        value = self._values[key] = value_cleanup(
+            self.raw[start:stop].lstrip())
+        return value
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            if self._materialized:
+                raise
+            return self._lookup(key)
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        self.materialize()
+        del self._values[key]
+
+    def __iter__(self):
+        return iter(self.materialize()._values)
+
+    def __len__(self):
+        return len(self.materialize()._values)
+
+    def __repr__(self):
+        return repr(self.materialize()._values)
+
+
+class WeakMethod(object):
+    """
+    A weak reference to a bound method, which stays valid for as long as the
+    object the method is bound to. Calling the reference returns the bound 
+    method, or None once the object has been garbage collected, at which 
+    point the optional callback is called with this reference.
+    """
+    def __init__(self, method, callback=None):
+        self.im_func = method.im_func
+        if callback:
+            self._ref = weakref.ref(method.im_self, lambda ref: callback(self))
+        else:
+            self._ref = weakref.ref(method.im_self)
+
+    def __call__(self):
+        obj = self._ref()
+        if obj is None:
+            return None
+        return self.im_func.__get__(obj, obj.__class__)
+
+    def __eq__(self, other):
+        return isinstance(other, WeakMethod) and \
+            self.im_func is other.im_func and \
+            self.im_self is not None and self.im_self is other.im_self
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def im_self(self):
+        return self._ref()
+
+
+class StrongMethod(object):
+    """
+    A strong reference with the same interface as WeakMethod, for functions
+    that can't (or shouldn't) be weakly referenced.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.im_self = getattr(func, 'im_self', None)
+
+    def __call__(self):
+        return self.func
+
+    def __eq__(self, other):
+        return isinstance(other, StrongMethod) and self.func == other.func
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def subscriber_ref(func, weak=True, callback=None):
+    """
+    Returns a WeakMethod for bound methods when weak is True, and a 
+    StrongMethod otherwise (plain functions, or objects that don't support 
+    weak references).
+    """
+    if weak and getattr(func, 'im_self', None) is not None:
+        try:
+            return WeakMethod(func, callback=callback)
+        except TypeError:
+            pass
+    return StrongMethod(func)
+
+
+def prefixed(headers, prefix):
+    """
+    Returns the (key, value) of every header whose name starts with the
+    prefix, without decoding the others when headers is a LazyEventDict.
+
+        >>> prefixed({'variable_a': '1', 'Unique-ID': 'x'}, 'variable_')
+        [('variable_a', '1')]
+    """
+    if isinstance(headers, LazyEventDict):
+        return headers.prefixed(prefix)
+    return [(key, value) for key, value in headers.iteritems()
+        if key.startswith(prefix)]
+
 def eventname2funcname(eventname, subclass=''):
     funcname = 'on' + eventname.title().replace('_', '')
     if subclass:
@@ -63,6 +292,32 @@ def funcname2eventname(funcname):
             subclass = subclass[0] + subclass[1:].replace(letter, '::' + letter)
     return (eventname.upper(), subclass.lower())
 
+def subscription_functions(obj):
+    """
+    Returns (funcname, eventname, subclass) for each function of obj that
+    meets the naming convention denoting an event subscription. Scanning 
+    dir() is only done once per class, since subscribers are often 
+    created in numbers (one per channel, for example).
+    """
+    cls = obj.__class__
+    try:
+        names = SUBSCRIPTION_NAMES[cls]
+    except KeyError:
+        names = SUBSCRIPTION_NAMES[cls] = tuple(
+            funcname for funcname in dir(cls) 
+            if funcname.startswith('on') and 
+            callable(getattr(cls, funcname, None)))
+    # functions may also be assigned to the instance itself
+    names += tuple(funcname for funcname in getattr(obj, '__dict__', ())
+        if funcname.startswith('on') and funcname not in names)
+    functions = []
+    for funcname in names:
+        if not callable(getattr(obj, funcname, None)):
+            continue
+        eventname, subclass = funcname2eventname(funcname)
+        functions.append((funcname, eventname, subclass))
+    return functions
+
 def format_event(event_title, event_dict, content=None):
     """
     Returns a string representation of the event information,
@@ -1,4 +1,8 @@
+from collections import deque
+import functools
 import logging
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure, threadpool
 
 # create a log target for this module
 logger = logging.getLogger(__name__)
@@ -61,6 +65,126 @@ def requires_attr(name, default=False, evaluate=lambda value: value,
     return _decorated
 
 
+class ThreadLanes(object):
+    """
+    Runs blocking functions on a thread pool of its own, in lanes: the
+    functions given the same key (such as a channel uuid) run one at a time,
+    in the order given, while those of other lanes run in parallel. There
+    are as many threads as lanes, unless a threadpool is given.
+    """
+    def __init__(self, lanes=4, threadpool=None):
+        if threadpool is None:
+            threadpool = self._startPool(lanes)
+        self.threadpool = threadpool
+        # the functions waiting in each lane, and whether one is running
+        self.lanes = [deque() for i in xrange(lanes)]
+        self.running = [False] * lanes
+        self.counters = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'peak_queued': 0,
+            # submissions made while every lane was busy
+            'saturated': 0,
+        }
+
+    def _startPool(self, size):
+        pool = threadpool.ThreadPool(0, size, name='ThreadLanes')
+        reactor.callWhenRunning(pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+        return pool
+
+    def run(self, key, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) in the lane of key, returning a deferred
+        which is called back with its result.
+        """
+        index = hash(key) % len(self.lanes)
+        d = defer.Deferred()
+        if all(self.running):
+            self.counters['saturated'] += 1
+        self.counters['submitted'] += 1
+        self.lanes[index].append((func, args, kwargs, d))
+        queued = sum([len(lane) for lane in self.lanes])
+        if queued > self.counters['peak_queued']:
+            self.counters['peak_queued'] = queued
+        if not self.running[index]:
+            self._next(index)
+        return d
+
+    def _next(self, index):
+        lane = self.lanes[index]
+        if not lane:
+            self.running[index] = False
+            return
+        self.running[index] = True
+        func, args, kwargs, d = lane.popleft()
+        def done(result):
+            if isinstance(result, failure.Failure):
+                self.counters['failed'] += 1
+            self.counters['completed'] += 1
+            self._next(index)
+            d.callback(result)
+        threads.deferToThreadPool(reactor, self.threadpool, func, *args,
+            **kwargs).addBoth(done)
+
+    def stats(self):
+        """
+        Returns the counters, along with the lanes busy and the functions
+        queued in them, and the threads of the pool in use.
+        """
+        stats = dict(self.counters)
+        stats.update({
+            'lanes': len(self.lanes),
+            'busy': len([running for running in self.running if running]),
+            'queued': sum([len(lane) for lane in self.lanes]),
+            'threads_busy': len(self.threadpool.working),
+            'threads_max': self.threadpool.max,
+        })
+        return stats
+
+
+# the lanes of blocking subscription functions not given lanes of their own
+default_lanes = None
+
+def blocking(lanes=None, key='Unique-ID'):
+    """
+    Decorator for an event subscription function that blocks (on database
+    writes or file I/O, say), running it on the ThreadLanes given, or on
+    default_lanes, instead of the reactor thread. The events of a channel
+    (those with the same value for the key header) are handled in order;
+    failures are logged.
+
+        class CdrWriter(object):
+            @blocking()
+            def onChannelHangupComplete(self, event, content):
+                Cdr.objects.create(uuid=event.dict['Unique-ID'], ...)
+
+    The event is shared with the reactor thread, and should only be read.
+    """
+    def _decorated(func):
+        @functools.wraps(func)
+        def _do_func(self, event, content):
+            global default_lanes
+            target = lanes
+            if target is None:
+                if default_lanes is None:
+                    default_lanes = ThreadLanes()
+                target = default_lanes
+            # parse every header here, so the threads never parse the
+            ## (shared) event concurrently
+            materialize = getattr(event.dict, 'materialize', None)
+            if materialize:
+                materialize()
+            def error(reason):
+                logger.error('Blocking subscription function %r failed: %s',
+                    func.__name__, reason.getTraceback())
+            return target.run(event.dict.get(key), func, self, event,
+                content).addErrback(error)
+        return _do_func
+    return _decorated
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,73 @@
+"""
+Shared parts of the supervisors running subscribers and servers in worker
+processes (see parseltone.api.workers and parseltone.eventsocket.fanout).
+"""
+import logging
+from twisted.internet import defer, reactor
+
+# create a log target for this module
+logger = logging.getLogger(__name__)
+
+
+def load_object(path):
+    """
+    Imports the object named by 'module:attribute'.
+    """
+    module_name, name = path.split(':', 1)
+    module = __import__(module_name, fromlist=[name])
+    return getattr(module, name)
+
+
+class ProcessSupervisor(object):
+    """
+    Keeps a number of worker processes running until it is stopped. A worker
+    that dies is restarted after restart_delay seconds, doubling for each
+    further death in a row up to max_restart_delay, so a worker that can not
+    start does not spin. Subclasses define spawn(index), which adds the
+    process of the worker to self.processes.
+    """
+    restart_delay = 1
+    max_restart_delay = 30
+    # source of delayed calls; may be replaced with a task.Clock for testing
+    clock = reactor
+
+    def __init__(self):
+        # the process of each running worker, by index
+        self.processes = {}
+        # deaths in a row of each worker
+        self.failures = {}
+        self.restarts = 0
+        self.stopping = False
+        self.stopped = defer.Deferred()
+
+    def workerStarted(self, index):
+        """
+        Called once a worker is known to have started properly, so that a
+        later death is restarted after restart_delay again.
+        """
+        self.failures.pop(index, None)
+
+    def processEnded(self, index):
+        """
+        Forgets the process of a worker that exited. Returns the seconds
+        until it is restarted, or None while stopping, the stopped deferred
+        being called back once every worker has exited.
+        """
+        del self.processes[index]
+        if self.stopping:
+            if not self.processes:
+                self.stopped.callback(None)
+            return None
+        failures = self.failures[index] = self.failures.get(index, 0) + 1
+        delay = min(self.restart_delay * 2 ** (failures - 1),
+            self.max_restart_delay)
+        self.restarts += 1
+        self.clock.callLater(delay, self.restart, index)
+        return delay
+
+    def restart(self, index):
+        if not self.stopping and index not in self.processes:
+            self.spawn(index)
+
+    def spawn(self, index):
+        raise NotImplementedError
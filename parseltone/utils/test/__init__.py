@@ -0,0 +1,5 @@
+"""
+Tests for parseltone.utils, run with trial:
+
+    trial parseltone.utils.test
+"""
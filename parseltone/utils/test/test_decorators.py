@@ -0,0 +1,135 @@
+"""
+Tests for ThreadLanes, on a thread pool whose work is run by hand, and on a
+real one.
+"""
+import threading
+import time
+from twisted.internet import defer
+from twisted.python import failure, threadpool
+from twisted.trial import unittest
+from parseltone.utils.decorators import ThreadLanes
+
+
+class ManualPool(object):
+    """
+    Stands in for a thread pool, holding the functions given to it until
+    run is called.
+    """
+    max = 2
+
+    def __init__(self):
+        self.calls = []
+        self.working = []
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kwargs):
+        self.calls.append((onResult, func, args, kwargs))
+
+    def pending(self):
+        return [call[2] for call in self.calls]
+
+    def run(self):
+        onResult, func, args, kwargs = self.calls.pop(0)
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            onResult(False, failure.Failure())
+        else:
+            onResult(True, result)
+
+
+def echo(value):
+    return value
+
+def fail(value):
+    raise ValueError(value)
+
+
+class ManualLaneTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = ManualPool()
+        self.lanes = ThreadLanes(lanes=2, threadpool=self.pool)
+
+    def test_oneAtATime(self):
+        """
+        The functions of a lane are given to the pool one at a time, in the
+        order they were run, while another lane has its own running.
+        """
+        first = self.lanes.run(0, echo, 'first')
+        other = self.lanes.run(1, echo, 'other')
+        # run while every lane is busy
+        second = self.lanes.run(0, echo, 'second')
+        self.assertEqual(self.pool.pending(), [('first',), ('other',)])
+        stats = self.lanes.stats()
+        self.assertEqual((stats['busy'], stats['queued'], stats['saturated']),
+            (2, 1, 1))
+        self.pool.run()
+        def ran(result):
+            self.assertEqual(result, 'first')
+            self.assertEqual(self.pool.pending(), [('other',), ('second',)])
+            self.pool.run()
+            self.pool.run()
+            return defer.gatherResults([other, second])
+        def idle(results):
+            self.assertEqual(results, ['other', 'second'])
+            stats = self.lanes.stats()
+            self.assertEqual((stats['submitted'], stats['completed'],
+                stats['busy'], stats['queued'], stats['peak_queued']),
+                (3, 3, 0, 0, 1))
+        return first.addCallback(ran).addCallback(idle)
+
+    def test_failure(self):
+        """
+        A failing function fails its deferred, and the next function of its
+        lane still runs.
+        """
+        failed = self.lanes.run(0, fail, 'failed')
+        following = self.lanes.run(0, echo, 'following')
+        self.pool.run()
+        def ran(result):
+            self.assertEqual(self.pool.pending(), [('following',)])
+            self.pool.run()
+            return following
+        def idle(result):
+            self.assertEqual(result, 'following')
+            stats = self.lanes.stats()
+            self.assertEqual((stats['completed'], stats['failed']), (2, 1))
+        d = self.assertFailure(failed, ValueError)
+        return d.addCallback(ran).addCallback(idle)
+
+
+class ThreadedLaneTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = threadpool.ThreadPool(0, 4)
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+        self.lanes = ThreadLanes(lanes=4, threadpool=self.pool)
+        self.lock = threading.Lock()
+        # the steps run in each lane, and the most running at once
+        self.steps = {}
+        self.running = {}
+        self.most = {}
+
+    def step(self, key, n):
+        with self.lock:
+            self.running[key] = self.running.get(key, 0) + 1
+            self.most[key] = max(self.most.get(key, 0), self.running[key])
+        time.sleep(0.001)
+        with self.lock:
+            self.steps.setdefault(key, []).append(n)
+            self.running[key] -= 1
+
+    def test_inOrder(self):
+        """
+        The functions given the same key run one at a time, in order, on
+        the threads of the pool.
+        """
+        keys = ['a', 'b', 'c']
+        d = defer.gatherResults([self.lanes.run(key, self.step, key, n)
+            for n in range(20) for key in keys])
+        def check(result):
+            for key in keys:
+                self.assertEqual(self.steps[key], range(20))
+                self.assertEqual(self.most[key], 1)
+            stats = self.lanes.stats()
+            self.assertEqual((stats['completed'], stats['busy']), (60, 0))
+        return d.addCallback(check)
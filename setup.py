@@ -20,6 +20,7 @@ setup(
     packages=[
         'parseltone',
         'parseltone.api',
+        'parseltone.api.test',
         'parseltone.django',
         'parseltone.django.apps.api',
         'parseltone.django.apps.freeswitch',
@@ -28,6 +29,7 @@ setup(
         'parseltone.django.apps.provisioning',
         'parseltone.django.apps.provisioning.polycom',
         'parseltone.eventsocket',
+        'parseltone.eventsocket.test',
         'parseltone.interface',
         'parseltone.interface.client',
         'parseltone.interface.client.curses',
@@ -36,6 +38,7 @@ setup(
         'parseltone.interface.manager.avatar',
         'parseltone.interface.manager.checkers',
         'parseltone.utils',
+        'parseltone.utils.test',
     ],
     package_data={
         'parseltone.django.apps.freeswitch': [